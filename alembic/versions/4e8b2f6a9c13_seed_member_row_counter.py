@@ -0,0 +1,31 @@
+"""Seed member row counter
+
+Revision ID: 4e8b2f6a9c13
+Revises: 1c7e5a9b3d84
+Create Date: 2026-10-17 21:05:12.640317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e8b2f6a9c13'
+down_revision: Union[str, None] = '1c7e5a9b3d84'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 成员列表的 ETag 校验值读取 member 的计数，按现有数据初始化
+    op.execute(
+        "INSERT INTO rowcounter (table_name, row_count) SELECT 'member', count(*) FROM member "
+        "ON CONFLICT (table_name) DO UPDATE SET row_count = EXCLUDED.row_count"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DELETE FROM rowcounter WHERE table_name = 'member'")
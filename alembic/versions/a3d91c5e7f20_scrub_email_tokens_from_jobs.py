@@ -0,0 +1,33 @@
+"""Scrub raw email tokens from job payloads
+
+Revision ID: a3d91c5e7f20
+Revises: e6c3f0a9d215
+Create Date: 2026-10-17 19:12:05.274310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d91c5e7f20'
+down_revision: Union[str, None] = 'e6c3f0a9d215'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 旧版本把原始的验证/重置令牌写入了 job.payload；worker 现在在发送时按 email_to 查找用户并重新生成令牌
+    op.execute(
+        "UPDATE job SET payload = (payload::jsonb - 'token')::json "
+        "WHERE kind IN ('email.verification', 'email.password_reset') "
+        "AND (payload::jsonb - 'token') <> payload::jsonb"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 被清除的令牌无法恢复
+    pass
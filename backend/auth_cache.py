@@ -0,0 +1,108 @@
+﻿# backend/auth_cache.py
+"""
+已认证用户的进程内缓存。
+
+每个需要登录的请求都要确认令牌对应的用户仍然存在、未被禁用，并读取其角色。
+这里缓存这几个与认证相关的字段 (短 TTL + 容量上限的 LRU)，命中时请求不再为此访问数据库。
+
+失效方式：
+- crud 中修改这些字段 (管理员修改用户、删除用户、修改密码等) 的操作提交后调用 invalidate_auth_user；
+- 同时通过 Postgres NOTIFY 广播到其他 worker (见 backend/invalidation.py)，各进程收到后删除对应条目；
+- 监听连接断开期间可能漏掉通知，重新连接后清空整个缓存；TTL 是最后一道保障。
+"""
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from backend.models import UserRole
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY 频道；payload 为用户ID，"*" 表示清空
+AUTH_USER_CHANNEL = "auth_user_invalidate"
+
+
+@dataclass(frozen=True)
+class AuthUser:
+    """认证依赖返回的轻量用户信息。需要完整 User 记录 (例如修改资料) 的端点仍然使用 get_current_active_user。"""
+    id: int
+    username: str
+    role: UserRole
+    is_active: bool
+
+
+class AuthUserCache:
+    def __init__(self, ttl_seconds: float = 30.0, max_entries: int = 10000):
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        # user_id -> (过期时间, AuthUser)，按最近使用排序
+        self._entries: "OrderedDict[int, Tuple[float, AuthUser]]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._clears = 0
+
+    def configure(self, ttl_seconds: float, max_entries: int):
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._entries.clear()
+
+    @property
+    def enabled(self) -> bool:
+        return self._ttl_seconds > 0 and self._max_entries > 0
+
+    def get(self, user_id: int) -> Optional[AuthUser]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self._misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self._hits += 1
+        return entry[1]
+
+    def put(self, user: AuthUser):
+        if not self.enabled:
+            return
+        self._entries[user.id] = (time.monotonic() + self._ttl_seconds, user)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._invalidations += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._clears += 1
+        self._entries.clear()
+
+    def handle_notification(self, payload: str):
+        """处理其他进程 (或本进程) 通过 NOTIFY 广播的失效消息。"""
+        if payload == "*":
+            self.clear()
+            return
+        try:
+            self.invalidate(int(payload))
+        except ValueError:
+            logger.warning(f"无法解析的用户缓存失效消息: {payload!r}")
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses
+        return {
+            "ttl_seconds": self._ttl_seconds,
+            "max_entries": self._max_entries,
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self._invalidations,
+            "clears": self._clears,
+        }
+
+
+# 进程内唯一实例：auth_utils 的认证依赖读写它，crud 的写操作使其失效
+auth_user_cache = AuthUserCache()
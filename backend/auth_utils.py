@@ -1,7 +1,10 @@
 ﻿# backend/auth_utils.py
+import hashlib
+import hmac
 import logging
+import uuid
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -14,7 +17,10 @@ from sqlmodel.ext.asyncio.session import AsyncSession # 确保导入 AsyncSessio
 
 from backend.core.config import get_settings
 from backend.database import get_async_session # 修改为依赖 get_async_session
+from backend.auth_cache import AuthUser, auth_user_cache
 from backend.models import TokenData, User, UserRole
+from backend.password_hasher import PasswordHasher
+from backend.token_cache import token_cache_key, token_revocation_list, verified_token_cache
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
@@ -23,17 +29,50 @@ logger = logging.getLogger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token") # 调整为 /auth/token
 
 # --- 密码哈希上下文 ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# rounds 的上下限都设为当前配置：工作因子调整后，旧哈希在用户下次登录时自动按新配置重新计算
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.PASSWORD_BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.PASSWORD_BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.PASSWORD_BCRYPT_ROUNDS
+)
+# 异步端点使用的哈希执行器 (专用线程池)，由 main.py 在应用启动时启动
+password_hasher = PasswordHasher(pwd_context)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """同步版本，会阻塞调用线程；异步代码中请使用 verify_password_async。"""
     return pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
+    """同步版本，会阻塞调用线程；异步代码中请使用 get_password_hash_async。"""
     return pwd_context.hash(password)
 
 
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hasher.hash(password)
+
+
+async def verify_and_update_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """校验密码，并在哈希的工作因子与当前配置不一致时返回新哈希 (否则为 None)。"""
+    return await password_hasher.verify_and_update(plain_password, hashed_password)
+
+
+# --- 令牌摘要 ---
+def hash_token(raw_token: str) -> str:
+    """
+    计算验证/重置令牌存入数据库的摘要 (带密钥的 HMAC-SHA256，十六进制)。
+    令牌本身是高熵的随机签名串，不需要 bcrypt 这样的慢哈希；摘要是确定性的，可以直接按 token_hash 索引做等值查询。
+    """
+    return hmac.new(settings.token_digest_key, raw_token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
 # --- 邮件验证令牌相关 ---
 email_verification_serializer = URLSafeTimedSerializer(
     secret_key=settings.EMAIL_VERIFICATION_SECRET_KEY,
@@ -91,8 +130,10 @@ def _create_jwt_token(data: dict, secret_key: str, expires_delta: timedelta,
     # JWT 的 'exp' 字段通常是 Unix 时间戳，它是时区无关的。
     # datetime.now(timezone.utc) 是正确的，因为这确保 exp 是基于 UTC 的。
     # 此处不需要 .replace(tzinfo=None)
-    expire = datetime.now(timezone.utc) + expires_delta
-    to_encode.update({"exp": expire})
+    issued_at = datetime.now(timezone.utc)
+    expire = issued_at + expires_delta
+    # jti 用于登出时吊销单个令牌，iat 用于按用户纪元吊销 (见 backend/token_cache.py)
+    to_encode.update({"exp": expire, "iat": issued_at, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, secret_key, algorithm=algorithm)
     return encoded_jwt
 
@@ -107,7 +148,7 @@ def create_refresh_token(data: dict) -> str:
     return _create_jwt_token(data=data, secret_key=settings.JWT_REFRESH_SECRET_KEY, expires_delta=expires_delta)
 
 
-def _verify_jwt_and_get_token_data(token: str, secret_key: str, algorithm: str = settings.JWT_ALGORITHM) -> Optional[
+def _decode_jwt_token_data(token: str, secret_key: str, algorithm: str = settings.JWT_ALGORITHM) -> Optional[
     TokenData]:
     try:
         payload = jwt.decode(token, secret_key, algorithms=[algorithm])
@@ -116,7 +157,12 @@ def _verify_jwt_and_get_token_data(token: str, secret_key: str, algorithm: str =
             logger.debug("Token payload missing 'sub_id'")
             return None
 
-        token_data = TokenData(user_id=int(user_id_from_payload))
+        token_data = TokenData(
+            user_id=int(user_id_from_payload),
+            jti=payload.get("jti"),
+            issued_at=payload.get("iat"),
+            expires_at=payload.get("exp")
+        )
         return token_data
     except JWTError as e:
         logger.debug(f"JWT 错误: {e}")
@@ -126,12 +172,31 @@ def _verify_jwt_and_get_token_data(token: str, secret_key: str, algorithm: str =
         return None
 
 
+def _verify_jwt_and_get_token_data(token: str, kind: str, secret_key: str) -> Optional[TokenData]:
+    """
+    校验令牌并返回其中的数据。校验通过的结果按令牌摘要缓存到令牌过期为止，同一令牌再次出示时不再重新解码；
+    无论是否命中缓存，都检查内存中的吊销列表 (登出、禁用用户后立即生效)。
+    返回的 TokenData 可能被多个请求共享，调用方不应修改它。
+    """
+    cache_key = token_cache_key(kind, token)
+    token_data = verified_token_cache.get(cache_key)
+    if token_data is None:
+        token_data = _decode_jwt_token_data(token, secret_key)
+        if token_data is None:
+            return None
+        verified_token_cache.put(cache_key, token_data)
+    if token_revocation_list.is_revoked(token_data):
+        logger.debug(f"令牌已被吊销 (user_id={token_data.user_id}, jti={token_data.jti})")
+        return None
+    return token_data
+
+
 def verify_access_token_and_get_token_data(token: str) -> Optional[TokenData]:
-    return _verify_jwt_and_get_token_data(token, settings.JWT_SECRET_KEY)
+    return _verify_jwt_and_get_token_data(token, "access", settings.JWT_SECRET_KEY)
 
 
 def verify_refresh_token_and_get_token_data(token: str) -> Optional[TokenData]:
-    return _verify_jwt_and_get_token_data(token, settings.JWT_REFRESH_SECRET_KEY)
+    return _verify_jwt_and_get_token_data(token, "refresh", settings.JWT_REFRESH_SECRET_KEY)
 
 
 # --- 获取当前用户依赖项 ---
@@ -164,14 +229,40 @@ async def get_current_active_user(
 
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="与令牌关联的用户未找到")
+    # 已经读到了完整记录，顺便刷新认证缓存
+    auth_user_cache.put(AuthUser(id=user.id, username=user.username, role=user.role, is_active=user.is_active))
     if not user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户已被禁用")
     return user
 
 
+async def get_current_auth_user(
+        token_data: TokenData = Depends(get_current_user_from_token),
+        session: AsyncSession = Depends(get_async_session)
+) -> AuthUser:
+    """
+    依赖项：与 get_current_active_user 的检查相同，但只返回认证相关的字段 (AuthUser)。
+    优先读取进程内缓存，命中时不访问数据库；只需要用户ID、用户名或角色的端点应使用它。
+    """
+    auth_user = auth_user_cache.get(token_data.user_id)
+    if auth_user is None:
+        result = await session.execute(
+            select(User.id, User.username, User.role, User.is_active).where(User.id == token_data.user_id)
+        )
+        row = result.first()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="与令牌关联的用户未找到")
+        auth_user = AuthUser(id=row.id, username=row.username, role=row.role, is_active=row.is_active)
+        auth_user_cache.put(auth_user)
+
+    if not auth_user.is_active:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户已被禁用")
+    return auth_user
+
+
 async def get_current_admin_user(
-    current_user: User = Depends(get_current_active_user)
-) -> User:
+    current_user: AuthUser = Depends(get_current_auth_user)
+) -> AuthUser:
     """
     依赖项：获取当前用户，并验证其是否为管理员。
     如果不是管理员，则抛出403 Forbidden异常。
@@ -0,0 +1,450 @@
+﻿# backend/avatar_proxy.py
+"""
+Minecraft 头像代理。
+
+上游请求复用应用生命周期内的同一个 httpx 连接池 (不再每次请求都重新握手)，
+头像按用户名缓存在磁盘上：成功的结果缓存 AVATAR_CACHE_TTL_SECONDS，上游 404 缓存 AVATAR_NEGATIVE_CACHE_TTL_SECONDS。
+同一用户名的并发请求只向上游发起一次；上游连续出错时熔断器打开，直接返回本地生成的占位头像，不再等待超时。
+缓存过期后上游出错时继续返回过期的副本，上游故障不会让已经见过的头像消失。
+只有上游明确表示用户名不存在 (404/400/422) 时才写入负缓存；限流 (429)、403 等其他错误按上游不可用处理，计入熔断器。
+磁盘缓存的总大小不超过 AVATAR_CACHE_MAX_MB，超出时按写入时间从旧到新淘汰 (与图片缩放缓存使用同一个 sweep_cache)。
+
+成员网格、画廊卡片一次需要很多头像时，get_many 并发获取一组用户名，compose_avatar_sprite 把它们拼成一张雪碧图，
+前端一次往返即可拿到整个网格的头像 (见 main.py 的 /avatars/batch)。
+
+上游地址由 MC_AVATAR_URL_TEMPLATE 配置，测试时可以指向 benchmarks/fake_avatar_upstream.py 启动的本地假服务器。
+"""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import httpx
+from PIL import Image as PILImage
+from PIL import ImageDraw, ImageFont
+from starlette.concurrency import run_in_threadpool
+
+from backend.image_resizer import SWEEP_INTERVAL_SECONDS, sweep_cache
+
+logger = logging.getLogger(__name__)
+
+# 上游返回这些状态码表示用户名不存在或格式不合法，写入负缓存；其他 4xx (限流、拒绝访问等) 视为上游不可用
+MISSING_STATUS_CODES = {400, 404, 422}
+
+
+@dataclass
+class CachedAvatar:
+    """
+    磁盘缓存中的一条记录。missing 为 True 表示上游返回了 404 (负缓存)，此时没有 content。
+    fallback 为 True 表示这是本地生成的占位头像 (上游不可用)，不写入磁盘缓存。
+    """
+    fetched_at: float
+    missing: bool = False
+    content: bytes = b""
+    content_type: str = "image/png"
+    etag: str = ""
+    fallback: bool = False
+
+    def is_fresh(self, ttl_seconds: int) -> bool:
+        return time.time() - self.fetched_at < ttl_seconds
+
+
+class AvatarNotFound(Exception):
+    """上游确认该用户名没有头像 (或命中了负缓存)。"""
+
+
+class CircuitBreaker:
+    """
+    简单的熔断器：
+    - closed: 正常请求上游，连续失败达到 failure_threshold 次后打开；
+    - open: reset_seconds 内所有请求直接失败 (返回占位头像)，不访问上游；
+    - half_open: 冷却结束后只放行一个试探请求，成功则关闭，失败则重新打开。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._times_opened = 0
+        self._short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = True
+            return True
+        self._short_circuited += 1
+        return False
+
+    def record_success(self):
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self._times_opened += 1
+                logger.warning(f"头像上游连续失败 {self._consecutive_failures} 次，熔断器打开 {self.reset_seconds}s")
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_seconds": self.reset_seconds,
+            "times_opened": self._times_opened,
+            "short_circuited": self._short_circuited,
+        }
+
+
+class UpstreamUnavailable(Exception):
+    """熔断器打开，本次没有访问上游。"""
+
+
+# --- 占位头像 ---
+
+FALLBACK_AVATAR_SIZE = 128
+_FALLBACK_CACHE_SIZE = 256
+
+
+def render_fallback_avatar(username: str) -> bytes:
+    """按用户名生成固定颜色的占位头像 (PNG)，中间是用户名首字母。应在线程池中调用。"""
+    digest = hashlib.sha256(username.lower().encode("utf-8")).digest()
+    background = (64 + digest[0] % 128, 64 + digest[1] % 128, 64 + digest[2] % 128)
+    image = PILImage.new("RGB", (FALLBACK_AVATAR_SIZE, FALLBACK_AVATAR_SIZE), background)
+    initial = username[:1].upper()
+    if initial.isascii() and initial.isprintable():  # 默认字体只能绘制 ASCII 字符
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.load_default()
+        left, top, right, bottom = draw.textbbox((0, 0), initial, font=font)
+        position = ((FALLBACK_AVATAR_SIZE - (right - left)) / 2 - left, (FALLBACK_AVATAR_SIZE - (bottom - top)) / 2 - top)
+        draw.text(position, initial, fill=(255, 255, 255), font=font)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+# --- 批量头像雪碧图 ---
+
+_SPRITE_CACHE_SIZE = 32
+
+
+def compose_avatar_sprite(tiles: Sequence[Tuple[str, bytes]], tile_size: int) -> Tuple[bytes, int, Dict[str, dict], List[str]]:
+    """
+    把若干头像按网格拼成一张 PNG 雪碧图。应在线程池中调用。
+    返回 (PNG 数据, 列数, {名称: {"x", "y"}} 偏移表, 无法解码的名称列表)。
+    Minecraft 头像是像素画，缩放使用 NEAREST，避免边缘发糊。
+    """
+    decoded = []
+    broken = []
+    for name, content in tiles:
+        try:
+            with PILImage.open(io.BytesIO(content)) as source:
+                decoded.append((name, source.convert("RGBA").resize((tile_size, tile_size), PILImage.NEAREST)))
+        except (OSError, ValueError, PILImage.DecompressionBombError):
+            broken.append(name)
+
+    columns = max(1, math.ceil(math.sqrt(len(decoded))))
+    rows = max(1, math.ceil(len(decoded) / columns))
+    sheet = PILImage.new("RGBA", (columns * tile_size, rows * tile_size), (0, 0, 0, 0))
+    offsets = {}
+    for index, (name, tile) in enumerate(decoded):
+        x, y = (index % columns) * tile_size, (index // columns) * tile_size
+        sheet.paste(tile, (x, y))
+        offsets[name] = {"x": x, "y": y}
+    buffer = io.BytesIO()
+    sheet.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue(), columns, offsets, broken
+
+
+def _read_cache_entry(meta_path: Path, data_path: Path) -> Optional[CachedAvatar]:
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        content = b"" if meta.get("missing") else data_path.read_bytes()
+    except (OSError, ValueError):
+        return None
+    return CachedAvatar(
+        fetched_at=meta["fetched_at"],
+        missing=meta.get("missing", False),
+        content=content,
+        content_type=meta.get("content_type", "image/png"),
+        etag=meta.get("etag", ""),
+    )
+
+
+def _write_cache_entry(meta_path: Path, data_path: Path, entry: CachedAvatar):
+    """先写数据再写元数据，都通过临时文件 + 重命名完成，读取方不会看到写了一半的内容。"""
+    meta_path.parent.mkdir(parents=True, exist_ok=True)
+    if not entry.missing:
+        temp_data = data_path.with_name(f"{data_path.name}.{os.getpid()}.tmp")
+        temp_data.write_bytes(entry.content)
+        os.replace(temp_data, data_path)
+    meta = {"fetched_at": entry.fetched_at, "missing": entry.missing,
+            "content_type": entry.content_type, "etag": entry.etag}
+    temp_meta = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+    temp_meta.write_text(json.dumps(meta), encoding="utf-8")
+    os.replace(temp_meta, meta_path)
+
+
+class AvatarProxy:
+    """带磁盘缓存的头像代理，上游请求使用共享的 httpx 连接池。"""
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache_dir: Optional[Path] = None
+        self.breaker = CircuitBreaker()
+        # 正在向上游请求的用户名 (小写) -> Future，同一用户名的并发请求共享一次上游请求
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._fallbacks: "OrderedDict[str, bytes]" = OrderedDict()
+        # 雪碧图 ETag -> (PNG, 列数, 偏移表, 无法解码的名称)，同一组头像的雪碧图只拼一次
+        self._sprites: "OrderedDict[str, tuple]" = OrderedDict()
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._stale_served = 0
+        self._fallback_served = 0
+        self._upstream_errors = 0
+        self._cache_write_errors = 0
+        self._refresh_errors = 0
+        self._batch_requests = 0
+        self._sprites_composed = 0
+        # 磁盘缓存容量 (0 表示不限制)；_cache_bytes 是上次扫描的结果，之后本进程写入的字节数另外累计
+        self._max_cache_bytes = 0
+        self._cache_bytes = 0
+        self._cached_files = 0
+        self._written_since_sweep = 0
+        self._last_sweep = 0.0
+        self._sweeping = False
+        self._sweeps = 0
+        self._evictions = 0
+
+    def start(self, client: httpx.AsyncClient, cache_dir: Path, breaker_failure_threshold: int = 5,
+              breaker_reset_seconds: float = 30.0, max_cache_bytes: int = 0):
+        self._client = client
+        self._cache_dir = cache_dir
+        self.breaker = CircuitBreaker(breaker_failure_threshold, breaker_reset_seconds)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._max_cache_bytes = max_cache_bytes
+        if max_cache_bytes:
+            self._apply_sweep(sweep_cache(cache_dir, max_cache_bytes))
+
+    def _paths(self, username: str):
+        # Minecraft 用户名不区分大小写；文件名使用哈希，避免用户名中的特殊字符
+        key = hashlib.sha256(username.lower().encode("utf-8")).hexdigest()
+        directory = self._cache_dir / key[:2]
+        return directory / f"{key}.json", directory / f"{key}.img"
+
+    async def get(self, username: str, url_template: str, ttl_seconds: int, negative_ttl_seconds: int) -> CachedAvatar:
+        """
+        返回头像 (缓存、上游或占位头像)。上游确认不存在时抛出 AvatarNotFound。
+        上游不可用 (出错或熔断) 时优先返回过期的缓存副本，没有副本时返回 fallback=True 的占位头像。
+        """
+        meta_path, data_path = self._paths(username)
+        cached = await run_in_threadpool(_read_cache_entry, meta_path, data_path)
+        if cached is not None:
+            if cached.missing and cached.is_fresh(negative_ttl_seconds):
+                self._negative_hits += 1
+                raise AvatarNotFound()
+            if not cached.missing and cached.is_fresh(ttl_seconds):
+                self._hits += 1
+                return cached
+
+        key = username.lower()
+        future = self._inflight.get(key)
+        if future is not None:
+            self._coalesced += 1
+        else:
+            self._misses += 1
+            future = asyncio.ensure_future(self._refresh(username, url_template, meta_path, data_path))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        try:
+            # shield: 发起请求的客户端断开时，共享同一请求的其他客户端不受影响
+            entry = await asyncio.shield(future)
+        except Exception as e:
+            # 上游出错或熔断是预期内的；其他异常 (程序错误、磁盘问题等) 记录下来，但同样不让头像接口返回 500
+            if not isinstance(e, (httpx.HTTPError, UpstreamUnavailable)):
+                self._refresh_errors += 1
+                logger.error(f"刷新头像 {username} 时出现意外错误: {e!r}")
+            if cached is not None and not cached.missing:
+                self._stale_served += 1
+                logger.warning(f"获取头像 {username} 失败，返回过期的缓存副本: {e!r}")
+                return cached
+            return await self._fallback(username)
+
+        if entry.missing:
+            raise AvatarNotFound()
+        return entry
+
+    async def get_many(self, usernames: Sequence[str], url_template: str, ttl_seconds: int,
+                       negative_ttl_seconds: int) -> Dict[str, Optional[CachedAvatar]]:
+        """
+        并发获取一组头像，返回 {用户名: CachedAvatar}，不存在的用户名对应 None。
+        各用户名仍然走 get 的缓存、请求合并和熔断逻辑，单个用户名的失败不影响其他用户名。
+        """
+        self._batch_requests += 1
+        results = await asyncio.gather(
+            *(self.get(username, url_template, ttl_seconds, negative_ttl_seconds) for username in usernames),
+            return_exceptions=True
+        )
+        avatars = {}
+        for username, result in zip(usernames, results):
+            if isinstance(result, AvatarNotFound):
+                avatars[username] = None
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                avatars[username] = result
+        return avatars
+
+    async def get_sprite(self, sprite_key: str, tiles: Sequence[Tuple[str, bytes]], tile_size: int):
+        """返回 compose_avatar_sprite 的结果；sprite_key 相同 (同一组头像、同一尺寸) 时复用内存中的结果。"""
+        sprite = self._sprites.get(sprite_key)
+        if sprite is not None:
+            self._sprites.move_to_end(sprite_key)
+            return sprite
+        sprite = await run_in_threadpool(compose_avatar_sprite, tiles, tile_size)
+        self._sprites_composed += 1
+        self._sprites[sprite_key] = sprite
+        while len(self._sprites) > _SPRITE_CACHE_SIZE:
+            self._sprites.popitem(last=False)
+        return sprite
+
+    async def _refresh(self, username: str, url_template: str, meta_path: Path, data_path: Path) -> CachedAvatar:
+        """向上游请求一次并写入磁盘缓存 (经过熔断器)。"""
+        if not self.breaker.allow_request():
+            raise UpstreamUnavailable("熔断器已打开")
+        try:
+            entry = await self._fetch_upstream(url_template.format(username=username))
+        except BaseException as e:
+            # 包括取消在内的任何失败都要通知熔断器，否则半开状态的试探请求会一直占着名额
+            if isinstance(e, httpx.HTTPError):
+                self._upstream_errors += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        try:
+            await run_in_threadpool(_write_cache_entry, meta_path, data_path, entry)
+        except OSError as e:
+            # 磁盘已满、权限错误等：本次仍返回从上游拿到的头像，只是没有缓存下来
+            self._cache_write_errors += 1
+            logger.error(f"写入头像缓存失败 ({username}): {e}")
+            return entry
+        self._written_since_sweep += len(entry.content)
+        self._maybe_sweep()
+        return entry
+
+    def _maybe_sweep(self):
+        """估算的缓存大小超出上限，或距上次扫描已超过 SWEEP_INTERVAL_SECONDS 时，在线程池中扫描淘汰。"""
+        if not self._max_cache_bytes or self._sweeping:
+            return
+        over_capacity = self._cache_bytes + self._written_since_sweep > self._max_cache_bytes
+        if not over_capacity and time.monotonic() - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return
+        self._sweeping = True
+        self._written_since_sweep = 0
+        sweep_future = asyncio.get_running_loop().run_in_executor(
+            None, sweep_cache, self._cache_dir, self._max_cache_bytes)
+
+        def _on_swept(fut: asyncio.Future):
+            self._sweeping = False
+            if fut.cancelled() or fut.exception() is not None:
+                logger.error(f"扫描头像缓存失败: {fut.exception() if not fut.cancelled() else '已取消'}")
+                return
+            self._apply_sweep(fut.result())
+
+        sweep_future.add_done_callback(_on_swept)
+
+    def _apply_sweep(self, result: Tuple[int, int, int]):
+        self._cache_bytes, self._cached_files, removed = result
+        self._evictions += removed
+        self._sweeps += 1
+        self._last_sweep = time.monotonic()
+
+    async def _fallback(self, username: str) -> CachedAvatar:
+        self._fallback_served += 1
+        key = username.lower()
+        content = self._fallbacks.get(key)
+        if content is None:
+            content = await run_in_threadpool(render_fallback_avatar, username)
+            self._fallbacks[key] = content
+            while len(self._fallbacks) > _FALLBACK_CACHE_SIZE:
+                self._fallbacks.popitem(last=False)
+        else:
+            self._fallbacks.move_to_end(key)
+        return CachedAvatar(
+            fetched_at=time.time(),
+            content=content,
+            content_type="image/png",
+            etag='W/"fallback-' + hashlib.sha256(content).hexdigest()[:24] + '"',
+            fallback=True,
+        )
+
+    async def _fetch_upstream(self, url: str) -> CachedAvatar:
+        if self._client is None:
+            raise httpx.HTTPError("头像代理未启动")
+        response = await self._client.get(url)
+        if response.status_code in MISSING_STATUS_CODES:
+            return CachedAvatar(fetched_at=time.time(), missing=True)
+        # 其他 4xx/5xx 抛出 httpx.HTTPStatusError：计入熔断器，调用方返回过期副本或占位头像
+        response.raise_for_status()
+        content = response.content
+        return CachedAvatar(
+            fetched_at=time.time(),
+            content=content,
+            content_type=response.headers.get("content-type", "image/png"),
+            etag='"' + hashlib.sha256(content).hexdigest()[:32] + '"',
+        )
+
+    def stats(self) -> dict:
+        return {
+            "hits": self._hits,
+            "negative_hits": self._negative_hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "inflight": len(self._inflight),
+            "stale_served": self._stale_served,
+            "fallback_served": self._fallback_served,
+            "upstream_errors": self._upstream_errors,
+            "cache_write_errors": self._cache_write_errors,
+            "refresh_errors": self._refresh_errors,
+            "batch_requests": self._batch_requests,
+            "sprites_composed": self._sprites_composed,
+            "sprites_cached": len(self._sprites),
+            "cached_files": self._cached_files,
+            "cache_bytes": self._cache_bytes + self._written_since_sweep,
+            "max_cache_bytes": self._max_cache_bytes,
+            "evictions": self._evictions,
+            "sweeps": self._sweeps,
+            "breaker": self.breaker.stats(),
+        }
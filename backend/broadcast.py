@@ -0,0 +1,279 @@
+﻿# backend/broadcast.py
+"""
+全站群发邮件的执行者。
+
+- 收件人：按 user.id 递增的顺序键集分页读取 (crud.get_broadcast_recipients)，每页一个短查询，发送期间不持有游标或事务；
+- 发送：每封邮件用预编译模板渲染后交给 mail_transport (已有的 SMTP 连接池)，
+  BROADCAST_CONCURRENCY 限制同时在途的邮件数，BROADCAST_RATE_PER_SECOND 限制发送速率；
+- 进度和续传：每批发送完毕后把该批最大的 user.id、成功和失败数写入检查点 (crud.checkpoint_broadcast)，
+  进程崩溃后从检查点继续，最多重复发送一批；
+- 互斥：crud.claim_broadcast 原子地领取群发，执行期间定期刷新心跳，其他进程只能接手心跳过期的群发。
+
+开启持久化任务队列时，一个 email.broadcast 任务只发送一批 (run_broadcast_job)：写检查点的同一个事务中释放群发并写入
+下一批的任务，任务的执行时间有上限，不会被当作超时任务重新领取，也不会长时间占用 worker 的一个批次。
+任务中带有它要继续的检查点 (after_user_id)，与群发当前的检查点不一致的任务是重复的，直接结束。
+未开启任务队列时由 API 进程中的 broadcast_runner 连续发送 (run_broadcast)，并在启动时继续上次中断的群发。
+"""
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set, Tuple
+
+from backend import crud, models
+from backend.core.config import Settings, get_settings
+from backend.database import AsyncSessionLocal
+from backend.email_templates import email_templates
+from backend.email_utils import build_email_message
+from backend.mail_transport import is_transient_error, mail_transport
+
+logger = logging.getLogger(__name__)
+
+# 持久化任务队列中的任务类型 (worker.py 从这里导入)
+JOB_EMAIL_BROADCAST = "email.broadcast"
+
+
+class BroadcastBusy(Exception):
+    """群发正由其他进程执行 (心跳未过期)。任务应稍后重试，而不是当作已完成。"""
+
+
+class RateLimiter:
+    """按固定间隔放行的限速器；rate_per_second <= 0 时不限速。"""
+
+    def __init__(self, rate_per_second: float):
+        self._interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._next_at = time.monotonic()
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        if self._next_at > now:
+            await asyncio.sleep(self._next_at - now)
+            now = self._next_at
+        # 空闲一段时间后不允许积攒额度突发发送
+        self._next_at = max(self._next_at, now) + self._interval
+
+
+async def _send_one(broadcast: models.Broadcast, user_id: int, username: str, email: str) -> Optional[dict]:
+    """发送一封群发邮件，成功返回 None，失败返回失败记录。"""
+    try:
+        subject, html_body, text_body = email_templates.render(
+            "broadcast", subject=broadcast.subject, username=username, message=broadcast.body)
+        await mail_transport.send(build_email_message(subject, [email], html_body, text_body))
+        return None
+    except Exception as e:
+        return {"user_id": user_id, "email": email, "error": repr(e)[:300], "transient": is_transient_error(e)}
+
+
+async def _send_batch(broadcast: models.Broadcast, recipients: list, limiter: RateLimiter,
+                      semaphore: asyncio.Semaphore) -> Tuple[int, List[dict]]:
+    """发送一批邮件，返回 (成功数, 失败记录)。整批都因临时错误失败时抛出异常，不推进检查点。"""
+    async def _send_limited(user_id: int, username: str, email: str) -> Optional[dict]:
+        try:
+            return await _send_one(broadcast, user_id, username, email)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    for user_id, username, email in recipients:
+        await limiter.wait()
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(_send_limited(user_id, username, email)))
+    results = await asyncio.gather(*tasks)
+    failures = [result for result in results if result is not None]
+    if failures and len(failures) == len(results) and all(failure["transient"] for failure in failures):
+        # 整批都是连接错误或 4xx (例如 SMTP 服务器不可用)：稍后从本批重新开始
+        raise RuntimeError(f"整批 {len(results)} 封邮件都因临时错误发送失败: {failures[-1]['error']}")
+    return len(results) - len(failures), failures
+
+
+async def _heartbeat(broadcast_id: int, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as session:
+                await crud.touch_broadcast(db=session, broadcast_id=broadcast_id)
+        except Exception as e:
+            logger.error(f"刷新群发 {broadcast_id} 的心跳失败: {e}")
+
+
+def _start_heartbeat(broadcast_id: int, settings: Settings) -> asyncio.Task:
+    return asyncio.create_task(_heartbeat(broadcast_id, max(settings.BROADCAST_STALE_SECONDS / 3, 1)))
+
+
+async def _claim(broadcast_id: int, settings: Settings) -> Optional[models.Broadcast]:
+    async with AsyncSessionLocal() as session:
+        return await crud.claim_broadcast(db=session, broadcast_id=broadcast_id,
+                                          stale_seconds=settings.BROADCAST_STALE_SECONDS)
+
+
+async def _fetch_recipients(broadcast: models.Broadcast, after_user_id: int, limit: int) -> list:
+    async with AsyncSessionLocal() as session:
+        return await crud.get_broadcast_recipients(
+            db=session, only_verified=broadcast.only_verified, after_user_id=after_user_id, limit=limit)
+
+
+async def _release(broadcast_id: int, error: Optional[BaseException] = None):
+    """中断时释放群发 (恢复为 PENDING，保留检查点)。包括进程关闭时的 CancelledError。"""
+    message = None
+    if error is not None:
+        message = "执行被中断" if isinstance(error, asyncio.CancelledError) else repr(error)
+        logger.error(f"群发 {broadcast_id} 中断，将从检查点继续: {message}")
+    try:
+        async with AsyncSessionLocal() as session:
+            await crud.finish_broadcast(db=session, broadcast_id=broadcast_id,
+                                        status=models.BroadcastStatus.PENDING, error=message)
+    except Exception as release_error:
+        logger.error(f"释放群发 {broadcast_id} 失败 (心跳过期后可被重新领取): {release_error}")
+
+
+def job_batch_size(settings: Settings) -> int:
+    """
+    一个任务发送的邮件数：不超过 BROADCAST_BATCH_SIZE，并且按限速能在 JOB_LOCK_TIMEOUT_SECONDS 的一半内发完，
+    避免任务还在执行时被其他 worker 当作超时任务重新领取。
+    """
+    size = settings.BROADCAST_BATCH_SIZE
+    if settings.BROADCAST_RATE_PER_SECOND > 0:
+        size = min(size, int(settings.BROADCAST_RATE_PER_SECOND * settings.JOB_LOCK_TIMEOUT_SECONDS / 2))
+    return max(size, 1)
+
+
+async def run_broadcast(broadcast_id: int) -> Optional[models.BroadcastStatus]:
+    """
+    在当前进程中连续发送 (或从检查点继续) 整个群发，返回结束时的状态；群发不可领取 (已完成、已取消或正由其他进程执行) 时返回 None。
+    中途出错时群发恢复为 PENDING 并抛出异常，已发送的部分不会重复发送。
+    """
+    settings = get_settings()
+    broadcast = await _claim(broadcast_id, settings)
+    if broadcast is None:
+        logger.info(f"群发 {broadcast_id} 无需执行 (已结束或正由其他进程执行)。")
+        return None
+
+    logger.info(f"开始群发 {broadcast_id}: 从 user.id > {broadcast.last_user_id} 继续，"
+                f"已发送 {broadcast.sent_count}/{broadcast.total_recipients}")
+    limiter = RateLimiter(settings.BROADCAST_RATE_PER_SECOND)
+    semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+    heartbeat_task = _start_heartbeat(broadcast_id, settings)
+    after_user_id = broadcast.last_user_id
+    try:
+        while True:
+            recipients = await _fetch_recipients(broadcast, after_user_id, settings.BROADCAST_BATCH_SIZE)
+            sent, failures = await _send_batch(broadcast, recipients, limiter, semaphore) if recipients else (0, [])
+            done = len(recipients) < settings.BROADCAST_BATCH_SIZE
+            async with AsyncSessionLocal() as session:
+                current_status = await crud.checkpoint_broadcast(
+                    db=session, broadcast_id=broadcast_id,
+                    last_user_id=recipients[-1][0] if recipients else None,
+                    sent=sent, failures=failures, max_recorded_failures=settings.BROADCAST_MAX_RECORDED_FAILURES,
+                    next_status=models.BroadcastStatus.COMPLETED if done else models.BroadcastStatus.RUNNING)
+            if current_status == models.BroadcastStatus.CANCELLED:
+                logger.info(f"群发 {broadcast_id} 已被取消，停止发送。")
+                return current_status
+            if done:
+                logger.info(f"群发 {broadcast_id} 已完成。")
+                return current_status
+            after_user_id = recipients[-1][0]
+    except BaseException as e:
+        await _release(broadcast_id, e)
+        raise
+    finally:
+        heartbeat_task.cancel()
+
+
+async def run_broadcast_job(broadcast_id: int, after_user_id: Optional[int]) -> Optional[models.BroadcastStatus]:
+    """
+    任务队列中的一个群发任务：从检查点 after_user_id 起发送一批，写检查点时释放群发并写入下一批的任务。
+    返回本批结束后群发的状态；群发已结束、已取消或任务重复时返回 None (任务完成)。
+    群发正由其他进程执行时抛出 BroadcastBusy，任务按退避重试。旧版本写入的任务没有 after_user_id，从群发当前的检查点继续。
+    """
+    settings = get_settings()
+    broadcast = await _claim(broadcast_id, settings)
+    if broadcast is None:
+        async with AsyncSessionLocal() as session:
+            current = await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+        if current is not None and current.status == models.BroadcastStatus.RUNNING:
+            raise BroadcastBusy(f"群发 {broadcast_id} 正由其他进程执行")
+        return None
+    if after_user_id is not None and after_user_id != broadcast.last_user_id:
+        # 检查点已经越过了这个任务 (例如管理员在执行期间点了继续)，后续批次由与检查点一起写入的任务负责
+        logger.info(f"群发 {broadcast_id} 的任务 (after_user_id={after_user_id}) 已过时，跳过。")
+        await _release(broadcast_id)
+        return None
+
+    batch_size = job_batch_size(settings)
+    heartbeat_task = _start_heartbeat(broadcast_id, settings)
+    try:
+        recipients = await _fetch_recipients(broadcast, broadcast.last_user_id, batch_size)
+        sent, failures = await _send_batch(
+            broadcast, recipients, RateLimiter(settings.BROADCAST_RATE_PER_SECOND),
+            asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)) if recipients else (0, [])
+        done = len(recipients) < batch_size
+        next_job = None if done else crud.new_job(
+            kind=JOB_EMAIL_BROADCAST,
+            payload={"broadcast_id": broadcast_id, "after_user_id": recipients[-1][0]},
+            max_attempts=settings.JOB_MAX_ATTEMPTS)
+        async with AsyncSessionLocal() as session:
+            current_status = await crud.checkpoint_broadcast(
+                db=session, broadcast_id=broadcast_id,
+                last_user_id=recipients[-1][0] if recipients else None,
+                sent=sent, failures=failures, max_recorded_failures=settings.BROADCAST_MAX_RECORDED_FAILURES,
+                next_status=models.BroadcastStatus.COMPLETED if done else models.BroadcastStatus.PENDING,
+                next_job=next_job)
+    except BaseException as e:
+        await _release(broadcast_id, e)
+        raise
+    finally:
+        heartbeat_task.cancel()
+    if current_status == models.BroadcastStatus.COMPLETED:
+        logger.info(f"群发 {broadcast_id} 已完成。")
+    return current_status
+
+
+class BroadcastRunner:
+    """未开启持久化任务队列时，在 API 进程内执行群发的后台任务集合。"""
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+        self._completed = 0
+        self._interrupted = 0
+
+    def start(self, broadcast_id: int):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, broadcast_id: int):
+        try:
+            if await run_broadcast(broadcast_id) is not None:
+                self._completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._interrupted += 1
+
+    async def resume_interrupted(self):
+        """启动时继续上次进程退出或崩溃时中断的群发。"""
+        settings = get_settings()
+        async with AsyncSessionLocal() as session:
+            broadcast_ids = await crud.get_interrupted_broadcast_ids(
+                db=session, stale_seconds=settings.BROADCAST_STALE_SECONDS)
+        for broadcast_id in broadcast_ids:
+            logger.info(f"继续中断的群发 {broadcast_id}。")
+            self.start(broadcast_id)
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._tasks),
+            "finished": self._completed,
+            "interrupted": self._interrupted,
+        }
+
+
+# 进程内唯一实例 (只在 API 进程中使用)
+broadcast_runner = BroadcastRunner()
@@ -35,7 +35,9 @@ EMAIL_VERIFICATION_SECRET_KEY="{email_verification_secret}"
 EMAIL_VERIFICATION_SALT="{email_verification_salt}"
 PASSWORD_RESET_SECRET_KEY="{password_reset_secret}"
 PASSWORD_RESET_SALT="{password_reset_salt}"
+TOKEN_DIGEST_SECRET_KEY="{token_digest_secret}"
 SESSION_SECRET_KEY="{session_secret}"
+PASSWORD_BCRYPT_ROUNDS=12
 
 # --- 邮件服务器配置 (示例) ---
 MAIL_USERNAME="noreply@example.com"
@@ -46,6 +48,9 @@ MAIL_PORT=465
 MAIL_FROM_NAME="安迪和莉莉的网站"
 MAIL_STARTTLS=False
 MAIL_SSL_TLS=True
+MAIL_USE_CREDENTIALS=True
+MAIL_POOL_SIZE=2
+BROADCAST_RATE_PER_SECOND=10
 
 # --- 应用行为 ---
 PORTAL_FRONTEND_BASE_URL="http://localhost:5173"
@@ -55,6 +60,35 @@ UPLOAD_MAX_SIZE_MB=50
 GALLERY_DEFAULT_PAGE_SIZE=12
 GALLERY_MAX_PAGE_SIZE=100
 MC_AVATAR_URL_TEMPLATE="https://cravatar.eu/avatar/{{username}}/128.png"
+AVATAR_CACHE_TTL_SECONDS=86400
+AVATAR_NEGATIVE_CACHE_TTL_SECONDS=3600
+AVATAR_CACHE_MAX_MB=256
+AVATAR_BATCH_MAX_NAMES=100
+LISTING_COUNT_MODE="counter"
+
+# --- 响应缓存 (多 worker 部署建议使用 redis) ---
+RESPONSE_CACHE_BACKEND="memory"
+RESPONSE_CACHE_TTL_SECONDS=300
+REDIS_URL="redis://localhost:6379/0"
+
+# --- 缩略图引擎 ---
+THUMBNAIL_WORKERS=2
+THUMBNAIL_QUEUE_SIZE=32
+THUMBNAIL_RETRY_AFTER_SECONDS=10
+THUMBNAIL_VARIANT_WIDTHS="160,320,640,1280"
+THUMBNAIL_VARIANT_FORMATS="webp,jpeg"
+
+# --- 按需缩放图片 (/img/...) ---
+IMAGE_RESIZE_WORKERS=2
+IMAGE_RESIZE_CACHE_MAX_MB=512
+IMAGE_RESIZE_MAX_DIMENSION=2048
+
+# --- /uploads 文件服务 (使用 nginx 时可设置为 internal location 的前缀，例如 "/_uploads/") ---
+MEDIA_ACCEL_REDIRECT_PREFIX=""
+
+# --- 持久化任务队列 (开启后需要运行 python -m backend.worker) ---
+JOB_QUEUE_ENABLED=false
+JOB_WORKER_PROCESSES=2
 """
 
 def generate_default_env_if_missing():
@@ -72,6 +106,7 @@ def generate_default_env_if_missing():
             "email_verification_salt": secrets.token_hex(16),
             "password_reset_secret": secrets.token_hex(32),
             "password_reset_salt": secrets.token_hex(16),
+            "token_digest_secret": secrets.token_hex(32),
             "session_secret": secrets.token_hex(32),
         }
 
@@ -118,6 +153,25 @@ class Settings(BaseSettings):
     MAIL_STARTTLS: bool = True
     MAIL_SSL_TLS: bool = False
     MAIL_FROM_NAME: str = "安迪和莉莉的网站"
+    # 本地测试用的 SMTP 服务器 (例如 benchmarks/smtp_sink.py) 不需要登录时设为 False
+    MAIL_USE_CREDENTIALS: bool = True
+    MAIL_TIMEOUT_SECONDS: float = 15.0
+    # 异步发送通道：SMTP 连接数、发件箱容量、每批取出的邮件数、单条连接最多发送的邮件数、空闲断开时间
+    MAIL_POOL_SIZE: int = 2
+    MAIL_OUTBOX_SIZE: int = 1000
+    MAIL_BATCH_SIZE: int = 20
+    MAIL_MAX_MESSAGES_PER_CONNECTION: int = 100
+    MAIL_IDLE_TIMEOUT_SECONDS: float = 60.0
+    # 临时错误 (连接断开、超时、4xx) 的重试次数和首次重试的等待时间 (之后指数增长)
+    MAIL_MAX_RETRIES: int = 3
+    MAIL_RETRY_BACKOFF_SECONDS: float = 2.0
+    # 全站群发：每秒最多发送的邮件数 (0 表示不限速)、同时在途的邮件数、每批流式读取的收件人数 (也是检查点间隔)
+    BROADCAST_RATE_PER_SECOND: float = 10.0
+    BROADCAST_CONCURRENCY: int = 8
+    BROADCAST_BATCH_SIZE: int = 200
+    # 执行者超过这么久没有心跳即视为已崩溃，其他进程可以接手；最多记录的失败收件人数
+    BROADCAST_STALE_SECONDS: int = 120
+    BROADCAST_MAX_RECORDED_FAILURES: int = 100
 
     # 邮件验证令牌相关
     EMAIL_VERIFICATION_SECRET_KEY: str
@@ -131,6 +185,10 @@ class Settings(BaseSettings):
     PASSWORD_RESET_SECRET_KEY: str
     PASSWORD_RESET_SALT: str
     PASSWORD_RESET_TOKEN_MAX_AGE_SECONDS: int = 900
+    # 数据库中保存的验证/重置令牌摘要 (HMAC-SHA256) 的密钥；未设置时使用 JWT_SECRET_KEY (兼容旧的 .env)
+    TOKEN_DIGEST_SECRET_KEY: Optional[str] = None
+    # 定期清理过期的验证/重置令牌的间隔
+    TOKEN_PURGE_INTERVAL_SECONDS: int = 3600
 
     # JWT 密钥
     JWT_SECRET_KEY: str
@@ -139,6 +197,18 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
 
+    # 密码哈希: bcrypt 工作因子 (修改后旧哈希在用户登录时自动升级)、专用线程数和排队上限
+    PASSWORD_BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_QUEUE_SIZE: int = 64
+    PASSWORD_HASH_RETRY_AFTER_SECONDS: int = 2
+
+    # 认证用户缓存 (用户ID -> 启用状态/角色)：TTL 为 0 时关闭；修改用户后通过 Postgres NOTIFY 通知所有 worker
+    AUTH_USER_CACHE_TTL_SECONDS: int = 30
+    AUTH_USER_CACHE_MAX_ENTRIES: int = 10000
+    # 已校验 JWT 的缓存容量 (按令牌摘要缓存到令牌过期)；0 表示关闭
+    JWT_VERIFY_CACHE_MAX_ENTRIES: int = 10000
+
     # --- PostgreSQL 配置 ---
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
@@ -156,12 +226,86 @@ class Settings(BaseSettings):
     GALLERY_DEFAULT_PAGE_SIZE: int = 12
     GALLERY_MAX_PAGE_SIZE: int = 100
     MC_AVATAR_URL_TEMPLATE: str = "https://cravatar.eu/avatar/{username}/128.png"
+    # 头像代理：磁盘缓存有效期、上游 404 的负缓存有效期、上游请求超时和连接池大小
+    AVATAR_CACHE_TTL_SECONDS: int = 86400
+    AVATAR_NEGATIVE_CACHE_TTL_SECONDS: int = 3600
+    AVATAR_CACHE_MAX_MB: int = 256  # 磁盘缓存上限，超出时淘汰最早写入的条目 (0 表示不限制)
+    AVATAR_UPSTREAM_TIMEOUT_SECONDS: float = 10.0
+    AVATAR_UPSTREAM_MAX_CONNECTIONS: int = 20
+    # 头像上游熔断：连续失败多少次后打开、打开后多久放行试探请求；熔断期间返回的占位头像的浏览器缓存时间
+    AVATAR_BREAKER_FAILURE_THRESHOLD: int = 5
+    AVATAR_BREAKER_RESET_SECONDS: int = 30
+    AVATAR_FALLBACK_MAX_AGE_SECONDS: int = 60
+    # 批量头像接口 (/avatars/batch) 单次最多请求的用户名数量
+    AVATAR_BATCH_MAX_NAMES: int = 100
+    # 列表总数的计算方式: counter (维护的计数表), estimate (Postgres 统计信息估算), exact (每次 COUNT(*))
+    LISTING_COUNT_MODE: str = "counter"
+
+    # 公开只读接口的响应缓存: memory (进程内 LRU), redis (多 worker 共享，需要安装 redis 包), none (关闭)
+    RESPONSE_CACHE_BACKEND: str = "memory"
+    RESPONSE_CACHE_TTL_SECONDS: int = 300
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1024
+    REDIS_URL: str = "redis://localhost:6379/0"
+    # 公开列表接口的 Cache-Control max-age；默认 0，即浏览器每次都带 If-None-Match 重新验证 (未变化时返回 304)
+    HTTP_CACHE_MAX_AGE_SECONDS: int = 0
+
+    # 缩略图引擎 (独立进程池)
+    THUMBNAIL_WORKERS: int = 2
+    THUMBNAIL_QUEUE_SIZE: int = 32
+    THUMBNAIL_RETRY_AFTER_SECONDS: int = 10
+    # 多分辨率缩略图变体 (srcset)，可用格式: webp, jpeg, avif (avif 需要 Pillow 支持)
+    THUMBNAIL_VARIANT_WIDTHS: str = "160,320,640,1280"
+    THUMBNAIL_VARIANT_FORMATS: str = "webp,jpeg"
+    THUMBNAIL_VARIANT_QUALITY: int = 80
+
+    # 按需缩放图片 (/img/...)：独立进程池 + 有容量上限的磁盘 LRU 缓存
+    IMAGE_RESIZE_WORKERS: int = 2
+    IMAGE_RESIZE_QUEUE_SIZE: int = 64
+    IMAGE_RESIZE_CACHE_MAX_MB: int = 512
+    IMAGE_RESIZE_MAX_DIMENSION: int = 2048
+    IMAGE_RESIZE_DEFAULT_QUALITY: int = 80
+    IMAGE_RESIZE_CACHE_MAX_AGE_SECONDS: int = 86400
+    IMAGE_RESIZE_RETRY_AFTER_SECONDS: int = 5
+    # 请求的宽高向上归整到这些档位，质量归整到最接近的档位 (限制每张原图可能生成的不同结果数量)
+    IMAGE_RESIZE_SIZE_STEPS: str = "64,128,160,240,320,480,640,800,960,1280,1600,2048"
+    IMAGE_RESIZE_QUALITY_STEPS: str = "50,65,80,90"
+
+    # 持久化任务队列 (开启后缩略图和邮件任务写入 job 表，由 python -m backend.worker 执行)
+    JOB_QUEUE_ENABLED: bool = False
+    JOB_WORKER_PROCESSES: int = 2
+    JOB_BATCH_SIZE: int = 10
+    JOB_POLL_INTERVAL_SECONDS: float = 2.0
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_SECONDS: int = 10
+    JOB_RETRY_MAX_SECONDS: int = 3600
+    JOB_LOCK_TIMEOUT_SECONDS: int = 600
+
+    # 可续传上传
+    RESUMABLE_UPLOAD_MAX_SIZE_MB: int = 500
+    RESUMABLE_UPLOAD_EXPIRE_HOURS: int = 24
+    RESUMABLE_UPLOAD_GC_INTERVAL_SECONDS: int = 3600
+    RESUMABLE_UPLOAD_LEASE_SECONDS: int = 900  # 单个 PATCH 分块的最长写入时间，超时后租约可被其他请求接管
+
+    # 存储回收：定期把 UPLOAD_DIR 中不再被数据库引用的文件移入隔离区，隔离区保留一段时间后删除
+    STORAGE_GC_INTERVAL_SECONDS: int = 86400  # 0 表示不定期执行 (仍可手动运行 python -m backend.storage_gc)
+    STORAGE_GC_MIN_AGE_HOURS: int = 24  # 比这更新的文件不处理 (可能是正在进行的上传)
+    STORAGE_GC_QUARANTINE_DAYS: int = 7
+    STORAGE_GC_BATCH_SIZE: int = 500
+
+    # /uploads 文件服务：内容寻址和 UUID 命名的文件按 immutable 长期缓存
+    MEDIA_IMMUTABLE_MAX_AGE_SECONDS: int = 31536000
+    MEDIA_MAX_RANGES: int = 16  # 合并后超过这么多个字节范围时忽略 Range，返回整个文件
+    MEDIA_ACCEL_REDIRECT_PREFIX: str = ""  # 非空时由 nginx 发送文件 (X-Accel-Redirect)，例如 "/_uploads/"
 
 
     # 使用 @property 来动态构建数据库 URL
     _ASYNC_DATABASE_URL: Optional[str] = None
     _SYNC_DATABASE_URL: Optional[str] = None
 
+    @property
+    def token_digest_key(self) -> bytes:
+        return (self.TOKEN_DIGEST_SECRET_KEY or self.JWT_SECRET_KEY).encode("utf-8")
+
     @property
     def cors_origins_list(self) -> List[str]:
         return [origin.strip() for origin in self.CORS_ALLOWED_ORIGINS.split(',')]
@@ -170,6 +314,22 @@ class Settings(BaseSettings):
     def allowed_mime_types_list(self) -> List[str]:
         return [mime_type.strip() for mime_type in self.UPLOAD_ALLOWED_MIME_TYPES.split(',')]
 
+    @property
+    def thumbnail_variant_widths_list(self) -> List[int]:
+        return [int(width) for width in self.THUMBNAIL_VARIANT_WIDTHS.split(',') if width.strip()]
+
+    @property
+    def image_resize_size_steps_list(self) -> List[int]:
+        return sorted(int(step) for step in self.IMAGE_RESIZE_SIZE_STEPS.split(',') if step.strip())
+
+    @property
+    def image_resize_quality_steps_list(self) -> List[int]:
+        return sorted(int(step) for step in self.IMAGE_RESIZE_QUALITY_STEPS.split(',') if step.strip())
+
+    @property
+    def thumbnail_variant_formats_list(self) -> List[str]:
+        return [fmt.strip().lower() for fmt in self.THUMBNAIL_VARIANT_FORMATS.split(',') if fmt.strip()]
+
     @property
     def ASYNC_DATABASE_URL(self) -> str:
         if self._ASYNC_DATABASE_URL is None:
@@ -1,22 +1,160 @@
 ﻿# backend/crud.py
+import base64
+import binascii
 import datetime
 import logging
-from pathlib import Path
 
 from fastapi import HTTPException, status
-from typing import List, Optional, Tuple, Union
-
-from sqlalchemy import func, desc, update
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from sqlalchemy import (
+    Integer, String, column, func, desc, update, delete, or_, and_, literal, literal_column, text, tuple_,
+    values as sql_values
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import selectinload
 from sqlmodel import select, SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from backend import models
-from backend.auth_utils import get_password_hash
+from backend.auth_cache import AUTH_USER_CHANNEL, auth_user_cache
+from backend.auth_utils import (
+    generate_email_verification_token, generate_password_reset_token, get_password_hash_async, hash_token
+)
+from backend.token_cache import TOKEN_REVOCATION_CHANNEL, epoch_from_datetime, token_revocation_list
+from backend.response_cache import ENTITY_GALLERY, ENTITY_MEMBERS, response_cache
 
-UPLOAD_DIR = Path(__file__).parent / "uploads"
 logger = logging.getLogger(__name__)
 
+# 批量释放 MediaBlob 引用时每条语句处理的摘要数 (控制绑定参数的数量)
+MEDIA_BLOB_RELEASE_CHUNK = 1000
+# 内容摘要的 advisory lock 使用双 int4 键：(命名空间, 摘要前 32 位)，与单个 bigint 键的锁互不冲突
+MEDIA_CONTENT_LOCK_NAMESPACE = 0x4D42
+
+
+# --- 认证缓存失效 ---
+
+async def invalidate_auth_user(db: AsyncSession, user_id: int):
+    """
+    用户的认证相关字段 (用户名、角色、启用状态、密码) 变化后调用，必须在写操作的事务提交之后。
+    先删除本进程的缓存条目，再通过 NOTIFY 通知其他 worker；通知失败时其他进程的缓存最多在 TTL 内过时。
+    """
+    auth_user_cache.invalidate(user_id)
+    try:
+        await _notify(db, AUTH_USER_CHANNEL, str(user_id))
+        await db.commit()
+    except Exception as e:
+        logger.error(f"广播用户缓存失效消息失败 (user_id={user_id}): {e}")
+
+
+# --- 令牌吊销 ---
+
+async def _notify(db: AsyncSession, channel: str, payload: str):
+    """在当前事务中发送 NOTIFY，事务提交时才会投递 (回滚则不投递)。"""
+    await db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+
+
+async def revoke_token(db: AsyncSession, token_data: models.TokenData):
+    """吊销单个令牌 (登出)。旧版本签发的令牌没有 jti，无法单独吊销，只能等它过期。"""
+    if not token_data.jti or not token_data.expires_at:
+        return
+    expires_at = datetime.datetime.fromtimestamp(token_data.expires_at, datetime.timezone.utc).replace(tzinfo=None)
+    await db.execute(
+        pg_insert(models.RevokedToken.__table__)
+        .values(jti=token_data.jti, user_id=token_data.user_id, expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=["jti"])
+    )
+    await _notify(db, TOKEN_REVOCATION_CHANNEL, f"jti:{token_data.jti}:{token_data.expires_at}")
+    await db.commit()
+    token_revocation_list.revoke_jti(token_data.jti, token_data.expires_at)
+
+
+async def _stage_user_token_revocation(db: AsyncSession, user: models.User) -> int:
+    """
+    在当前事务中设置用户纪元 (此前签发的令牌全部失效) 并排队广播，返回纪元秒数。
+    调用方提交事务后应调用 token_revocation_list.set_user_epoch，使本进程立即生效。
+    """
+    user.tokens_revoked_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    epoch = epoch_from_datetime(user.tokens_revoked_at)
+    await _notify(db, TOKEN_REVOCATION_CHANNEL, f"user:{user.id}:{epoch}")
+    return epoch
+
+
+async def load_token_revocations(db: AsyncSession, max_token_lifetime_seconds: float) -> Tuple[list, list]:
+    """读取仍然有意义的吊销记录：未过期令牌的 jti，以及晚于最长令牌有效期的用户纪元。"""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    jti_rows = await db.execute(
+        select(models.RevokedToken.jti, models.RevokedToken.expires_at).where(models.RevokedToken.expires_at > now)
+    )
+    jtis = [(jti, expires_at.replace(tzinfo=datetime.timezone.utc).timestamp()) for jti, expires_at in jti_rows.all()]
+    cutoff = now - datetime.timedelta(seconds=max_token_lifetime_seconds)
+    epoch_rows = await db.execute(
+        select(models.User.id, models.User.tokens_revoked_at).where(models.User.tokens_revoked_at > cutoff)
+    )
+    epochs = [(user_id, epoch_from_datetime(revoked_at)) for user_id, revoked_at in epoch_rows.all()]
+    return jtis, epochs
+
+
+# --- 行数计数 ---
+
+async def adjust_row_counter(db: AsyncSession, model: type, delta: int):
+    """
+    在当前事务中调整某张表的计数 (与增删行一起提交或回滚，计数始终与表一致)，不提交事务。
+    平时只是一条按主键的 UPDATE；计数行不存在时 (例如数据库由 create_all 创建) 才按实际行数初始化一次。
+    """
+    table = models.RowCounter.__table__
+    table_name = model.__tablename__
+    result = await db.execute(
+        update(table).where(table.c.table_name == table_name).values(row_count=table.c.row_count + delta)
+    )
+    if result.rowcount:
+        return
+    await db.flush()  # 先把本次增删写入数据库，初始化时的 COUNT(*) 才包含它们
+    # 并发初始化时后插入的一方等待先插入的事务提交，然后在其计数上加上自己的增量
+    await db.execute(
+        pg_insert(table)
+        .from_select(["table_name", "row_count"], select(literal(table_name), func.count()).select_from(model))
+        .on_conflict_do_update(index_elements=[table.c.table_name], set_={"row_count": table.c.row_count + delta})
+    )
+
+
+async def count_table_rows(db: AsyncSession, model: type, mode: str = "counter") -> int:
+    """
+    获取表的行数。mode:
+    - counter: 读取 RowCounter 维护的计数 (单行主键查询)；
+    - estimate: 读取 Postgres 统计信息中的估算值 (pg_class.reltuples)，由 autovacuum/ANALYZE 更新；
+    - exact: COUNT(*)，需要扫描全表。
+    前两种方式取不到值时退回 exact。
+    """
+    table_name = model.__tablename__
+    if mode == "counter":
+        result = await db.execute(
+            select(models.RowCounter.row_count).where(models.RowCounter.table_name == table_name)
+        )
+        row_count = result.scalar_one_or_none()
+        if row_count is not None:
+            return row_count
+    elif mode == "estimate":
+        result = await db.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(quote_ident(:table_name))"),
+            {"table_name": table_name}
+        )
+        estimate = result.scalar_one_or_none()
+        if estimate is not None and estimate >= 0:  # 从未 ANALYZE 过的表为 -1
+            return estimate
+    result = await db.execute(select(func.count()).select_from(model))
+    return result.scalar_one()
+
+
+async def get_table_validator(db: AsyncSession, model: type) -> Tuple[Optional[datetime.datetime], int]:
+    """
+    表内容的廉价校验值 (max(updated_at), 行数)，用于生成列表接口的 ETag，无需读取列表本身。
+    新增和修改会改变 max(updated_at)，删除会改变行数。行数优先读取 RowCounter 维护的计数。
+    """
+    result = await db.execute(select(func.max(model.updated_at)))
+    return result.scalar_one_or_none(), await count_table_rows(db, model, "counter")
+
 
 # --- User CRUD ---
 
@@ -43,15 +181,17 @@ async def get_user_by_username(db: AsyncSession, username: str) -> Optional[mode
     return result.scalars().first()
 
 
-async def create_user(db: AsyncSession, user_create: models.UserCreate) -> models.User:
-    """创建一个新用户"""
-    hashed_password = get_password_hash(user_create.password)
+async def add_user(db: AsyncSession, user_create: models.UserCreate) -> models.User:
+    """
+    在当前事务中添加一个新用户并 flush (取得 id)，不提交事务，
+    以便调用方把后续写入 (例如验证邮件任务) 与用户放在同一个事务中提交。
+    """
+    hashed_password = await get_password_hash_async(user_create.password)
     current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
 
-    existing_users_count_result = await db.execute(select(func.count(models.User.id)))
-    existing_users_count = existing_users_count_result.scalar_one_or_none() or 0
-
-    user_role = models.UserRole.ADMIN if existing_users_count == 0 else models.UserRole.USER
+    # 只需要知道是否已有用户，不必统计总数
+    existing_user_result = await db.execute(select(models.User.id).limit(1))
+    user_role = models.UserRole.ADMIN if existing_user_result.first() is None else models.UserRole.USER
 
     db_user = models.User.model_validate(
         user_create,
@@ -61,6 +201,14 @@ async def create_user(db: AsyncSession, user_create: models.UserCreate) -> model
         }
     )
     db.add(db_user)
+    await adjust_row_counter(db, models.User, 1)
+    await db.flush()
+    return db_user
+
+
+async def create_user(db: AsyncSession, user_create: models.UserCreate) -> models.User:
+    """创建一个新用户"""
+    db_user = await add_user(db, user_create)
     await db.commit()
     await db.refresh(db_user)
     return db_user
@@ -90,19 +238,35 @@ async def update_user(db: AsyncSession, user: models.User, user_update: models.U
     # --- 同步逻辑结束 ---
 
     await db.commit()
+    if member_to_sync:
+        # 成员信息也出现在画廊列表的创作者字段中
+        await response_cache.bump(ENTITY_MEMBERS, ENTITY_GALLERY)
     await db.refresh(user)
     return user
 
 
-async def update_user_password(db: AsyncSession, user: models.User, new_password: str) -> models.User:
-    user.hashed_password = get_password_hash(new_password)
+async def update_user_password(db: AsyncSession, user: models.User, new_password: str,
+                               revoke_sessions: bool = False) -> models.User:
+    """修改密码。revoke_sessions=True 时 (例如通过邮件重置密码) 同时吊销该用户此前签发的所有令牌。"""
+    user.hashed_password = await get_password_hash_async(new_password)
     user.updated_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
     db.add(user)
+    epoch = await _stage_user_token_revocation(db, user) if revoke_sessions else None
     await db.commit()
+    if epoch is not None:
+        token_revocation_list.set_user_epoch(user.id, epoch)
+    await invalidate_auth_user(db, user.id)
     await db.refresh(user)
     return user
 
 
+async def rehash_user_password(db: AsyncSession, user: models.User, new_hash: str):
+    """登录时透明升级密码哈希 (工作因子变化)。密码本身没有变化，因此不修改 updated_at。"""
+    user.hashed_password = new_hash
+    db.add(user)
+    await db.commit()
+
+
 # --- Token CRUD ---
 
 async def create_verification_token(db: AsyncSession, user_id: int, token_hash: str,
@@ -116,19 +280,24 @@ async def create_verification_token(db: AsyncSession, user_id: int, token_hash:
     return token
 
 
+def _utc_now_naive() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 async def get_verification_token_by_hash(db: AsyncSession, token_hash: str) -> Optional[models.VerificationToken]:
-    """通过哈希值获取邮件验证令牌"""
-    result = await db.execute(select(models.VerificationToken).where(models.VerificationToken.token_hash == token_hash))
+    """通过摘要获取未过期的邮件验证令牌 (token_hash 上有唯一索引，等值查询)"""
+    result = await db.execute(
+        select(models.VerificationToken)
+        .where(models.VerificationToken.token_hash == token_hash, models.VerificationToken.expires_at > _utc_now_naive())
+    )
     return result.scalars().first()
 
 
 async def create_password_reset_token(db: AsyncSession, user_id: int, token_hash: str,
                                       expires_at: datetime.datetime) -> models.PasswordResetToken:
     """创建密码重置令牌"""
-    existing_tokens_result = await db.execute(
-        select(models.PasswordResetToken).where(models.PasswordResetToken.user_id == user_id))
-    for t in existing_tokens_result.scalars().all():
-        await db.delete(t)
+    # 同一用户只保留最新的重置令牌
+    await db.execute(delete(models.PasswordResetToken).where(models.PasswordResetToken.user_id == user_id))
     if expires_at.tzinfo is not None:
         expires_at = expires_at.replace(tzinfo=None)
     token = models.PasswordResetToken(user_id=user_id, token_hash=token_hash, expires_at=expires_at)
@@ -139,17 +308,53 @@ async def create_password_reset_token(db: AsyncSession, user_id: int, token_hash
 
 
 async def get_password_reset_token_by_hash(db: AsyncSession, token_hash: str) -> Optional[models.PasswordResetToken]:
-    """通过哈希值获取密码重置令牌"""
+    """通过摘要获取未过期的密码重置令牌 (token_hash 上有唯一索引，等值查询)"""
     result = await db.execute(
-        select(models.PasswordResetToken).where(models.PasswordResetToken.token_hash == token_hash))
+        select(models.PasswordResetToken)
+        .where(models.PasswordResetToken.token_hash == token_hash, models.PasswordResetToken.expires_at > _utc_now_naive())
+    )
     return result.scalars().first()
 
 
+async def issue_verification_token(db: AsyncSession, user_id: int, email: str, max_age_seconds: int) -> str:
+    """生成邮件验证令牌并保存其摘要，返回原始令牌。原始令牌只用于发送邮件，不写入数据库。"""
+    raw_token = generate_email_verification_token(email)
+    await create_verification_token(
+        db=db, user_id=user_id, token_hash=hash_token(raw_token),
+        expires_at=_utc_now_naive() + datetime.timedelta(seconds=max_age_seconds)
+    )
+    return raw_token
+
+
+async def issue_password_reset_token(db: AsyncSession, user_id: int, email: str, max_age_seconds: int) -> str:
+    """生成密码重置令牌 (替换该用户之前的重置令牌) 并保存其摘要，返回原始令牌。"""
+    raw_token = generate_password_reset_token(email)
+    await create_password_reset_token(
+        db=db, user_id=user_id, token_hash=hash_token(raw_token),
+        expires_at=_utc_now_naive() + datetime.timedelta(seconds=max_age_seconds)
+    )
+    return raw_token
+
+
 async def delete_db_token(db: AsyncSession, token: Union[models.VerificationToken, models.PasswordResetToken]):
     await db.delete(token)
     await db.commit()
 
 
+async def purge_expired_tokens(db: AsyncSession, now: Optional[datetime.datetime] = None) -> int:
+    """
+    删除所有过期的验证/重置令牌以及过期令牌的吊销记录 (按 expires_at 索引范围删除)，返回删除的行数。
+    已使用的验证/重置令牌在使用时即被删除。
+    """
+    now = now or _utc_now_naive()
+    removed = 0
+    for model in (models.VerificationToken, models.PasswordResetToken, models.RevokedToken):
+        result = await db.execute(delete(model).where(model.expires_at <= now))
+        removed += result.rowcount or 0
+    await db.commit()
+    return removed
+
+
 # --- Member CRUD ---
 
 async def get_member_by_id(db: AsyncSession, member_id: int) -> Optional[models.Member]:
@@ -169,7 +374,9 @@ async def get_or_create_member(db: AsyncSession, name: str) -> models.Member:
         current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
         member = models.Member(name=name, created_at=current_utc_naive, updated_at=current_utc_naive)
         db.add(member)
+        await adjust_row_counter(db, models.Member, 1)
         await db.commit()
+        await response_cache.bump(ENTITY_MEMBERS)
         await db.refresh(member)
     return member
 
@@ -215,6 +422,7 @@ async def update_member(db: AsyncSession, member: models.Member, member_update:
     # --- 同步逻辑结束 ---
 
     await db.commit()
+    await response_cache.bump(ENTITY_MEMBERS, ENTITY_GALLERY)
     await db.refresh(member)
     return member
 
@@ -231,7 +439,9 @@ async def delete_member(db: AsyncSession, member: models.Member):
 
     # 2. 现在可以安全地删除该成员了
     await db.delete(member)
+    await adjust_row_counter(db, models.Member, -1)
     await db.commit()
+    await response_cache.bump(ENTITY_MEMBERS, ENTITY_GALLERY)
 
 # --- GalleryItem CRUD ---
 
@@ -245,17 +455,17 @@ async def get_gallery_item_by_id(db: AsyncSession, item_id: int) -> Optional[mod
     return result.scalars().first()
 
 
-async def get_paginated_gallery_items(db: AsyncSession, page: int, page_size: int) -> Tuple[
-    int, List[models.GalleryItem]]:
-    """分页获取画廊作品"""
+async def get_paginated_gallery_items(db: AsyncSession, page: int, page_size: int,
+                                      count_mode: Optional[str] = "counter") -> Tuple[
+    Optional[int], List[models.GalleryItem]]:
+    """分页获取画廊作品。count_mode 为 None 时不计算总数 (返回的总数为 None)。"""
     offset = (page - 1) * page_size
 
-    total_items_statement = select(func.count(models.GalleryItem.id))
-    total_items_result = await db.execute(total_items_statement)
-    total_items = total_items_result.scalar_one_or_none() or 0
-
-    if total_items == 0:
-        return 0, []
+    total_items = None
+    if count_mode is not None:
+        total_items = await count_table_rows(db, models.GalleryItem, count_mode)
+        if total_items == 0:
+            return 0, []
 
     items_statement = (
         select(models.GalleryItem)
@@ -263,7 +473,7 @@ async def get_paginated_gallery_items(db: AsyncSession, page: int, page_size: in
             selectinload(models.GalleryItem.builder),
             selectinload(models.GalleryItem.uploader)
         )
-        .order_by(desc(models.GalleryItem.uploaded_at))
+        .order_by(desc(models.GalleryItem.uploaded_at), desc(models.GalleryItem.id))
         .offset(offset)
         .limit(page_size)
     )
@@ -273,18 +483,118 @@ async def get_paginated_gallery_items(db: AsyncSession, page: int, page_size: in
     return total_items, gallery_items_db
 
 
+GalleryCursor = Tuple[datetime.datetime, int]
+
+
+def encode_gallery_cursor(item: Union[models.GalleryItem, Row]) -> str:
+    """把一页最后一个作品 (ORM 对象或查询行) 的 (uploaded_at, id) 编码为不透明的游标字符串。"""
+    raw = f"{item.uploaded_at.isoformat()}|{item.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_gallery_cursor(cursor: str) -> GalleryCursor:
+    """解析 encode_gallery_cursor 生成的游标，格式不正确时抛出 ValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        uploaded_at, item_id = raw.split("|", 1)
+        return datetime.datetime.fromisoformat(uploaded_at), int(item_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+
+
+# 公开画廊列表只需要这些列 (作品 + 创作者)：不构造 ORM 实体，也不加载响应中用不到的 uploader
+GALLERY_LISTING_COLUMNS = (
+    models.GalleryItem.id,
+    models.GalleryItem.title,
+    models.GalleryItem.description,
+    models.GalleryItem.image_url,
+    models.GalleryItem.thumbnail_url,
+    models.GalleryItem.item_type,
+    models.GalleryItem.user_id,
+    models.GalleryItem.member_id,
+    models.GalleryItem.uploaded_at,
+    models.GalleryItem.updated_at,
+    models.GalleryItem.thumbnail_variants,
+    models.Member.name.label("builder_name"),
+    models.Member.role.label("builder_role"),
+    models.Member.avatar_url.label("builder_avatar_url"),
+    models.Member.bio.label("builder_bio"),
+)
+
+
+async def get_gallery_listing_page(db: AsyncSession, page_size: int, offset: int = 0,
+                                   cursor: Optional[GalleryCursor] = None) -> Tuple[List[Row], Optional[str]]:
+    """
+    公开画廊列表的精简读取路径，返回 (行列表, 下一页游标)。
+    一次 LEFT JOIN 查询只取响应需要的列，结果是轻量的行元组，由 gallery_listing_row_to_dict 直接转换为响应结构。
+    传入 cursor 时按 (uploaded_at, id) 行值比较从上一页的最后一条之后继续读取 (借助 ix_galleryitem_uploaded_at_id 索引，
+    开销与翻页深度无关)；否则按 offset 跳过前面的行。
+    """
+    statement = (
+        select(*GALLERY_LISTING_COLUMNS)
+        .outerjoin(models.Member, models.Member.id == models.GalleryItem.member_id)
+        .order_by(desc(models.GalleryItem.uploaded_at), desc(models.GalleryItem.id))
+        .limit(page_size + 1)  # 多取一条，用来判断是否还有下一页
+    )
+    if cursor is not None:
+        statement = statement.where(tuple_(models.GalleryItem.uploaded_at, models.GalleryItem.id) < tuple_(*cursor))
+    elif offset:
+        statement = statement.offset(offset)
+    rows = list((await db.execute(statement)).all())
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, encode_gallery_cursor(rows[-1])
+    return rows, None
+
+
+def gallery_listing_row_to_dict(row: Row) -> dict:
+    """把 get_gallery_listing_page 的一行转换为与 GalleryItemReadWithBuilder 序列化结果相同的字典。"""
+    builder = None
+    if row.member_id is not None and row.builder_name is not None:
+        builder = {
+            "name": row.builder_name,
+            "role": row.builder_role,
+            "avatar_url": row.builder_avatar_url,
+            "bio": row.builder_bio,
+            "id": row.member_id,
+        }
+    return {
+        "title": row.title,
+        "description": row.description,
+        "image_url": row.image_url,
+        "thumbnail_url": row.thumbnail_url,
+        "item_type": row.item_type.value if isinstance(row.item_type, models.ItemType) else row.item_type,
+        "id": row.id,
+        "user_id": row.user_id,
+        "member_id": row.member_id,
+        "uploaded_at": row.uploaded_at.isoformat(),
+        "updated_at": row.updated_at.isoformat(),
+        "builder": builder,
+        "thumbnail_variants": row.thumbnail_variants,
+    }
+
+
 async def create_gallery_item(db: AsyncSession, item_create: models.GalleryItemCreate, user_id: int,
-                              member_id: int) -> models.GalleryItem:
+                              member_id: int, content_hash: Optional[str] = None,
+                              thumbnail_variants: Optional[List[dict]] = None,
+                              next_job: Optional[models.Job] = None) -> models.GalleryItem:
+    """创建画廊作品。next_job (例如缩略图任务) 与作品在同一个事务中写入，不会出现有作品却没有任务的情况。"""
     current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
     db_item = models.GalleryItem.model_validate(
         item_create,
         update={
-            "user_id": user_id, "member_id": member_id,
+            "user_id": user_id, "member_id": member_id, "content_hash": content_hash,
+            "thumbnail_variants": thumbnail_variants,
             "uploaded_at": current_utc_naive, "updated_at": current_utc_naive
         }
     )
     db.add(db_item)
+    if next_job is not None:
+        db.add(next_job)
+    await adjust_row_counter(db, models.GalleryItem, 1)
     await db.commit()
+    await response_cache.bump(ENTITY_GALLERY)
     await db.refresh(db_item)
     return db_item
 
@@ -297,13 +607,212 @@ async def update_gallery_item(db: AsyncSession, item: models.GalleryItem,
     item.updated_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
     db.add(item)
     await db.commit()
+    await response_cache.bump(ENTITY_GALLERY)
     await db.refresh(item)
     return item
 
 
-async def delete_gallery_item(db: AsyncSession, item: models.GalleryItem):
+async def delete_gallery_item(db: AsyncSession, item: models.GalleryItem) -> List[str]:
+    """
+    删除画廊作品，返回已不再被任何作品引用、可以从磁盘删除的文件URL。
+    文件删除由调用方在事务提交之后进行。
+    """
+    orphaned_urls = await release_gallery_item_files(db, item)
     await db.delete(item)
+    await adjust_row_counter(db, models.GalleryItem, -1)
     await db.commit()
+    await response_cache.bump(ENTITY_GALLERY)
+    return orphaned_urls
+
+
+# --- MediaBlob CRUD ---
+
+async def lock_media_content(db: AsyncSession, hashes):
+    """
+    在当前事务中对这些内容摘要加事务级 advisory lock (按键排序加锁，避免死锁)，事务结束时释放。
+    上传 (acquire_media_blob 到提交) 和删除孤儿文件 (file_reaper) 对同一摘要互斥：
+    删除前在锁内确认 MediaBlob 不存在，同一内容的新上传不会在检查和删除之间把文件放回原路径。
+    """
+    for key in sorted({int(digest[:8], 16) - 2 ** 31 for digest in hashes}):
+        await db.execute(text("SELECT pg_advisory_xact_lock(:namespace, :key)"),
+                         {"namespace": MEDIA_CONTENT_LOCK_NAMESPACE, "key": key})
+
+
+async def acquire_media_blob(db: AsyncSession, sha256: str, image_url: str, thumbnail_url: str,
+                             thumbnail_variants: List[dict], mime_type: str,
+                             size: int) -> Tuple[models.MediaBlob, bool]:
+    """
+    为一次上传增加对应内容的引用计数 (不存在时创建)，不提交事务，
+    以便与随后创建的画廊作品在同一个事务中提交。
+    返回 (MediaBlob, 是否新建)；不是新建时调用方可以丢弃刚上传的文件并跳过缩略图生成。
+    同时持有该摘要的锁直到事务结束，调用方应在提交之前把文件移动到最终位置。
+    """
+    await lock_media_content(db, [sha256])
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    table = models.MediaBlob.__table__
+    statement = (
+        pg_insert(table)
+        .values(
+            sha256=sha256, image_url=image_url, thumbnail_url=thumbnail_url,
+            thumbnail_variants=thumbnail_variants, mime_type=mime_type, size=size,
+            ref_count=1, created_at=current_utc_naive, updated_at=current_utc_naive
+        )
+        .on_conflict_do_update(
+            index_elements=[table.c.sha256],
+            set_={"ref_count": table.c.ref_count + 1, "updated_at": current_utc_naive}
+        )
+        .returning(*table.c, literal_column("xmax = 0").label("inserted"))
+    )
+    row = (await db.execute(statement)).mappings().one()
+    blob = models.MediaBlob(**{column.name: row[column.name] for column in table.c})
+    return blob, bool(row["inserted"])
+
+
+async def record_thumbnail_variants(db: AsyncSession, sha256: str, actual_widths: Dict[str, int]):
+    """
+    缩略图任务完成后，把变体的实际宽度 (文件名 -> 宽度) 写回上传时规划的变体记录，并提交事务。
+    原图比目标宽度小时不会放大，同样大小的变体只生成一个，没有生成的变体从记录中去掉。
+    同时更新 MediaBlob 和引用它的所有画廊作品。
+    """
+    blob = await db.get(models.MediaBlob, sha256)
+    if blob is None or not blob.thumbnail_variants:
+        return
+    variants = []
+    for variant in blob.thumbnail_variants:
+        file_name = variant["url"].rsplit("/", 1)[-1]
+        if file_name in actual_widths:
+            variants.append({**variant, "width": actual_widths[file_name]})
+    if variants == blob.thumbnail_variants:
+        return
+    # 同时更新 updated_at：列表接口的 ETag 由 max(updated_at) 和行数决定，否则客户端会一直拿到 304 和旧的宽度
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    await db.execute(
+        update(models.MediaBlob).where(models.MediaBlob.sha256 == sha256)
+        .values(thumbnail_variants=variants, updated_at=current_utc_naive)
+    )
+    await db.execute(
+        update(models.GalleryItem).where(models.GalleryItem.content_hash == sha256)
+        .values(thumbnail_variants=variants, updated_at=current_utc_naive)
+    )
+    await db.commit()
+    await response_cache.bump(ENTITY_GALLERY)
+
+
+async def release_media_blob(db: AsyncSession, sha256: str) -> List[str]:
+    """
+    减少内容的引用计数 (不提交事务)。引用归零时删除记录，并返回需要从磁盘删除的文件URL。
+    """
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    result = await db.execute(
+        update(models.MediaBlob)
+        .where(models.MediaBlob.sha256 == sha256)
+        .values(ref_count=models.MediaBlob.ref_count - 1, updated_at=current_utc_naive)
+        .returning(models.MediaBlob.ref_count, models.MediaBlob.image_url, models.MediaBlob.thumbnail_url,
+                   models.MediaBlob.thumbnail_variants)
+    )
+    row = result.first()
+    if row is None or row.ref_count > 0:
+        return []
+    await db.execute(delete(models.MediaBlob).where(models.MediaBlob.sha256 == sha256))
+    return media_file_urls(row.image_url, row.thumbnail_url, row.thumbnail_variants)
+
+
+async def release_media_blobs(db: AsyncSession, released: Dict[str, int]) -> List[str]:
+    """
+    批量版本的 release_media_blob：released 为 {sha256: 释放的引用数}，每批只执行一条 UPDATE 和一条 DELETE (不提交事务)。
+    返回引用归零、需要从磁盘删除的文件URL。
+    """
+    orphaned_urls = []
+    now = _utc_now_naive()
+    items = sorted(released.items())
+    for start in range(0, len(items), MEDIA_BLOB_RELEASE_CHUNK):
+        chunk = items[start:start + MEDIA_BLOB_RELEASE_CHUNK]
+        releases = sql_values(
+            column("sha256", String), column("released", Integer), name="releases"
+        ).data(chunk)
+        await db.execute(
+            update(models.MediaBlob)
+            .where(models.MediaBlob.sha256 == releases.c.sha256)
+            .values(ref_count=models.MediaBlob.ref_count - releases.c.released, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        deleted_blobs = await db.execute(
+            delete(models.MediaBlob)
+            .where(models.MediaBlob.sha256.in_([sha256 for sha256, _ in chunk]), models.MediaBlob.ref_count <= 0)
+            .returning(models.MediaBlob.image_url, models.MediaBlob.thumbnail_url,
+                       models.MediaBlob.thumbnail_variants)
+            .execution_options(synchronize_session=False)
+        )
+        for row in deleted_blobs:
+            orphaned_urls.extend(media_file_urls(row.image_url, row.thumbnail_url, row.thumbnail_variants))
+    return orphaned_urls
+
+
+def media_file_urls(image_url: Optional[str], thumbnail_url: Optional[str],
+                    thumbnail_variants: Optional[List[dict]]) -> List[str]:
+    """一个作品 (或 MediaBlob) 在磁盘上对应的所有文件URL：原始文件、缩略图和缩略图变体。"""
+    urls = [url for url in (image_url, thumbnail_url) if url]
+    urls.extend(variant["url"] for variant in thumbnail_variants or [])
+    return urls
+
+
+async def release_gallery_item_files(db: AsyncSession, item: models.GalleryItem) -> List[str]:
+    """
+    释放画廊作品对文件的引用 (不提交事务)，返回可以从磁盘删除的文件URL。
+    内容寻址的作品按引用计数处理；旧作品的文件只属于它自己，直接返回。
+    """
+    if item.content_hash:
+        return await release_media_blob(db, item.content_hash)
+    return media_file_urls(item.image_url, item.thumbnail_url, item.thumbnail_variants)
+
+
+# --- 存储回收 (storage_gc) ---
+
+async def try_advisory_xact_lock(db: AsyncSession, key: int) -> bool:
+    """尝试获取事务级的 advisory lock，事务结束 (提交或回滚) 时自动释放。多个进程中只有一个能拿到。"""
+    return bool((await db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": key})).scalar())
+
+
+async def find_existing_media_hashes(db: AsyncSession, hashes: List[str]) -> Set[str]:
+    """返回 hashes 中仍有 MediaBlob 记录 (即仍被作品引用) 的摘要。"""
+    if not hashes:
+        return set()
+    result = await db.execute(select(models.MediaBlob.sha256).where(models.MediaBlob.sha256.in_(hashes)))
+    return set(result.scalars().all())
+
+
+async def get_referenced_upload_urls(db: AsyncSession, exclude_prefix: str) -> Set[str]:
+    """
+    返回数据库引用的全部 /uploads/... URL：作品的原图、缩略图和缩略图变体，用户头像和成员头像。
+    以 exclude_prefix 开头的 URL (内容寻址的 media/ 文件，由 MediaBlob 判断) 不包含在内，
+    剩下的只是数量有限的旧版上传。存储回收每次运行只调用一次 (每张表顺序扫描一遍)，
+    而不是对每批文件在没有索引的 URL 列上做 IN 查询。
+    """
+    url_columns = (
+        models.GalleryItem.image_url,
+        models.GalleryItem.thumbnail_url,
+        models.User.avatar_url,
+        models.Member.avatar_url,
+    )
+    referenced = set()
+    for url_column in url_columns:
+        result = await db.execute(
+            select(url_column).where(url_column.like("/uploads/%"), url_column.not_like(f"{exclude_prefix}%"))
+            .distinct()
+        )
+        referenced.update(result.scalars().all())
+    # 缩略图变体保存在 JSON 数组中
+    result = await db.execute(
+        text(
+            "SELECT DISTINCT variant->>'url' FROM galleryitem "
+            "CROSS JOIN LATERAL json_array_elements(galleryitem.thumbnail_variants) AS variant "
+            "WHERE json_typeof(galleryitem.thumbnail_variants) = 'array' "
+            "AND variant->>'url' LIKE '/uploads/%' AND variant->>'url' NOT LIKE :exclude"
+        ),
+        {"exclude": f"{exclude_prefix}%"}
+    )
+    referenced.update(result.scalars().all())
+    return referenced
 
 
 # --- FriendLink CRUD ---
@@ -336,10 +845,13 @@ async def admin_update_user_details(db: AsyncSession, user: models.User, update_
             )
 
     # 更新 User
+    was_active = user.is_active
     for key, value in patch_data.items():
         setattr(user, key, value)
     user.updated_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
     db.add(user)
+    # 禁用用户时吊销其所有令牌 (包括刷新令牌)，立即生效
+    epoch = await _stage_user_token_revocation(db, user) if was_active and not user.is_active else None
 
     # --- 同步逻辑开始 ---
     # 使用更新后的用户名来查找对应的核心成员
@@ -354,61 +866,69 @@ async def admin_update_user_details(db: AsyncSession, user: models.User, update_
     # --- 同步逻辑结束 ---
 
     await db.commit()
+    if epoch is not None:
+        token_revocation_list.set_user_epoch(user.id, epoch)
+    await invalidate_auth_user(db, user.id)
+    if member_to_sync:
+        await response_cache.bump(ENTITY_MEMBERS, ENTITY_GALLERY)
     await db.refresh(user)
     return user
 
 
-async def delete_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+async def delete_user_by_id(db: AsyncSession, user_id: int) -> Tuple[Optional[models.User], List[str]]:
     """
-    通过ID删除用户，并级联删除其所有关联记录及文件。
-    返回被删除的用户对象，如果未找到则返回 None。
+    通过ID删除用户及其所有关联记录，返回 (被删除的用户, 可以从磁盘删除的文件URL)；未找到用户时返回 (None, [])。
+    每张表只执行一条 DELETE ... RETURNING，不把关联记录加载为 ORM 对象，耗时与用户的作品数量基本无关。
+    文件由调用方在事务提交后交给 file_reaper 在后台删除。
     """
-    user_to_delete = await db.get(models.User, user_id)
-    if not user_to_delete:
-        return None
-
-    # 1. 删除关联的画廊作品及其物理文件
-    gallery_items_stmt = select(models.GalleryItem).where(models.GalleryItem.user_id == user_id)
-    for item in (await db.execute(gallery_items_stmt)).scalars().all():
-        # 【核心修改】新增物理文件删除逻辑
-        try:
-            if item.image_url:
-                image_path = UPLOAD_DIR / Path(item.image_url).name
-                if image_path.is_file():
-                    image_path.unlink()
-            if item.thumbnail_url:
-                thumb_path = UPLOAD_DIR / Path(item.thumbnail_url).name
-                if thumb_path.is_file():
-                    thumb_path.unlink()
-        except Exception as e:
-            logger.error(f"删除用户时，删除作品 {item.id} 的文件失败: {e}")
-
-        await db.delete(item)
-
-    # 2. 删除关联的邮件验证令牌 (修复本次报错的关键)
-    verification_tokens_stmt = select(models.VerificationToken).where(models.VerificationToken.user_id == user_id)
-    for token in (await db.execute(verification_tokens_stmt)).scalars().all():
-        await db.delete(token)
-
-    # 3. 删除关联的密码重置令牌
-    password_reset_tokens_stmt = select(models.PasswordResetToken).where(models.PasswordResetToken.user_id == user_id)
-    for token in (await db.execute(password_reset_tokens_stmt)).scalars().all():
-        await db.delete(token)
-
-    # 4. 现在可以安全地删除用户了
-    await db.delete(user_to_delete)
+    # 1. 删除关联的画廊作品，并释放它们对文件的引用
+    deleted_items = (await db.execute(
+        delete(models.GalleryItem)
+        .where(models.GalleryItem.user_id == user_id)
+        .returning(models.GalleryItem.content_hash, models.GalleryItem.image_url,
+                   models.GalleryItem.thumbnail_url, models.GalleryItem.thumbnail_variants)
+        .execution_options(synchronize_session=False)
+    )).all()
+    orphaned_urls = []
+    released_hashes: Dict[str, int] = {}
+    for row in deleted_items:
+        if row.content_hash:
+            released_hashes[row.content_hash] = released_hashes.get(row.content_hash, 0) + 1
+        else:
+            orphaned_urls.extend(media_file_urls(row.image_url, row.thumbnail_url, row.thumbnail_variants))
+    orphaned_urls.extend(await release_media_blobs(db, released_hashes))
+    if deleted_items:
+        await adjust_row_counter(db, models.GalleryItem, -len(deleted_items))
+
+    # 2. 删除关联的邮件验证令牌、密码重置令牌和未完成的可续传上传会话 (临时文件由定期清理任务回收)
+    for model in (models.VerificationToken, models.PasswordResetToken, models.UploadSession):
+        await db.execute(delete(model).where(model.user_id == user_id).execution_options(synchronize_session=False))
+
+    # 3. 最后删除用户；用户不存在时回滚 (上面的语句此时也不会删除任何行)
+    deleted_user = (await db.execute(
+        delete(models.User)
+        .where(models.User.id == user_id)
+        .returning(models.User)
+        .execution_options(synchronize_session=False)
+    )).scalars().first()
+    if deleted_user is None:
+        await db.rollback()
+        return None, []
+    await adjust_row_counter(db, models.User, -1)
     await db.commit()
+    await invalidate_auth_user(db, user_id)
+    if deleted_items:
+        await response_cache.bump(ENTITY_GALLERY)
 
-    return user_to_delete
+    return deleted_user, orphaned_urls
 
 
-async def admin_get_paginated_users(db: AsyncSession, page: int, page_size: int) -> Tuple[int, List[models.User]]:
-    """分页获取所有用户的列表"""
+async def admin_get_paginated_users(db: AsyncSession, page: int, page_size: int,
+                                    count_mode: Optional[str] = "counter") -> Tuple[Optional[int], List[models.User]]:
+    """分页获取所有用户的列表。count_mode 为 None 时不计算总数。"""
     offset = (page - 1) * page_size
 
-    total_stmt = select(func.count(models.User.id))
-    total_result = await db.execute(total_stmt)
-    total = total_result.scalar_one()
+    total = await count_table_rows(db, models.User, count_mode) if count_mode is not None else None
 
     items_stmt = select(models.User).order_by(models.User.id).offset(offset).limit(page_size)
     items_result = await db.execute(items_stmt)
@@ -417,14 +937,13 @@ async def admin_get_paginated_users(db: AsyncSession, page: int, page_size: int)
     return total, items
 
 
-async def admin_get_paginated_gallery_items(db: AsyncSession, page: int, page_size: int) -> Tuple[
-    int, List[models.GalleryItem]]:
-    """分页获取所有画廊作品的列表"""
+async def admin_get_paginated_gallery_items(db: AsyncSession, page: int, page_size: int,
+                                            count_mode: Optional[str] = "counter") -> Tuple[
+    Optional[int], List[models.GalleryItem]]:
+    """分页获取所有画廊作品的列表。count_mode 为 None 时不计算总数。"""
     offset = (page - 1) * page_size
 
-    total_stmt = select(func.count(models.GalleryItem.id))
-    total_result = await db.execute(total_stmt)
-    total = total_result.scalar_one()
+    total = await count_table_rows(db, models.GalleryItem, count_mode) if count_mode is not None else None
 
     items_stmt = (
         select(models.GalleryItem)
@@ -432,7 +951,7 @@ async def admin_get_paginated_gallery_items(db: AsyncSession, page: int, page_si
             selectinload(models.GalleryItem.builder),
             selectinload(models.GalleryItem.uploader)
         )
-        .order_by(desc(models.GalleryItem.uploaded_at))
+        .order_by(desc(models.GalleryItem.uploaded_at), desc(models.GalleryItem.id))
         .offset(offset)
         .limit(page_size)
     )
@@ -442,4 +961,419 @@ async def admin_get_paginated_gallery_items(db: AsyncSession, page: int, page_si
     return total, items
 
 
+# --- Job Queue CRUD ---
+
+def new_job(kind: str, payload: dict, max_attempts: int = 5) -> models.Job:
+    """构造一个立即可执行的任务 (未写入数据库)，供需要与其他写操作在同一事务中入队的调用方使用。"""
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return models.Job(
+        kind=kind, payload=payload, max_attempts=max_attempts,
+        run_after=current_utc_naive, created_at=current_utc_naive, updated_at=current_utc_naive
+    )
+
+
+async def enqueue_job(db: AsyncSession, kind: str, payload: dict, max_attempts: int = 5) -> models.Job:
+    """向持久化任务队列写入一个新任务"""
+    job = new_job(kind=kind, payload=payload, max_attempts=max_attempts)
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+async def claim_jobs(db: AsyncSession, batch_size: int, lock_timeout_seconds: int) -> List[models.Job]:
+    """
+    领取一批可执行的任务。
+    使用 SELECT ... FOR UPDATE SKIP LOCKED，多个 worker 进程并发领取时互不阻塞、也不会重复领取。
+    被领取后超过 lock_timeout_seconds 仍未完成的任务 (例如 worker 崩溃) 会被重新领取；
+    这样的任务如果已经用完了尝试次数 (例如每次都让 worker 进程崩溃的任务)，直接标记为 FAILED，不再领取。
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    stale_before = now - datetime.timedelta(seconds=lock_timeout_seconds)
+
+    await db.execute(
+        update(models.Job)
+        .where(
+            models.Job.status == models.JobStatus.RUNNING,
+            models.Job.locked_at < stale_before,
+            models.Job.attempts >= models.Job.max_attempts
+        )
+        .values(status=models.JobStatus.FAILED, locked_at=None, updated_at=now,
+                last_error="worker 在执行期间退出或超时，已达到最大尝试次数")
+    )
+    statement = (
+        select(models.Job)
+        .where(or_(
+            and_(models.Job.status == models.JobStatus.PENDING, models.Job.run_after <= now),
+            and_(models.Job.status == models.JobStatus.RUNNING, models.Job.locked_at < stale_before,
+                 models.Job.attempts < models.Job.max_attempts)
+        ))
+        .order_by(models.Job.run_after, models.Job.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    jobs = (await db.execute(statement)).scalars().all()
+
+    for job in jobs:
+        job.status = models.JobStatus.RUNNING
+        job.locked_at = now
+        job.attempts += 1
+        job.updated_at = now
+        db.add(job)
+    await db.commit()
+    return jobs
+
+
+async def has_active_job(db: AsyncSession, kind: str, payload_key: str, payload_value: str) -> bool:
+    """是否已有尚未结束 (等待中或执行中) 的同类任务，其 payload[payload_key] 等于 payload_value。"""
+    result = await db.execute(
+        select(models.Job.id)
+        .where(
+            models.Job.kind == kind,
+            models.Job.status.in_([models.JobStatus.PENDING, models.JobStatus.RUNNING]),
+            models.Job.payload[payload_key].as_string() == payload_value
+        )
+        .limit(1)
+    )
+    return result.first() is not None
+
+
+def _claimed_by(job: models.Job):
+    """
+    只匹配本次领取的任务：任务超时后可能已被其他 worker 重新领取 (locked_at 随之改变)，
+    迟到的 worker 不能再删除或改写它。
+    """
+    return and_(
+        models.Job.id == job.id,
+        models.Job.status == models.JobStatus.RUNNING,
+        models.Job.locked_at == job.locked_at
+    )
+
+
+async def complete_job(db: AsyncSession, job: models.Job) -> bool:
+    """任务执行成功后直接删除。任务已被重新领取时不做任何修改，返回 False。"""
+    result = await db.execute(delete(models.Job).where(_claimed_by(job)))
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def fail_job(db: AsyncSession, job: models.Job, error: str, retry_base_seconds: int,
+                   retry_max_seconds: int) -> bool:
+    """
+    记录任务失败。未超过最大尝试次数时按指数退避重新排队，否则标记为 FAILED。
+    任务已被重新领取时不做任何修改，返回 False。
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if job.attempts >= job.max_attempts:
+        values = {"status": models.JobStatus.FAILED}
+    else:
+        delay = min(retry_base_seconds * (2 ** max(job.attempts - 1, 0)), retry_max_seconds)
+        values = {"status": models.JobStatus.PENDING, "run_after": now + datetime.timedelta(seconds=delay)}
+
+    result = await db.execute(
+        update(models.Job)
+        .where(_claimed_by(job))
+        .values(locked_at=None, last_error=error[:2000], updated_at=now, **values)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+# --- Broadcast CRUD ---
+
+def _broadcast_recipient_filter(only_verified: bool):
+    conditions = [models.User.is_active == True]
+    if only_verified:
+        conditions.append(models.User.is_verified == True)
+    return and_(*conditions)
+
+
+async def create_broadcast(db: AsyncSession, broadcast_create: models.BroadcastCreate,
+                           created_by_id: int) -> models.Broadcast:
+    """创建群发记录，并统计当前的收件人数量用于展示进度 (发送期间新注册的用户也会收到)。"""
+    total = (await db.execute(
+        select(func.count(models.User.id)).where(_broadcast_recipient_filter(broadcast_create.only_verified))
+    )).scalar_one()
+    now = _utc_now_naive()
+    broadcast = models.Broadcast(
+        # 主题写入邮件头，不能包含换行
+        subject=" ".join(broadcast_create.subject.split()),
+        body=broadcast_create.body,
+        only_verified=broadcast_create.only_verified,
+        created_by_id=created_by_id,
+        total_recipients=total,
+        created_at=now,
+        updated_at=now
+    )
+    db.add(broadcast)
+    await db.commit()
+    await db.refresh(broadcast)
+    return broadcast
+
+
+async def get_broadcast(db: AsyncSession, broadcast_id: int) -> Optional[models.Broadcast]:
+    return await db.get(models.Broadcast, broadcast_id, populate_existing=True)
+
+
+async def list_broadcasts(db: AsyncSession, limit: int = 50) -> List[models.Broadcast]:
+    result = await db.execute(select(models.Broadcast).order_by(desc(models.Broadcast.id)).limit(limit))
+    return result.scalars().all()
+
+
+async def claim_broadcast(db: AsyncSession, broadcast_id: int, stale_seconds: int) -> Optional[models.Broadcast]:
+    """
+    领取一个群发：只有 PENDING，或 RUNNING 但执行者超过 stale_seconds 没有心跳 (已崩溃) 的群发可以被领取。
+    条件更新是原子的，多个进程同时领取时只有一个成功，其余返回 None。
+    """
+    now = _utc_now_naive()
+    stale_before = now - datetime.timedelta(seconds=stale_seconds)
+    result = await db.execute(
+        update(models.Broadcast)
+        .where(
+            models.Broadcast.id == broadcast_id,
+            or_(
+                models.Broadcast.status == models.BroadcastStatus.PENDING,
+                and_(
+                    models.Broadcast.status == models.BroadcastStatus.RUNNING,
+                    or_(models.Broadcast.heartbeat_at.is_(None), models.Broadcast.heartbeat_at < stale_before)
+                )
+            )
+        )
+        .values(status=models.BroadcastStatus.RUNNING, heartbeat_at=now, updated_at=now)
+        .returning(models.Broadcast.id)
+    )
+    claimed = result.scalar_one_or_none()
+    await db.commit()
+    if claimed is None:
+        return None
+    return await get_broadcast(db, broadcast_id)
+
+
+async def get_broadcast_recipients(db: AsyncSession, only_verified: bool, after_user_id: int,
+                                   limit: int) -> List[Row]:
+    """
+    读取 user.id > after_user_id 的下一页收件人 (id, username, email)，按 id 递增 (键集分页，沿主键索引范围扫描)。
+    每页是一个独立的短查询，发送期间不持有游标或事务。
+    """
+    result = await db.execute(
+        select(models.User.id, models.User.username, models.User.email)
+        .where(models.User.id > after_user_id, _broadcast_recipient_filter(only_verified))
+        .order_by(models.User.id)
+        .limit(limit)
+    )
+    return list(result.all())
+
+
+async def checkpoint_broadcast(db: AsyncSession, broadcast_id: int, last_user_id: Optional[int], sent: int,
+                               failures: List[dict], max_recorded_failures: int,
+                               next_status: models.BroadcastStatus = models.BroadcastStatus.RUNNING,
+                               next_job: Optional[models.Job] = None) -> models.BroadcastStatus:
+    """
+    一批收件人发送完毕后写入检查点和计数。next_status:
+    - RUNNING: 执行者继续持有群发，刷新心跳；
+    - PENDING: 释放群发，由 next_job 继续下一批 (next_job 与检查点在同一个事务中写入)；
+    - COMPLETED: 已全部发送。
+    已被取消的群发保持 CANCELLED，也不写入 next_job。返回群发的当前状态。
+    """
+    broadcast = await db.get(models.Broadcast, broadcast_id, with_for_update=True, populate_existing=True)
+    now = _utc_now_naive()
+    if last_user_id is not None:
+        broadcast.last_user_id = max(broadcast.last_user_id, last_user_id)
+    broadcast.sent_count += sent
+    broadcast.failed_count += len(failures)
+    if failures:
+        # JSON 列需要整体赋值才会被标记为已修改
+        broadcast.failures = (broadcast.failures + failures)[-max_recorded_failures:]
+    if broadcast.status == models.BroadcastStatus.RUNNING:
+        broadcast.status = next_status
+        broadcast.heartbeat_at = now if next_status == models.BroadcastStatus.RUNNING else None
+        if next_status == models.BroadcastStatus.COMPLETED:
+            broadcast.finished_at = now
+        if next_job is not None:
+            db.add(next_job)
+    broadcast.updated_at = now
+    db.add(broadcast)
+    await db.commit()
+    return broadcast.status
+
+
+async def touch_broadcast(db: AsyncSession, broadcast_id: int):
+    """刷新执行者心跳 (一批收件人发送时间较长时，避免被其他进程误判为崩溃)。"""
+    await db.execute(
+        update(models.Broadcast)
+        .where(models.Broadcast.id == broadcast_id, models.Broadcast.status == models.BroadcastStatus.RUNNING)
+        .values(heartbeat_at=_utc_now_naive())
+    )
+    await db.commit()
+
+
+async def finish_broadcast(db: AsyncSession, broadcast_id: int, status: models.BroadcastStatus,
+                           error: Optional[str] = None):
+    """
+    执行者结束群发：COMPLETED 表示全部发送完毕；PENDING 表示中断 (保留检查点，可以继续)。
+    已被取消的群发保持 CANCELLED。
+    """
+    now = _utc_now_naive()
+    values = {"status": status, "heartbeat_at": None, "updated_at": now}
+    if status == models.BroadcastStatus.COMPLETED:
+        values["finished_at"] = now
+    if error is not None:
+        values["last_error"] = error[:2000]
+    await db.execute(
+        update(models.Broadcast)
+        .where(models.Broadcast.id == broadcast_id, models.Broadcast.status == models.BroadcastStatus.RUNNING)
+        .values(**values)
+    )
+    await db.commit()
 
+
+async def cancel_broadcast(db: AsyncSession, broadcast_id: int) -> bool:
+    """取消未完成的群发。执行者在写下一个检查点时发现并停止。"""
+    now = _utc_now_naive()
+    result = await db.execute(
+        update(models.Broadcast)
+        .where(
+            models.Broadcast.id == broadcast_id,
+            models.Broadcast.status.in_([models.BroadcastStatus.PENDING, models.BroadcastStatus.RUNNING])
+        )
+        .values(status=models.BroadcastStatus.CANCELLED, finished_at=now, updated_at=now)
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+async def reopen_broadcast(db: AsyncSession, broadcast_id: int) -> bool:
+    """把已取消的群发重新设为 PENDING，从检查点继续发送。"""
+    result = await db.execute(
+        update(models.Broadcast)
+        .where(models.Broadcast.id == broadcast_id, models.Broadcast.status == models.BroadcastStatus.CANCELLED)
+        .values(status=models.BroadcastStatus.PENDING, finished_at=None, updated_at=_utc_now_naive())
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+async def get_interrupted_broadcast_ids(db: AsyncSession, stale_seconds: int) -> List[int]:
+    """等待执行的群发，以及执行者已经崩溃 (心跳过期) 的群发。"""
+    stale_before = _utc_now_naive() - datetime.timedelta(seconds=stale_seconds)
+    result = await db.execute(
+        select(models.Broadcast.id)
+        .where(or_(
+            models.Broadcast.status == models.BroadcastStatus.PENDING,
+            and_(
+                models.Broadcast.status == models.BroadcastStatus.RUNNING,
+                or_(models.Broadcast.heartbeat_at.is_(None), models.Broadcast.heartbeat_at < stale_before)
+            )
+        ))
+        .order_by(models.Broadcast.id)
+    )
+    return list(result.scalars().all())
+
+
+# --- UploadSession CRUD ---
+
+async def create_upload_session(db: AsyncSession, upload_id: str, user_id: int,
+                                upload_create: models.UploadSessionCreate) -> models.UploadSession:
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    upload_session = models.UploadSession.model_validate(
+        upload_create,
+        update={
+            "id": upload_id, "user_id": user_id, "offset": 0,
+            "created_at": current_utc_naive, "updated_at": current_utc_naive
+        }
+    )
+    db.add(upload_session)
+    await db.commit()
+    await db.refresh(upload_session)
+    return upload_session
+
+
+async def get_upload_session(db: AsyncSession, upload_id: str, lock: bool = False) -> Optional[models.UploadSession]:
+    """
+    获取上传会话。lock=True 时对该行加锁 (NOWAIT)，同一上传的并发写入会立即失败而不是排队等待。
+    """
+    statement = select(models.UploadSession).where(models.UploadSession.id == upload_id)
+    if lock:
+        statement = statement.with_for_update(nowait=True)
+    result = await db.execute(statement)
+    return result.scalars().first()
+
+
+async def lease_upload_session(db: AsyncSession, upload_id: str, user_id: int, lease_id: str,
+                               lease_seconds: int) -> Optional[Row]:
+    """
+    为一次 PATCH 获取上传会话的写入租约，返回 (offset, total_size)。
+    条件 UPDATE 后立即提交，之后的流式写入不占用事务和数据库连接。
+    会话不存在、不属于该用户或租约仍被其他请求持有时返回 None。
+    """
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    result = await db.execute(
+        update(models.UploadSession)
+        .where(
+            models.UploadSession.id == upload_id,
+            models.UploadSession.user_id == user_id,
+            or_(models.UploadSession.lease_expires_at.is_(None),
+                models.UploadSession.lease_expires_at < current_utc_naive)
+        )
+        .values(
+            lease_id=lease_id,
+            lease_expires_at=current_utc_naive + datetime.timedelta(seconds=lease_seconds),
+            updated_at=current_utc_naive
+        )
+        .returning(models.UploadSession.offset, models.UploadSession.total_size)
+    )
+    lease = result.first()
+    await db.commit()
+    return lease
+
+
+async def commit_upload_chunk(db: AsyncSession, upload_id: str, lease_id: str, old_offset: int,
+                              new_offset: int) -> bool:
+    """
+    分块写入完成后推进 offset 并释放租约。
+    只有租约仍属于本次请求且 offset 没有被改动时才会更新；返回是否更新成功。
+    """
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    result = await db.execute(
+        update(models.UploadSession)
+        .where(
+            models.UploadSession.id == upload_id,
+            models.UploadSession.lease_id == lease_id,
+            models.UploadSession.offset == old_offset
+        )
+        .values(offset=new_offset, lease_id=None, lease_expires_at=None, updated_at=current_utc_naive)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def release_upload_lease(db: AsyncSession, upload_id: str, lease_id: str):
+    """放弃写入租约 (分块被拒绝或写入失败)，offset 保持不变。"""
+    await db.execute(
+        update(models.UploadSession)
+        .where(models.UploadSession.id == upload_id, models.UploadSession.lease_id == lease_id)
+        .values(lease_id=None, lease_expires_at=None)
+    )
+    await db.commit()
+
+
+def is_upload_leased(upload_session: models.UploadSession) -> bool:
+    """是否有 PATCH 请求正持有未过期的写入租约。"""
+    current_utc_naive = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return upload_session.lease_expires_at is not None and upload_session.lease_expires_at > current_utc_naive
+
+
+async def delete_upload_session(db: AsyncSession, upload_session: models.UploadSession):
+    await db.delete(upload_session)
+    await db.commit()
+
+
+async def purge_stale_upload_sessions(db: AsyncSession, older_than: datetime.datetime) -> List[str]:
+    """删除长时间没有收到数据的上传会话，返回被删除的会话ID，供调用方清理磁盘上的临时文件。"""
+    result = await db.execute(
+        delete(models.UploadSession)
+        .where(models.UploadSession.updated_at < older_than)
+        .returning(models.UploadSession.id)
+    )
+    await db.commit()
+    return list(result.scalars().all())
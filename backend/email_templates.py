@@ -0,0 +1,229 @@
+﻿# backend/email_templates.py
+"""
+预编译的邮件模板。
+
+原先每个 send_*_email 函数每次发送都用 f-string 重新拼一遍完整 HTML (三份重复的 CSS)，并多次读取配置。
+这里改为在启动时 (或首次发送时) 从 templates/email/ 读取模板并编译一次：
+- layout.html / layout.txt 是公共外框，各邮件只写正文片段；
+- style.css 在编译时内联到各元素的 style 属性 (很多邮件客户端会忽略 <style> 标签)，只支持 tag 和 .class 选择器；
+- 站点级的值 (站点名、前端地址、重置链接有效期) 在编译时代入，模板按剩下的用户名、令牌等变量切分成片段，
+  发送时只需把变量填入片段再拼接一次；
+- 同时生成纯文本版本，发送 multipart/alternative 邮件。
+模板使用 string.Template 语法 (${name})，模板中不要出现其他 $ 字符。
+修改配置后调用 email_templates.reload()，下次发送时按新配置重新编译。
+"""
+import html
+import logging
+import re
+from pathlib import Path
+from string import Template
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from backend.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TEMPLATE_DIR = Path(__file__).resolve().parent / "templates" / "email"
+
+# 邮件名称 -> 主题模板 (主题不转义，发送时提供的主题变量不能包含换行)
+EMAIL_SUBJECTS: Dict[str, str] = {
+    "verification": "${site_name} - 邮箱验证",
+    "password_reset": "${site_name} - 密码重置请求",
+    "account_deletion": "【${site_name}】账户删除通知",
+    "broadcast": "【${site_name}】${subject}",
+}
+
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_RULE_RE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+_OPEN_TAG_RE = re.compile(r"<([a-zA-Z][a-zA-Z0-9]*)((?:\s[^<>]*?)?)(/?)>")
+_ATTR_RE_TEMPLATE = r'\s{name}\s*=\s*"([^"]*)"'
+
+
+class CompiledTemplate(NamedTuple):
+    """切分好的模板：parts 是文本片段，slots 中的 (下标, 变量名) 表示 parts 中需要填入变量的位置。"""
+    parts: Tuple[Optional[str], ...]
+    slots: Tuple[Tuple[int, str], ...]
+
+    @classmethod
+    def from_template(cls, source: str) -> "CompiledTemplate":
+        parts: List[Optional[str]] = []
+        slots: List[Tuple[int, str]] = []
+        literal = []
+        position = 0
+        for match in Template.pattern.finditer(source):
+            literal.append(source[position:match.start()])
+            position = match.end()
+            if match.group("escaped") is not None:
+                literal.append("$")
+                continue
+            name = match.group("named") or match.group("braced")
+            if name is None:
+                raise ValueError(f"邮件模板中有无效的占位符: {match.group(0)!r}")
+            parts.append("".join(literal))
+            literal = []
+            slots.append((len(parts), name))
+            parts.append(None)
+        parts.append(source[position:] if not literal else "".join(literal) + source[position:])
+        return cls(parts=tuple(parts), slots=tuple(slots))
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(name for _, name in self.slots))
+
+    def render(self, values: Dict[str, str]) -> str:
+        # 比 Template.substitute (逐个正则回调) 和 str.format_map (每次重新解析格式串) 都快得多
+        out = list(self.parts)
+        for index, name in self.slots:
+            out[index] = values[name]
+        return "".join(out)
+
+
+class CompiledEmail(NamedTuple):
+    subject: CompiledTemplate
+    html: CompiledTemplate
+    text: CompiledTemplate
+    fields: Tuple[str, ...]  # 发送时需要提供的变量
+
+
+def _parse_css(css: str) -> List[Tuple[str, str, List[Tuple[str, str]]]]:
+    """把样式表解析为 [(选择器类型 'tag'/'class', 名称, [(属性, 值), ...]), ...]，保持原有顺序。"""
+    rules = []
+    for selectors, body in _CSS_RULE_RE.findall(_CSS_COMMENT_RE.sub("", css)):
+        declarations = []
+        for declaration in body.split(";"):
+            name, _, value = declaration.partition(":")
+            if name.strip() and value.strip():
+                declarations.append((name.strip(), value.strip()))
+        for selector in selectors.split(","):
+            selector = selector.strip()
+            if re.fullmatch(r"\.[\w-]+", selector):
+                rules.append(("class", selector[1:], declarations))
+            elif re.fullmatch(r"[a-zA-Z][a-zA-Z0-9]*", selector):
+                rules.append(("tag", selector.lower(), declarations))
+            else:
+                logger.warning(f"邮件样式表中不支持的选择器已忽略: {selector}")
+    return rules
+
+
+def inline_css(markup: str, css: str) -> str:
+    """
+    把样式表内联到匹配元素的 style 属性中。
+    优先级：标签选择器 < 类选择器 < 元素原有的 style 属性；同一优先级内后出现的规则覆盖先出现的。
+    """
+    rules = _parse_css(css)
+    tag_rules = [rule for rule in rules if rule[0] == "tag"]
+    class_rules = [rule for rule in rules if rule[0] == "class"]
+
+    def _attr(attrs: str, name: str) -> Optional[str]:
+        match = re.search(_ATTR_RE_TEMPLATE.format(name=name), attrs)
+        return match.group(1) if match else None
+
+    def _replace(match: re.Match) -> str:
+        tag, attrs, self_closing = match.group(1), match.group(2), match.group(3)
+        classes = set((_attr(attrs, "class") or "").split())
+        merged: Dict[str, str] = {}
+        for _, name, declarations in tag_rules:
+            if name == tag.lower():
+                merged.update(declarations)
+        for _, name, declarations in class_rules:
+            if name in classes:
+                merged.update(declarations)
+        if not merged:
+            return match.group(0)
+        existing = _attr(attrs, "style")
+        if existing:
+            for declaration in existing.split(";"):
+                name, _, value = declaration.partition(":")
+                if name.strip() and value.strip():
+                    merged[name.strip()] = value.strip()
+            attrs = re.sub(_ATTR_RE_TEMPLATE.format(name="style"), "", attrs)
+        style = "; ".join(f"{name}: {value}" for name, value in merged.items())
+        return f'<{tag}{attrs} style="{style}"{self_closing}>'
+
+    return _OPEN_TAG_RE.sub(_replace, markup)
+
+
+def _read_template(name: str) -> str:
+    # 模板文件可能带 BOM
+    return (EMAIL_TEMPLATE_DIR / name).read_text(encoding="utf-8-sig")
+
+
+class EmailTemplates:
+    """编译后的邮件模板集合。compile 读取模板文件并代入站点级变量；render 只需填入变量并拼接片段。"""
+
+    def __init__(self):
+        self._compiled: Optional[Dict[str, CompiledEmail]] = None
+        self._renders = 0
+        self._compilations = 0
+
+    def compile(self, site_name: str, frontend_base_url: str, reset_minutes: int) -> Dict[str, CompiledEmail]:
+        """读取并编译全部邮件模板。模板文件有误时直接抛出异常 (启动时调用可以尽早发现问题)。"""
+        layout_html = Template(_read_template("layout.html"))
+        layout_text = Template(_read_template("layout.txt"))
+        css = _read_template("style.css")
+        html_values = {
+            "site_name": html.escape(site_name),
+            "frontend_base_url": html.escape(frontend_base_url),
+            "reset_minutes": str(reset_minutes),
+        }
+        text_values = {"site_name": site_name, "frontend_base_url": frontend_base_url,
+                       "reset_minutes": str(reset_minutes)}
+
+        compiled = {}
+        for name, subject in EMAIL_SUBJECTS.items():
+            body_html = layout_html.safe_substitute(content=_read_template(f"{name}.html").rstrip("\n"))
+            body_text = layout_text.safe_substitute(content=_read_template(f"{name}.txt").strip("\n"))
+            html_template = CompiledTemplate.from_template(
+                Template(inline_css(body_html, css)).safe_substitute(html_values))
+            text_template = CompiledTemplate.from_template(Template(body_text).safe_substitute(text_values))
+            subject_template = CompiledTemplate.from_template(Template(subject).safe_substitute(site_name=site_name))
+            compiled[name] = CompiledEmail(
+                subject=subject_template,
+                html=html_template,
+                text=text_template,
+                fields=tuple(sorted({*subject_template.fields, *html_template.fields, *text_template.fields})),
+            )
+        self._compiled = compiled
+        self._compilations += 1
+        logger.info(f"已编译 {len(compiled)} 个邮件模板。")
+        return compiled
+
+    def load(self) -> Dict[str, CompiledEmail]:
+        """按当前配置编译模板 (已编译时直接返回)。"""
+        if self._compiled is None:
+            settings = get_settings()
+            self.compile(
+                site_name=settings.MAIL_FROM_NAME,
+                frontend_base_url=settings.PORTAL_FRONTEND_BASE_URL,
+                reset_minutes=settings.PASSWORD_RESET_TOKEN_MAX_AGE_SECONDS // 60,
+            )
+        return self._compiled
+
+    def reload(self):
+        """丢弃已编译的模板，下次发送时按新配置重新编译。"""
+        self._compiled = None
+
+    def render(self, name: str, **values: str) -> Tuple[str, str, str]:
+        """返回 (主题, HTML 正文, 纯文本正文)。values 中的值在 HTML 版本中会被转义。"""
+        email = self.load()[name]
+        missing = [field for field in email.fields if field not in values]
+        if missing:
+            raise KeyError(f"邮件模板 {name} 缺少变量: {', '.join(missing)}")
+        self._renders += 1
+        return (
+            email.subject.render(values),
+            email.html.render({key: html.escape(str(value)) for key, value in values.items()}),
+            email.text.render(values),
+        )
+
+    def stats(self) -> dict:
+        return {
+            "compiled": self._compiled is not None,
+            "templates": sorted(self._compiled) if self._compiled is not None else [],
+            "compilations": self._compilations,
+            "renders": self._renders,
+        }
+
+
+# 进程内唯一实例 (API 进程和任务队列 worker 进程各自一个)
+email_templates = EmailTemplates()
@@ -0,0 +1,114 @@
+﻿# backend/file_reaper.py
+"""
+后台删除上传文件。
+
+删除用户或作品时，数据库事务提交后需要从磁盘删除不再被引用的文件。文件可能有成百上千个，
+逐个 unlink 会让请求的耗时随文件数量增长 (原先删除用户时还是在事件循环里同步删除的)。
+这里改为：请求只把文件 URL 交给 file_reaper 就返回，由一个后台协程在线程池中分批删除。
+
+内容寻址的文件 (media/ab/cd/<sha256>...) 可能在引用归零之后、删除之前被同一内容的新上传重新使用，
+因此删除前持有该摘要的 advisory lock 并确认 MediaBlob 仍不存在 (见 crud.lock_media_content)。
+
+进程在删除完成前退出时，剩下的孤儿文件由 storage_gc 定期对账时回收。
+"""
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from backend import crud
+from backend.database import AsyncSessionLocal
+from backend.upload_storage import media_digest, remove_upload_files
+
+logger = logging.getLogger(__name__)
+
+# 每次交给线程池删除的文件数
+REAP_BATCH_SIZE = 200
+
+
+class FileReaper:
+    """后台删除文件的队列。首次提交时在当前事件循环中自动启动。"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._submitted = 0
+        self._removed = 0
+        self._errors = 0
+
+    def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._worker())
+
+    def submit(self, upload_dir: Path, urls: Iterable[Optional[str]]):
+        """提交一组待删除的 /uploads/... URL，立即返回。必须在数据库事务提交之后调用。"""
+        urls = [url for url in urls if url]
+        if not urls:
+            return
+        self.start()
+        self._submitted += len(urls)
+        for start in range(0, len(urls), REAP_BATCH_SIZE):
+            self._queue.put_nowait((upload_dir, urls[start:start + REAP_BATCH_SIZE]))
+
+    async def _worker(self):
+        while True:
+            upload_dir, urls = await self._queue.get()
+            try:
+                self._removed += await self._remove(upload_dir, urls)
+            except Exception as e:
+                self._errors += 1
+                logger.error(f"后台删除 {len(urls)} 个文件失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _remove(self, upload_dir: Path, urls: List[str]) -> int:
+        by_digest: Dict[str, List[str]] = {}
+        other_urls = []
+        for url in urls:
+            digest = media_digest(url[len("/uploads/"):]) if url.startswith("/uploads/") else None
+            if digest is not None:
+                by_digest.setdefault(digest, []).append(url)
+            else:
+                other_urls.append(url)
+        removed = await run_in_threadpool(remove_upload_files, upload_dir, other_urls) if other_urls else 0
+        if not by_digest:
+            return removed
+        async with AsyncSessionLocal() as session:
+            await crud.lock_media_content(db=session, hashes=by_digest.keys())
+            live_hashes = await crud.find_existing_media_hashes(db=session, hashes=sorted(by_digest))
+            removable = [url for digest, digest_urls in by_digest.items() if digest not in live_hashes
+                         for url in digest_urls]
+            if len(removable) < sum(len(digest_urls) for digest_urls in by_digest.values()):
+                logger.info(f"{len(live_hashes)} 个内容已被重新上传，保留其文件。")
+            removed += await run_in_threadpool(remove_upload_files, upload_dir, removable)
+            await session.commit()  # 释放锁
+        return removed
+
+    async def shutdown(self, timeout: float = 30.0):
+        """等待队列中的文件删除完毕 (最多 timeout 秒)。"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"关闭时仍有 {self._queue.qsize()} 批文件未删除，将由存储回收任务清理。")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._queue = None
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "pending_batches": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self._submitted,
+            "removed": self._removed,
+            "errors": self._errors,
+        }
+
+
+# 进程内唯一实例
+file_reaper = FileReaper()
@@ -0,0 +1,33 @@
+﻿# backend/http_cache.py
+"""HTTP 条件请求 (ETag / If-None-Match) 的公共工具函数。"""
+import hashlib
+from typing import Optional
+
+from fastapi import Response, status
+
+
+def make_etag(*parts, weak: bool = False) -> str:
+    """由若干部分计算 ETag (带引号)。同样的输入总是得到同样的 ETag。"""
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:32]
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按 RFC 9110 的弱比较判断 If-None-Match 是否命中 (GET/HEAD 的 304 判断使用弱比较)。"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def not_modified_response(etag: str, headers: Optional[dict] = None) -> Response:
+    """304 响应，只带 ETag 和缓存相关的响应头，没有响应体。"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={**(headers or {}), "ETag": etag})
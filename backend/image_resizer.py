@@ -0,0 +1,341 @@
+﻿# backend/image_resizer.py
+"""
+按需缩放图片 (/img/...)。
+
+缩放和编码在独立进程池中执行；同一时刻对同一结果的多个请求只会渲染一次；
+渲染结果写入有容量上限的磁盘缓存。缓存目录由所有 worker 进程共享，以文件系统为准 (进程内不维护索引)：
+- 命中：检查文件是否存在，文件被其他进程淘汰时重新渲染；命中时刷新文件的修改时间作为最近使用时间；
+- 淘汰：扫描缓存目录，总大小超过上限时按修改时间从旧到新删除，容量上限对所有 worker 合计生效；
+  最近使用过的文件 (修改时间在 EVICTION_GRACE_SECONDS 内) 不会被删除，正在发送的响应不会读到已删除的文件。
+请求的尺寸和质量先归整到固定的档位 (quantize_dimension / quantize_quality)，每张原图可能的输出数量有上限。
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image as PILImage
+from PIL import ImageOps
+from PIL.Image import Resampling
+
+logger = logging.getLogger(__name__)
+
+# 输出格式 -> (Pillow 编码器名称, 文件扩展名, Content-Type)
+OUTPUT_FORMATS = {
+    "avif": ("AVIF", ".avif", "image/avif"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "png": ("PNG", ".png", "image/png"),
+}
+# 可以作为缩放源的原图扩展名 (视频等其他文件不处理)
+SOURCE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+# 源文件带透明通道的可能性较大，协商不到 WebP/AVIF 时退回 PNG 而不是 JPEG
+ALPHA_SOURCE_SUFFIXES = {".png", ".gif", ".webp"}
+
+# 命中的缓存文件最多每隔这么久刷新一次修改时间 (LRU 以修改时间作为最近使用时间，不依赖可能被关闭的 atime)
+TOUCH_INTERVAL_SECONDS = 300
+# 修改时间在这段时间内的文件不淘汰 (必须大于 TOUCH_INTERVAL_SECONDS)：刚命中或刚写入的文件可能正在被响应读取
+EVICTION_GRACE_SECONDS = 900
+# 超出容量时淘汰到上限的这个比例，避免每写入一个文件就淘汰一次
+EVICTION_LOW_WATER = 0.9
+# 本进程写入过文件时至少每隔这么久扫描一次缓存目录 (其他 worker 写入的文件只有扫描时才能计入)
+SWEEP_INTERVAL_SECONDS = 300
+
+
+class ImageResizerBusy(Exception):
+    """等待渲染的任务已达上限 (或缩放引擎未启动)。"""
+
+
+def encoder_available(fmt: str) -> bool:
+    """当前 Pillow 是否能编码该格式 (AVIF 需要额外的插件或较新的 Pillow)。"""
+    PILImage.init()
+    return fmt in OUTPUT_FORMATS and OUTPUT_FORMATS[fmt][0] in PILImage.SAVE
+
+
+def negotiate_format(accept: Optional[str], requested: Optional[str], source_suffix: str) -> Tuple[str, bool]:
+    """
+    决定输出格式，返回 (格式, 是否根据 Accept 协商得出)。
+    明确指定了 fmt 时直接使用；否则按 AVIF > WebP > 原图类型的顺序挑选客户端声明支持的格式。
+    """
+    if requested and requested != "auto":
+        return requested, False
+    accept = (accept or "").lower()
+    if "image/avif" in accept and encoder_available("avif"):
+        return "avif", True
+    if "image/webp" in accept and encoder_available("webp"):
+        return "webp", True
+    return ("png" if source_suffix.lower() in ALPHA_SOURCE_SUFFIXES else "jpeg"), True
+
+
+def quantize_dimension(value: Optional[int], steps: List[int], max_dimension: int) -> Optional[int]:
+    """把请求的宽或高向上归整到档位 (不小于请求值的最小档位)，超过所有档位时使用 max_dimension。"""
+    if not value:
+        return None
+    for step in steps:
+        if value <= step <= max_dimension:
+            return step
+    return max_dimension
+
+
+def quantize_quality(value: int, steps: List[int]) -> int:
+    """把请求的编码质量归整到最接近的档位。"""
+    return min(steps, key=lambda step: (abs(step - value), -step)) if steps else value
+
+
+# --- 渲染函数 (在独立进程中执行，因此必须是模块级函数) ---
+
+def render_resized_image(
+        source_path: Path,
+        destination: Path,
+        width: Optional[int],
+        height: Optional[int],
+        max_dimension: int,
+        fmt: str,
+        quality: int
+) -> int:
+    """
+    把原图等比缩放到 width x height 的范围内 (不放大)，编码为 fmt 并写入 destination，返回文件大小。
+    先写入临时文件再重命名，读取缓存的请求不会读到写了一半的文件。
+    """
+    box = (min(width or max_dimension, max_dimension), min(height or max_dimension, max_dimension))
+    encoder, _, _ = OUTPUT_FORMATS[fmt]
+    with PILImage.open(source_path) as img:
+        # JPEG 按接近目标尺寸的比例解码；EXIF 旋转可能交换宽高，因此两个方向都取较大值
+        img.draft("RGB", (max(box), max(box)))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(box, Resampling.LANCZOS)
+        if encoder == "JPEG":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = destination.with_name(f"{destination.name}.{os.getpid()}.tmp")
+        save_options = {"optimize": True} if encoder == "PNG" else {"quality": quality}
+        img.save(temp_path, encoder, **save_options)
+    os.replace(temp_path, destination)
+    return destination.stat().st_size
+
+
+def lookup_cached_file(path: Path) -> bool:
+    """缓存文件存在时返回 True，并在上次刷新已超过 TOUCH_INTERVAL_SECONDS 时刷新其修改时间。"""
+    try:
+        mtime = path.stat().st_mtime
+        if time.time() - mtime > TOUCH_INTERVAL_SECONDS:
+            os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def sweep_cache(cache_dir: Path, max_bytes: int) -> Tuple[int, int, int]:
+    """
+    扫描缓存目录，总大小超过 max_bytes 时按修改时间从旧到新删除到 max_bytes * EVICTION_LOW_WATER 以下
+    (跳过 EVICTION_GRACE_SECONDS 内使用过的文件)，顺便清理残留的临时文件。
+    多个进程可能同时扫描，文件已被其他进程删除时按已删除计。返回 (剩余字节数, 剩余文件数, 删除的文件数)。
+    """
+    now = time.time()
+    entries = []
+    total = 0
+    for directory in os.scandir(cache_dir):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    if now - stat.st_mtime > EVICTION_GRACE_SECONDS:
+                        os.unlink(entry.path)  # 渲染进程退出时没写完的临时文件
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+            total += stat.st_size
+
+    removed = 0
+    if total > max_bytes:
+        target = max_bytes * EVICTION_LOW_WATER
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= target or now - mtime < EVICTION_GRACE_SECONDS:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"删除缓存文件 {path} 失败: {e}")
+                continue
+            total -= size
+            removed += 1
+    return total, len(entries) - removed, removed
+
+
+class ImageResizer:
+    """
+    按需缩放引擎：进程池 + 请求合并 + 共享的磁盘 LRU 缓存。
+    缓存键由原图路径、修改时间、大小和缩放参数决定，原图被替换后旧的缓存自然失效，最终被淘汰。
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._cache_dir: Optional[Path] = None
+        self._max_cache_bytes = 0
+        self._max_pending = 0
+        self._max_dimension = 0
+        # 最近一次扫描得到的缓存大小和文件数，加上之后本进程写入的字节数
+        self._cache_bytes = 0
+        self._cached_files = 0
+        self._last_sweep = 0.0
+        self._written_since_sweep = 0
+        self._sweeping = False
+        # 正在渲染的任务，同一个 key 的并发请求共享同一个 Future
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._sweeps = 0
+        self._rejected = 0
+        self._failed = 0
+
+    def start(self, max_workers: int, max_pending: int, cache_dir: Path, max_cache_bytes: int, max_dimension: int):
+        """创建进程池，并扫描一次缓存目录 (超出容量时淘汰)。"""
+        if self._executor is not None:
+            return
+        self._cache_dir = cache_dir
+        self._max_cache_bytes = max_cache_bytes
+        self._max_pending = max_pending
+        self._max_dimension = max_dimension
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._apply_sweep(sweep_cache(cache_dir, max_cache_bytes))
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(
+            f"图片缩放引擎已启动: {max_workers} 个工作进程, 缓存 {self._cached_files} 个文件 "
+            f"({self._cache_bytes / 1024 / 1024:.1f}MB / {max_cache_bytes / 1024 / 1024:.0f}MB)"
+        )
+
+    async def shutdown(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown, True)
+        logger.info("图片缩放引擎已关闭。")
+
+    @property
+    def max_dimension(self) -> int:
+        return self._max_dimension
+
+    @staticmethod
+    def cache_key(source_path: Path, source_stat: os.stat_result, width: Optional[int], height: Optional[int],
+                  fmt: str, quality: int) -> str:
+        """缓存键 (同时用作强 ETag)：相同的原图版本和参数总是得到相同的输出。"""
+        raw = f"{source_path}|{source_stat.st_mtime_ns}|{source_stat.st_size}|{width}|{height}|{fmt}|{quality}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def render(self, key: str, source_path: Path, width: Optional[int], height: Optional[int],
+                     fmt: str, quality: int) -> Path:
+        """
+        返回缩放结果的缓存文件路径；缓存文件不存在 (未渲染过或已被任一进程淘汰) 时在进程池中渲染，
+        同一个 key 的并发请求只渲染一次。
+        """
+        destination = self._cache_dir / key[:2] / f"{key}{OUTPUT_FORMATS[fmt][1]}"
+        future = self._inflight.get(key)
+        if future is not None:
+            self._coalesced += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, lookup_cached_file, destination):
+            self._hits += 1
+            return destination
+
+        future = self._inflight.get(key)  # 检查文件期间可能已有其他请求开始渲染
+        if future is not None:
+            self._coalesced += 1
+            return await asyncio.shield(future)
+        if self._executor is None or len(self._inflight) >= self._max_pending:
+            self._rejected += 1
+            raise ImageResizerBusy()
+
+        self._misses += 1
+        render_future = loop.run_in_executor(
+            self._executor, render_resized_image,
+            source_path, destination, width, height, self._max_dimension, fmt, quality
+        )
+        future = loop.create_future()
+        self._inflight[key] = future
+
+        def _on_done(fut: asyncio.Future):
+            # 放在回调里而不是 await 之后：发起请求的客户端断开时，写入的字节数仍然会被计入
+            self._inflight.pop(key, None)
+            if fut.cancelled():
+                self._failed += 1
+                future.cancel()
+                return
+            if fut.exception() is not None:
+                self._failed += 1
+                logger.error(f"图片缩放失败 ({source_path.name}): {fut.exception()!r}")
+                future.set_exception(fut.exception())
+                return
+            self._written_since_sweep += fut.result()
+            self._cached_files += 1
+            self._maybe_sweep()
+            future.set_result(destination)
+
+        render_future.add_done_callback(_on_done)
+        return await asyncio.shield(future)
+
+    def _maybe_sweep(self):
+        """本进程估算的缓存大小超出上限，或距上次扫描已超过 SWEEP_INTERVAL_SECONDS 时，在线程池中扫描淘汰。"""
+        if self._sweeping:
+            return
+        over_capacity = self._cache_bytes + self._written_since_sweep > self._max_cache_bytes
+        if not over_capacity and time.monotonic() - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return
+        self._sweeping = True
+        self._written_since_sweep = 0
+        sweep_future = asyncio.get_running_loop().run_in_executor(
+            None, sweep_cache, self._cache_dir, self._max_cache_bytes)
+
+        def _on_swept(fut: asyncio.Future):
+            self._sweeping = False
+            if fut.cancelled() or fut.exception() is not None:
+                logger.error(f"扫描图片缓存失败: {fut.exception() if not fut.cancelled() else '已取消'}")
+                return
+            self._apply_sweep(fut.result())
+
+        sweep_future.add_done_callback(_on_swept)
+
+    def _apply_sweep(self, result: Tuple[int, int, int]):
+        self._cache_bytes, self._cached_files, removed = result
+        self._evictions += removed
+        self._sweeps += 1
+        self._last_sweep = time.monotonic()
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses + self._coalesced
+        return {
+            "running": self._executor is not None,
+            "inflight": len(self._inflight),
+            "max_pending": self._max_pending,
+            "cached_files": self._cached_files,
+            "cache_bytes": self._cache_bytes + self._written_since_sweep,
+            "max_cache_bytes": self._max_cache_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "evictions": self._evictions,
+            "sweeps": self._sweeps,
+            "rejected": self._rejected,
+            "failed": self._failed,
+            "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,88 @@
+﻿# backend/invalidation.py
+"""
+基于 Postgres LISTEN/NOTIFY 的跨进程缓存失效。
+
+每个 worker 进程持有一条专用的 asyncpg 连接 (不占用 SQLAlchemy 连接池)，LISTEN 若干频道；
+写操作在数据库中执行 pg_notify(频道, payload)，所有 worker (包括自己) 都会收到并调用对应的处理函数。
+连接断开后自动重连；重连成功时调用 on_reconnect (断开期间的通知已经丢失，调用方应清空或重新加载相关缓存)，
+on_reconnect 可以是普通函数或协程函数。
+"""
+import asyncio
+import inspect
+import logging
+from typing import Callable, Dict, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY_SECONDS = 5
+
+
+class InvalidationListener:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._connected = False
+        self._received = 0
+        self._reconnects = 0
+
+    def start(self, dsn: str, handlers: Dict[str, Callable[[str], None]], on_reconnect: Callable[[], None]):
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(dsn, handlers, on_reconnect))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self, dsn: str, handlers: Dict[str, Callable[[str], None]], on_reconnect: Callable[[], None]):
+        first_attempt = True
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                for channel, handler in handlers.items():
+                    await connection.add_listener(channel, self._make_callback(handler))
+                self._connected = True
+                if not first_attempt:
+                    self._reconnects += 1
+                    result = on_reconnect()
+                    if inspect.isawaitable(result):
+                        await result
+                logger.info(f"缓存失效监听已连接: {', '.join(handlers)}")
+                await closed.wait()
+                logger.warning("缓存失效监听连接已断开，稍后重连。")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"缓存失效监听连接失败: {e}")
+            finally:
+                self._connected = False
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            # 断开期间可能漏掉通知，下次连接成功后需要清空缓存
+            first_attempt = False
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    def _make_callback(self, handler: Callable[[str], None]):
+        def _callback(connection, pid, channel, payload):
+            self._received += 1
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"处理缓存失效通知失败 ({channel}): {e}")
+        return _callback
+
+    def stats(self) -> dict:
+        return {"connected": self._connected, "received": self._received, "reconnects": self._reconnects}
+
+
+invalidation_listener = InvalidationListener()
@@ -0,0 +1,244 @@
+﻿# backend/mail_transport.py
+"""
+异步 SMTP 发送通道。
+
+原先每封邮件都在事件循环里调用阻塞的 smtplib，重新建立 TLS 连接并登录一次，最长会卡住整个进程 15 秒。
+这里改为：
+- 发件箱 (asyncio.Queue)：send 把邮件放入队列并等待投递结果，不阻塞事件循环；
+- 连接池：MAIL_POOL_SIZE 个发送协程，每个持有一条已登录的 aiosmtplib 连接，成批取出队列中的邮件在同一会话中连续发送，
+  单条连接发送 MAIL_MAX_MESSAGES_PER_CONNECTION 封后重新连接 (多数服务器限制单个会话的邮件数)，空闲超时后主动断开；
+- 重试：连接断开、超时和 4xx 临时错误按指数退避重新入队，最多 MAIL_MAX_RETRIES 次；5xx 等永久错误直接失败。
+
+本地测试时可以运行 python -m benchmarks.smtp_sink 启动一个只收不发的 SMTP 服务器，
+并设置 MAIL_SERVER=127.0.0.1, MAIL_PORT=8025, MAIL_STARTTLS=false, MAIL_SSL_TLS=false, MAIL_USE_CREDENTIALS=false。
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from typing import List, Optional
+
+import aiosmtplib
+
+from backend.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# 连接层面的错误：丢弃当前连接，邮件重新入队
+_CONNECTION_ERRORS = (
+    aiosmtplib.SMTPServerDisconnected,
+    aiosmtplib.SMTPConnectError,
+    aiosmtplib.SMTPTimeoutError,
+    asyncio.TimeoutError,
+    OSError,
+)
+
+
+@dataclass
+class _OutboxItem:
+    message: EmailMessage
+    future: asyncio.Future
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """连接错误和 4xx 响应视为临时错误，可以重试；其他 (例如 5xx、收件人被拒绝) 视为永久错误。"""
+    if isinstance(error, _CONNECTION_ERRORS):
+        return True
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(400 <= recipient.code < 500 for recipient in error.recipients)
+    if isinstance(error, aiosmtplib.SMTPResponseException):
+        return 400 <= error.code < 500
+    return False
+
+
+class MailTransport:
+    """带连接池和发件箱的异步邮件发送通道。首次发送时在当前事件循环中自动启动。"""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._retry_tasks: "set[asyncio.Task]" = set()
+        self._open_connections = 0
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._connections_opened = 0
+        self._batches = 0
+        self._total_latency_seconds = 0.0
+
+    @property
+    def started(self) -> bool:
+        return self._queue is not None
+
+    def start(self):
+        if self._queue is not None:
+            return
+        settings = get_settings()
+        self._queue = asyncio.Queue(maxsize=settings.MAIL_OUTBOX_SIZE)
+        self._workers = [asyncio.create_task(self._worker(index)) for index in range(settings.MAIL_POOL_SIZE)]
+        logger.info(f"邮件发送通道已启动: {settings.MAIL_POOL_SIZE} 条 SMTP 连接, 发件箱上限 {settings.MAIL_OUTBOX_SIZE}")
+
+    async def shutdown(self, timeout: float = 30.0):
+        """等待发件箱中的邮件发送完毕 (最多 timeout 秒)，然后关闭所有连接。"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"关闭邮件发送通道时仍有 {self._queue.qsize()} 封邮件未发送。")
+        for task in [*self._workers, *self._retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._retry_tasks, return_exceptions=True)
+        # 没来得及发送的邮件通知调用方失败 (任务队列中的邮件任务会按自己的策略重试)
+        while not self._queue.empty():
+            self._abandon(self._queue.get_nowait())
+        self._workers = []
+        self._retry_tasks.clear()
+        self._queue = None
+        logger.info("邮件发送通道已关闭。")
+
+    async def send(self, message: EmailMessage):
+        """把邮件放入发件箱并等待投递完成；最终失败时抛出最后一次的异常。"""
+        self.start()
+        item = _OutboxItem(message=message, future=asyncio.get_running_loop().create_future())
+        await self._queue.put(item)
+        await item.future
+
+    # --- 连接管理 ---
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        settings = get_settings()
+        # MAIL_SSL_TLS: 连接即 TLS (通常是 465 端口)；MAIL_STARTTLS: 明文连接后升级 (通常是 587 端口)
+        client = aiosmtplib.SMTP(
+            hostname=settings.MAIL_SERVER,
+            port=settings.MAIL_PORT,
+            use_tls=settings.MAIL_SSL_TLS,
+            start_tls=settings.MAIL_STARTTLS and not settings.MAIL_SSL_TLS,
+            timeout=settings.MAIL_TIMEOUT_SECONDS,
+        )
+        await client.connect()
+        try:
+            if settings.MAIL_USE_CREDENTIALS:
+                await client.login(settings.MAIL_USERNAME, settings.MAIL_PASSWORD)
+        except BaseException:
+            client.close()
+            raise
+        self._connections_opened += 1
+        self._open_connections += 1
+        return client
+
+    async def _disconnect(self, client: Optional[aiosmtplib.SMTP], graceful: bool = True):
+        if client is None:
+            return
+        self._open_connections -= 1
+        try:
+            if graceful and client.is_connected:
+                await client.quit()
+        except Exception:
+            pass
+        finally:
+            client.close()
+
+    # --- 发送协程 ---
+
+    async def _worker(self, index: int):
+        settings = get_settings()
+        client: Optional[aiosmtplib.SMTP] = None
+        sent_on_connection = 0
+        try:
+            while True:
+                try:
+                    # 空闲一段时间后断开连接，避免服务器端超时踢掉连接后下一封邮件先遇到一次失败
+                    first = await asyncio.wait_for(self._queue.get(), timeout=settings.MAIL_IDLE_TIMEOUT_SECONDS)
+                except asyncio.TimeoutError:
+                    await self._disconnect(client)
+                    client, sent_on_connection = None, 0
+                    first = await self._queue.get()
+
+                batch = [first]
+                while len(batch) < settings.MAIL_BATCH_SIZE and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                self._batches += 1
+
+                for position, item in enumerate(batch):
+                    try:
+                        if item.future.done():  # 调用方已经取消
+                            continue
+                        if client is not None and sent_on_connection >= settings.MAIL_MAX_MESSAGES_PER_CONNECTION:
+                            await self._disconnect(client)
+                            client, sent_on_connection = None, 0
+                        if client is None:
+                            client = await self._connect()
+                        await client.send_message(item.message)
+                        sent_on_connection += 1
+                        self._deliver(item)
+                    except asyncio.CancelledError:
+                        # 关闭通道时本批次中尚未发送的邮件通知调用方失败
+                        for pending in batch[position:]:
+                            self._abandon(pending)
+                        raise
+                    except Exception as e:
+                        if isinstance(e, _CONNECTION_ERRORS):
+                            await self._disconnect(client, graceful=False)
+                            client, sent_on_connection = None, 0
+                        self._handle_failure(item, e)
+                    finally:
+                        self._queue.task_done()
+        finally:
+            await self._disconnect(client, graceful=False)
+
+    def _deliver(self, item: _OutboxItem):
+        self._sent += 1
+        self._total_latency_seconds += time.monotonic() - item.enqueued_at
+        if not item.future.done():
+            item.future.set_result(None)
+
+    def _handle_failure(self, item: _OutboxItem, error: Exception):
+        settings = get_settings()
+        recipients = item.message.get("To")
+        if is_transient_error(error) and item.attempts < settings.MAIL_MAX_RETRIES:
+            item.attempts += 1
+            self._retried += 1
+            delay = settings.MAIL_RETRY_BACKOFF_SECONDS * (2 ** (item.attempts - 1))
+            logger.warning(f"发送邮件至 {recipients} 失败 (第 {item.attempts} 次)，{delay:.1f}s 后重试: {error!r}")
+            task = asyncio.create_task(self._requeue_later(item, delay))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+            return
+        self._failed += 1
+        logger.error(f"发送邮件至 {recipients} 失败，不再重试: {error!r}")
+        if not item.future.done():
+            item.future.set_exception(error)
+
+    async def _requeue_later(self, item: _OutboxItem, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            await self._queue.put(item)
+        except asyncio.CancelledError:
+            self._abandon(item)
+            raise
+
+    def _abandon(self, item: _OutboxItem):
+        if not item.future.done():
+            item.future.set_exception(RuntimeError("邮件发送通道已关闭，邮件未发送"))
+
+    def stats(self) -> dict:
+        return {
+            "running": self.started,
+            "outbox": self._queue.qsize() if self._queue is not None else 0,
+            "pending_retries": len(self._retry_tasks),
+            "open_connections": self._open_connections,
+            "connections_opened": self._connections_opened,
+            "batches": self._batches,
+            "sent": self._sent,
+            "retried": self._retried,
+            "failed": self._failed,
+            "avg_latency_ms": round(self._total_latency_seconds / self._sent * 1000, 2) if self._sent else 0.0,
+        }
+
+
+# 进程内唯一实例 (API 进程和任务队列 worker 进程各自一个)
+mail_transport = MailTransport()
@@ -1,60 +1,127 @@
 ﻿# backend/main.py
+import asyncio
+import base64
 import datetime
+import functools
 import logging
 import shutil
 import sys
+import time
 import uuid
 from contextlib import asynccontextmanager
 from math import ceil
 from pathlib import Path
-from typing import Optional, List  # 导入 Union 用于文件类型提示
+from typing import AsyncIterator, Optional, List  # 导入 Union 用于文件类型提示
 import json
 from fastapi import Request
-import cv2
 import httpx
 import uvicorn
-from PIL import Image as PILImage
-from PIL.Image import Resampling
-from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks, File, UploadFile, Query
+from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks, File, UploadFile, Query, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import selectinload
 from sqlmodel import SQLModel, select, desc  # 确保导入 SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
-from starlette.responses import StreamingResponse
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
 
 from backend import crud, models
 from backend.auth_utils import (
-    get_password_hash,
-    generate_email_verification_token,
+    hash_token,
     verify_email_verification_token,
-    verify_password,
+    verify_password_async,
+    verify_and_update_password_async,
+    password_hasher,
     create_access_token,
     create_refresh_token,
     get_current_active_user,
+    get_current_auth_user,
+    get_current_user_from_token,
     verify_refresh_token_and_get_token_data,
-    generate_password_reset_token,
     verify_password_reset_token, get_current_admin_user
 )
+from backend.auth_cache import AUTH_USER_CHANNEL, AuthUser, auth_user_cache
+from backend.token_cache import TOKEN_REVOCATION_CHANNEL, token_revocation_list, verified_token_cache
+from backend.invalidation import invalidation_listener
+from backend.email_templates import email_templates
+from backend.mail_transport import mail_transport
+from backend.broadcast import broadcast_runner
+from backend.file_reaper import file_reaper
+from backend.media_files import media_files
+from backend.storage_gc import StorageGcBusy, storage_collector
+from backend.avatar_proxy import AvatarNotFound, AvatarProxy
 from backend.core.config import get_settings, clear_settings_cache, Settings
 from backend.crud import get_friend_links
-from backend.database import get_async_session
-from backend.email_utils import send_verification_email, send_password_reset_email, send_account_deletion_email
+from backend.database import get_async_session, AsyncSessionLocal
+from backend.password_hasher import PasswordHasherBusy
+from backend.http_cache import etag_matches, make_etag, not_modified_response
+from backend.response_cache import ENTITY_FRIEND_LINKS, ENTITY_GALLERY, ENTITY_MEMBERS, response_cache
+from backend.image_resizer import (
+    OUTPUT_FORMATS,
+    SOURCE_SUFFIXES,
+    ImageResizer,
+    ImageResizerBusy,
+    encoder_available,
+    negotiate_format,
+    quantize_dimension,
+    quantize_quality
+)
+from backend.thumbnails import (
+    ThumbnailEngine,
+    ThumbnailQueueFull,
+    ThumbnailReservation,
+    ThumbnailVariant,
+    plan_thumbnail_variants,
+    supported_variant_formats,
+    variant_widths_by_name
+)
+from backend.upload_storage import (
+    MIME_EXTENSIONS,
+    UploadRejected,
+    UploadDeadlineExceeded,
+    UploadTooLarge,
+    any_upload_file_missing,
+    append_stream_to_file,
+    content_addressed_path,
+    copy_and_hash,
+    hash_file,
+    move_into_place,
+    purge_stale_files,
+    read_file_head,
+    sniff_mime_type,
+    stream_to_file,
+    upload_path_to_url,
+    upload_url_to_path
+)
+from backend.worker import (
+    EMAIL_SENDERS,
+    JOB_THUMBNAIL,
+    JOB_EMAIL_VERIFICATION,
+    JOB_EMAIL_PASSWORD_RESET,
+    JOB_EMAIL_ACCOUNT_DELETION,
+    JOB_EMAIL_BROADCAST,
+    issue_email_token
+)
 from backend.models import (
     User,
     UserCreate,
     UserRead,
     Token,
     RefreshTokenRequest,
+    TokenData,
     UserPasswordUpdate,
     UserUpdate,
     PasswordResetRequest,
     PasswordResetForm,
     GalleryItemCreate,
-    GalleryItemReadWithBuilder, MemberRead, MemberCreate, MemberUpdate, FriendLinkRead, ItemType, UserRole
+    GalleryItemReadWithBuilder, MemberRead, MemberCreate, MemberUpdate, FriendLinkRead, ItemType, UserRole,
+    UploadSessionCreate,
+    UploadSessionRead,
+    BroadcastCreate,
+    BroadcastRead
 )
 
 # --- 上传文件存储目录定义 ---
@@ -78,13 +145,164 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).parent.parent
 UPLOAD_DIR = PROJECT_ROOT / "backend/uploads"
 SITE_CONFIG_PATH = PROJECT_ROOT / "frontend/public/site-config.json"
+# 可续传上传的临时文件目录 (不在 /uploads 静态目录下，未完成的文件不会被公开访问)
+PARTIAL_UPLOAD_DIR = PROJECT_ROOT / "backend/partial_uploads"
+PARTIAL_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+# --- 缩略图引擎 (独立进程池，在应用生命周期内启动和关闭) ---
+thumbnail_engine = ThumbnailEngine()
+# --- 按需缩放图片的引擎和磁盘缓存目录 ---
+IMAGE_CACHE_DIR = PROJECT_ROOT / "backend/cache/img"
+image_resizer = ImageResizer()
+# --- Minecraft 头像代理的磁盘缓存目录 ---
+AVATAR_CACHE_DIR = PROJECT_ROOT / "backend/cache/avatars"
+avatar_proxy = AvatarProxy()
+
+
+def max_token_lifetime_seconds(settings: Settings) -> int:
+    return max(settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, settings.REFRESH_TOKEN_EXPIRE_DAYS * 86400)
+
+
+async def load_token_revocations():
+    """从数据库加载吊销记录到内存 (启动时，以及失效监听重连后补上断开期间错过的吊销)。"""
+    async with AsyncSessionLocal() as session:
+        jtis, epochs = await crud.load_token_revocations(
+            db=session, max_token_lifetime_seconds=max_token_lifetime_seconds(get_settings()))
+    token_revocation_list.load(jtis, epochs)
+
+
+async def on_invalidation_reconnect():
+    auth_user_cache.clear()
+    await load_token_revocations()
+
+
+async def purge_expired_tokens_periodically():
+    """定期删除过期的邮件验证、密码重置令牌和吊销记录，并清理内存中已经没有意义的吊销条目。"""
+    while True:
+        settings = get_settings()
+        await asyncio.sleep(settings.TOKEN_PURGE_INTERVAL_SECONDS)
+        token_revocation_list.prune(max_token_lifetime_seconds(settings))
+        try:
+            async with AsyncSessionLocal() as session:
+                removed = await crud.purge_expired_tokens(db=session)
+            if removed:
+                logger.info(f"已清理 {removed} 个过期的验证/重置令牌。")
+        except Exception as e:
+            logger.error(f"清理过期令牌失败: {e}")
+
+
+async def reconcile_storage_periodically():
+    """定期把上传目录中不再被引用的文件移入隔离区，并删除过期的隔离批次。多个 worker 中只有一个会实际执行。"""
+    while True:
+        settings = get_settings()
+        interval = settings.STORAGE_GC_INTERVAL_SECONDS
+        await asyncio.sleep(interval if interval > 0 else 3600)
+        if interval <= 0:
+            continue  # 未开启定期回收 (重载配置后可以开启)
+        try:
+            await storage_collector.run(UPLOAD_DIR)
+        except StorageGcBusy:
+            pass
+        except Exception as e:
+            logger.error(f"存储回收失败: {e}")
+
+
+async def purge_stale_uploads_periodically():
+    """定期清理长时间没有收到数据的可续传上传 (数据库记录和磁盘上的临时文件)。"""
+    while True:
+        settings = get_settings()
+        await asyncio.sleep(settings.RESUMABLE_UPLOAD_GC_INTERVAL_SECONDS)
+        try:
+            expire_seconds = settings.RESUMABLE_UPLOAD_EXPIRE_HOURS * 3600
+            cutoff = (datetime.datetime.now(datetime.timezone.utc)
+                      - datetime.timedelta(seconds=expire_seconds)).replace(tzinfo=None)
+            async with AsyncSessionLocal() as session:
+                upload_ids = await crud.purge_stale_upload_sessions(db=session, older_than=cutoff)
+            # 临时文件每次写入都会更新修改时间，因此按修改时间清理即可覆盖上面删除的会话以及没有会话的残留文件
+            removed_files = await run_in_threadpool(purge_stale_files, PARTIAL_UPLOAD_DIR, expire_seconds)
+            if upload_ids or removed_files:
+                logger.info(f"已清理 {len(upload_ids)} 个过期的上传会话和 {removed_files} 个临时文件。")
+        except Exception as e:
+            logger.error(f"清理过期的上传会话失败: {e}")
+
 
 # --- FastAPI 应用生命周期管理 ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("应用启动中...")
+    settings = get_settings()
+    thumbnail_engine.start(max_workers=settings.THUMBNAIL_WORKERS, max_pending=settings.THUMBNAIL_QUEUE_SIZE)
+    password_hasher.start(max_workers=settings.PASSWORD_HASH_WORKERS, max_pending=settings.PASSWORD_HASH_QUEUE_SIZE)
+    image_resizer.start(
+        max_workers=settings.IMAGE_RESIZE_WORKERS,
+        max_pending=settings.IMAGE_RESIZE_QUEUE_SIZE,
+        cache_dir=IMAGE_CACHE_DIR,
+        max_cache_bytes=settings.IMAGE_RESIZE_CACHE_MAX_MB * 1024 * 1024,
+        max_dimension=settings.IMAGE_RESIZE_MAX_DIMENSION
+    )
+    http_client = httpx.AsyncClient(
+        timeout=settings.AVATAR_UPSTREAM_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=settings.AVATAR_UPSTREAM_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.AVATAR_UPSTREAM_MAX_CONNECTIONS),
+        follow_redirects=True
+    )
+    avatar_proxy.start(
+        client=http_client,
+        cache_dir=AVATAR_CACHE_DIR,
+        breaker_failure_threshold=settings.AVATAR_BREAKER_FAILURE_THRESHOLD,
+        breaker_reset_seconds=settings.AVATAR_BREAKER_RESET_SECONDS,
+        max_cache_bytes=settings.AVATAR_CACHE_MAX_MB * 1024 * 1024
+    )
+    response_cache.configure(
+        backend_name=settings.RESPONSE_CACHE_BACKEND,
+        ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+        max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+        redis_url=settings.REDIS_URL
+    )
+    # 启动时编译邮件模板，模板文件有误时尽早在日志中暴露
+    try:
+        email_templates.load()
+    except Exception as e:
+        logger.error(f"编译邮件模板失败: {e}")
+    upload_gc_task = asyncio.create_task(purge_stale_uploads_periodically())
+    token_gc_task = asyncio.create_task(purge_expired_tokens_periodically())
+    storage_gc_task = asyncio.create_task(reconcile_storage_periodically())
+    auth_user_cache.configure(ttl_seconds=settings.AUTH_USER_CACHE_TTL_SECONDS,
+                              max_entries=settings.AUTH_USER_CACHE_MAX_ENTRIES)
+    verified_token_cache.configure(max_entries=settings.JWT_VERIFY_CACHE_MAX_ENTRIES)
+    try:
+        await load_token_revocations()
+    except Exception as e:
+        logger.error(f"加载令牌吊销记录失败: {e}")
+    # 其他 worker 修改用户、吊销令牌后通过 NOTIFY 通知本进程；监听断开重连后清空用户缓存并重新加载吊销记录
+    invalidation_listener.start(
+        dsn=settings.ASYNC_DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1),
+        handlers={
+            AUTH_USER_CHANNEL: auth_user_cache.handle_notification,
+            TOKEN_REVOCATION_CHANNEL: token_revocation_list.handle_notification,
+        },
+        on_reconnect=on_invalidation_reconnect
+    )
+    # 未开启任务队列时群发在 API 进程内执行，继续上次关闭或崩溃时中断的群发 (开启时由 worker 重新领取任务继续)
+    if not settings.JOB_QUEUE_ENABLED:
+        try:
+            await broadcast_runner.resume_interrupted()
+        except Exception as e:
+            logger.error(f"继续中断的群发失败: {e}")
     yield
     logger.info("应用关闭中...")
+    upload_gc_task.cancel()
+    token_gc_task.cancel()
+    storage_gc_task.cancel()
+    await broadcast_runner.shutdown()
+    await file_reaper.shutdown()
+    await invalidation_listener.stop()
+    await thumbnail_engine.shutdown()
+    await password_hasher.shutdown()
+    await mail_transport.shutdown()
+    await image_resizer.shutdown()
+    await response_cache.close()
+    await http_client.aclose()
 
 
 app = FastAPI(
@@ -93,17 +311,169 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    """密码哈希线程池排队已满 (例如登录高峰)：返回 503，让客户端稍后重试，而不是无限排队。"""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "服务器繁忙，请稍后再试。"},
+        headers={"Retry-After": str(get_settings().PASSWORD_HASH_RETRY_AFTER_SECONDS)}
+    )
+
+# --- 响应缓存 ---
+def serialize_models(read_model: type, objects) -> bytes:
+    """按响应模型序列化对象列表 (与 response_model 的输出一致)，用于写入响应缓存。"""
+    return json.dumps([read_model.model_validate(obj).model_dump(mode="json") for obj in objects],
+                      ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def public_cache_headers(etag: str) -> dict:
+    """公开接口的缓存响应头：允许共享缓存保存，过期后必须带 If-None-Match 重新验证。"""
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={get_settings().HTTP_CACHE_MAX_AGE_SECONDS}, must-revalidate"
+    }
+
+
+async def cached_json_response(request: Request, endpoint: str, params: dict, validator: tuple,
+                               entities: tuple, produce) -> Response:
+    """
+    带条件请求的缓存 JSON 响应：
+    1. 由 validator (例如 max(updated_at) 和行数) 和请求参数生成弱 ETag，命中 If-None-Match 时直接返回 304，不读取也不序列化列表；
+    2. 否则从响应缓存读取响应体，未命中时调用 produce 生成；X-Cache 响应头标明是否命中。
+    validator 同时参与响应缓存的键，没有写接口递增版本号的数据 (例如友情链接) 变化后也不会返回旧内容。
+    """
+    etag = make_etag(endpoint, *(f"{name}={params[name]}" for name in sorted(params)), *validator, weak=True)
+    headers = public_cache_headers(etag)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified_response(etag, headers)
+
+    body, hit = await response_cache.get_or_produce(endpoint, {**params, "etag": etag}, entities, produce)
+    return Response(content=body, media_type="application/json",
+                    headers={**headers, "X-Cache": "HIT" if hit else "MISS"})
+
+
+# --- 后台任务分派 ---
+async def dispatch_email_task(session: AsyncSession, background_tasks: BackgroundTasks, kind: str, **payload):
+    """开启持久化任务队列时把邮件任务写入 job 表，否则退回到进程内的 BackgroundTasks。"""
+    settings = get_settings()
+    if settings.JOB_QUEUE_ENABLED:
+        await crud.enqueue_job(db=session, kind=kind, payload=payload, max_attempts=settings.JOB_MAX_ATTEMPTS)
+    else:
+        background_tasks.add_task(EMAIL_SENDERS[kind], **payload)
+
+
+async def dispatch_token_email(session: AsyncSession, background_tasks: BackgroundTasks, kind: str,
+                               user_id: int, email: str, username: str):
+    """
+    发送验证邮件或重置密码邮件。开启持久化任务队列时 job 表中只写入 user_id，由 worker 在发送时生成令牌，
+    原始令牌不会出现在 job 表中 (失败的任务会一直保留)；否则在这里生成令牌，交给 BackgroundTasks 发送。
+    两种方式都会提交 session：调用方尚未提交的写入 (例如刚注册的用户) 与任务或令牌在同一个事务中提交。
+    """
+    settings = get_settings()
+    if settings.JOB_QUEUE_ENABLED:
+        session.add(crud.new_job(kind=kind, payload={"user_id": user_id}, max_attempts=settings.JOB_MAX_ATTEMPTS))
+        await session.commit()
+    else:
+        raw_token = await issue_email_token(session, kind, user_id, email)
+        background_tasks.add_task(EMAIL_SENDERS[kind], email_to=email, username=username, token=raw_token)
+
+
+async def dispatch_broadcast(session: AsyncSession, broadcast: models.Broadcast):
+    """
+    开启持久化任务队列时把群发的下一批写入 job 表由 worker 执行 (每个任务一批，任务中带有要继续的检查点)，
+    否则在 API 进程内执行。
+    """
+    settings = get_settings()
+    if settings.JOB_QUEUE_ENABLED:
+        await crud.enqueue_job(db=session, kind=JOB_EMAIL_BROADCAST,
+                               payload={"broadcast_id": broadcast.id, "after_user_id": broadcast.last_user_id},
+                               max_attempts=settings.JOB_MAX_ATTEMPTS)
+    else:
+        broadcast_runner.start(broadcast.id)
+
+
+async def reserve_thumbnail_slot(
+        settings: Settings = Depends(get_settings)
+) -> AsyncIterator[Optional[ThumbnailReservation]]:
+    """
+    上传端点的依赖：在接收文件之前向进程内缩略图引擎预留一个队列名额，队列已满时返回 503。
+    名额在提交缩略图任务时被消耗；请求结束时仍未使用 (失败、内容去重) 则归还。
+    持久化任务队列不需要背压，返回 None。
+    """
+    if settings.JOB_QUEUE_ENABLED:
+        yield None
+        return
+    try:
+        reservation = thumbnail_engine.reserve()
+    except ThumbnailQueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="服务器繁忙，请稍后再试。",
+            headers={"Retry-After": str(settings.THUMBNAIL_RETRY_AFTER_SECONDS)}
+        )
+    try:
+        yield reservation
+    finally:
+        reservation.release()
+
+
+async def record_thumbnail_variants(content_hash: str, produced: List[ThumbnailVariant]):
+    """进程内缩略图引擎完成后，把变体的实际宽度写回数据库。"""
+    try:
+        async with AsyncSessionLocal() as session:
+            await crud.record_thumbnail_variants(db=session, sha256=content_hash,
+                                                 actual_widths=variant_widths_by_name(produced))
+    except Exception as e:
+        logger.error(f"写入缩略图变体宽度失败 ({content_hash[:12]}): {e}")
+
+
+def new_thumbnail_job(content_hash: str, original_file_path: Path, thumbnail_save_path: Path,
+                      item_type: ItemType, variants: List[ThumbnailVariant]) -> Optional[models.Job]:
+    """
+    开启持久化任务队列时构造缩略图任务 (含多分辨率变体，未写入数据库)，
+    由调用方与画廊作品在同一个事务中提交；使用进程内的缩略图引擎时返回 None。
+    """
+    settings = get_settings()
+    if not settings.JOB_QUEUE_ENABLED:
+        return None
+    return crud.new_job(
+        kind=JOB_THUMBNAIL,
+        payload={
+            "content_hash": content_hash,
+            "original_file_path": str(original_file_path),
+            "thumbnail_save_path": str(thumbnail_save_path),
+            "item_type": item_type.value,
+            "variants": [[width, fmt, str(path)] for width, fmt, path in variants],
+            "variant_quality": settings.THUMBNAIL_VARIANT_QUALITY
+        },
+        max_attempts=settings.JOB_MAX_ATTEMPTS
+    )
+
+
+def submit_thumbnail_task(content_hash: str, original_file_path: Path, thumbnail_save_path: Path,
+                          item_type: ItemType, variants: List[ThumbnailVariant],
+                          reservation: Optional[ThumbnailReservation] = None):
+    """把缩略图任务提交到进程内的缩略图引擎 (独立进程)，在画廊作品提交之后调用。"""
+    settings = get_settings()
+    thumbnail_engine.submit(original_file_path, thumbnail_save_path, item_type,
+                            variants, settings.THUMBNAIL_VARIANT_QUALITY,
+                            on_success=functools.partial(record_thumbnail_variants, content_hash),
+                            reservation=reservation)
+
+
 # --- 定义新的分页响应模型 ---
 class PaginatedUsers(SQLModel):
-    total_items: int
-    total_pages: int
+    total_items: Optional[int] = None  # ?with_total=false 时为空
+    total_pages: Optional[int] = None
     page: int
     page_size: int
     items: List[UserRead]
 
 class PaginatedAdminGallery(SQLModel):
-    total_items: int
-    total_pages: int
+    total_items: Optional[int] = None  # ?with_total=false 时为空
+    total_pages: Optional[int] = None
     page: int
     page_size: int
     items: List[GalleryItemReadWithBuilder]
@@ -122,25 +492,106 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "ETag", "X-Cache"],
 )
 app.add_middleware(
     SessionMiddleware, secret_key=get_settings().SESSION_SECRET_KEY
 )
 
 
-# --- 静态文件服务 ---
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# --- 上传文件服务 ---
+@app.api_route("/uploads/{file_path:path}", methods=["GET", "HEAD"], tags=["Media"])
+async def get_upload_file(file_path: str, request: Request):
+    """
+    读取 /uploads 下的文件。支持 Range (含多个范围) 和条件请求，内容不变的文件返回 immutable 缓存头，
+    配置 MEDIA_ACCEL_REDIRECT_PREFIX 时交给 nginx 发送。
+    """
+    return await media_files.respond(request, UPLOAD_DIR, file_path)
+
+
+# --- 按需缩放图片 ---
+@app.get("/img/{file_path:path}", tags=["Media"])
+async def get_resized_image(
+        file_path: str,
+        request: Request,
+        w: Optional[int] = Query(None, ge=1, description="最大宽度 (像素，向上归整到 IMAGE_RESIZE_SIZE_STEPS 的档位)"),
+        h: Optional[int] = Query(None, ge=1, description="最大高度 (像素，向上归整到档位)"),
+        fmt: Optional[str] = Query(None, pattern="^(auto|avif|webp|jpeg|png)$", description="输出格式，默认按 Accept 协商"),
+        q: Optional[int] = Query(None, ge=1, le=100, description="编码质量 (归整到最接近的档位)")
+):
+    """
+    把 /uploads 下的原图等比缩放到 w x h 以内 (不放大) 并按需转换格式。
+    结果缓存在磁盘上，响应带强 ETag，客户端重新验证时直接返回 304。
+    """
+    settings = get_settings()
+    source_path = upload_url_to_path(UPLOAD_DIR, f"/uploads/{file_path}")
+    if source_path is None or source_path.suffix.lower() not in SOURCE_SUFFIXES:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="图片不存在。")
+    try:
+        source_stat = await run_in_threadpool(source_path.stat)
+    except OSError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="图片不存在。")
+
+    output_format, negotiated = negotiate_format(request.headers.get("accept"), fmt, source_path.suffix)
+    if not encoder_available(output_format):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"服务器不支持输出 {output_format} 格式。")
+    # 尺寸和质量归整到固定档位 (超过上限的尺寸按上限处理)，任意参数组合都只会命中有限的几种缓存文件
+    max_dimension = image_resizer.max_dimension
+    size_steps = settings.image_resize_size_steps_list
+    width = quantize_dimension(w, size_steps, max_dimension)
+    height = quantize_dimension(h, size_steps, max_dimension)
+    quality = quantize_quality(q or settings.IMAGE_RESIZE_DEFAULT_QUALITY, settings.image_resize_quality_steps_list)
+
+    key = image_resizer.cache_key(source_path, source_stat, width, height, output_format, quality)
+    etag = f'"{key}"'
+    headers = {"Cache-Control": f"public, max-age={settings.IMAGE_RESIZE_CACHE_MAX_AGE_SECONDS}"}
+    if negotiated:
+        headers["Vary"] = "Accept"
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified_response(etag, headers)
+
+    try:
+        cached_path = await image_resizer.render(key, source_path, width, height, output_format, quality)
+    except ImageResizerBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="服务器繁忙，请稍后再试。",
+            headers={"Retry-After": str(settings.IMAGE_RESIZE_RETRY_AFTER_SECONDS)}
+        )
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="无法处理该图片。")
+
+    return FileResponse(cached_path, media_type=OUTPUT_FORMATS[output_format][2], headers={**headers, "ETag": etag})
+
+
+@app.get("/api/admin/cache/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_response_cache_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看公开接口响应缓存的命中率和失效次数"""
+    return response_cache.stats()
+
+
+@app.get("/api/admin/avatars/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_avatar_proxy_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看头像代理的缓存命中、请求合并、上游错误和熔断器状态"""
+    return avatar_proxy.stats()
+
+
+@app.get("/api/admin/images/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_image_resizer_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看按需缩放图片的缓存命中率、容量和渲染队列统计"""
+    return image_resizer.stats()
 
 
 # --- 配置重载端点 ---
 @app.post("/admin/reload-config", status_code=status.HTTP_200_OK, tags=["Admin"])
-async def reload_configuration(admin_user: User = Depends(get_current_admin_user)):
+async def reload_configuration(admin_user: AuthUser = Depends(get_current_admin_user)):
     """
     (需要管理员权限)
     清除服务器端的配置缓存，使服务器从 .env 文件重新加载配置。
     注意：CORS等中间件配置在服务启动时加载，无法通过此方式热重载。
     """
     clear_settings_cache()
+    email_templates.reload()
     return {"message": "配置已重载."}
 
 
@@ -151,34 +602,142 @@ async def read_root():
 
 
 @app.get("/config/public", response_model=PublicConfig, tags=["Public"])
-async def get_public_config(settings: Settings = Depends(get_settings)):
+async def get_public_config(request: Request, settings: Settings = Depends(get_settings)):
     """获取前端需要的、公开的后端配置信息。"""
-    return PublicConfig(
+    public_config = PublicConfig(
         enable_registration=settings.ENABLE_REGISTRATION,
         project_name=settings.MAIL_FROM_NAME
     )
+    body = public_config.model_dump_json().encode("utf-8")
+    etag = make_etag(body.decode("utf-8"), weak=True)
+    headers = public_cache_headers(etag)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified_response(etag, headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # --- 新增：Minecraft 头像代理接口 ---
 @app.get("/avatars/mc/{username}", tags=["Public"])
-async def get_mc_avatar(username: str, settings: Settings = Depends(get_settings)):
+async def get_mc_avatar(username: str, request: Request, settings: Settings = Depends(get_settings)):
     """
     一个代理接口，用于从 cravatar.eu 获取 Minecraft 头像，以避免客户端跨域或网络问题。
+    头像缓存在服务器磁盘上，缓存命中时不访问上游；浏览器按 ETag 重新验证。
+    上游不可用时返回本地生成的占位头像 (X-Avatar-Fallback: 1)，只短时间缓存，上游恢复后自动换回真实头像。
     """
-    avatar_url = settings.MC_AVATAR_URL_TEMPLATE.format(username=username)
+    if not username or len(username) > 64:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Avatar not found.")
+    try:
+        avatar = await avatar_proxy.get(
+            username,
+            url_template=settings.MC_AVATAR_URL_TEMPLATE,
+            ttl_seconds=settings.AVATAR_CACHE_TTL_SECONDS,
+            negative_ttl_seconds=settings.AVATAR_NEGATIVE_CACHE_TTL_SECONDS
+        )
+    except AvatarNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Avatar not found.",
+            headers={"Cache-Control": f"public, max-age={settings.AVATAR_NEGATIVE_CACHE_TTL_SECONDS}"}
+        )
 
-    async with httpx.AsyncClient() as client:
-        try:
-            req = client.build_request("GET", avatar_url, timeout=10.0)
-            r = await client.send(req, stream=True)
-            r.raise_for_status()
+    if avatar.fallback:
+        headers = {"ETag": avatar.etag, "Cache-Control": f"public, max-age={settings.AVATAR_FALLBACK_MAX_AGE_SECONDS}",
+                   "X-Avatar-Fallback": "1"}
+    else:
+        headers = {"ETag": avatar.etag, "Cache-Control": f"public, max-age={settings.AVATAR_CACHE_TTL_SECONDS}"}
+    if etag_matches(request.headers.get("if-none-match"), avatar.etag):
+        return not_modified_response(avatar.etag, headers)
+    return Response(content=avatar.content, media_type=avatar.content_type, headers=headers)
 
-            return StreamingResponse(r.aiter_bytes(), headers=r.headers)
 
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail="Avatar not found.")
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"Could not fetch avatar from upstream server: {e}")
+AVATAR_BATCH_TILE_SIZES = (32, 64, 128)
+
+
+@app.get("/avatars/batch", tags=["Public"])
+async def get_mc_avatar_batch(
+        request: Request,
+        names: str = Query(..., description="逗号分隔的 Minecraft 用户名"),
+        size: int = Query(64, description="雪碧图中每个头像的边长 (32/64/128)"),
+        format: str = Query("sprite", pattern="^(sprite|ndjson)$", description="sprite: 雪碧图 + 偏移表; ndjson: 每行一个头像"),
+        settings: Settings = Depends(get_settings)
+):
+    """
+    批量获取头像，成员网格和画廊卡片一次往返即可拿到所有头像。用户名按不区分大小写去重，顺序保持不变。
+    - sprite: 返回 JSON {sprite: PNG data URL, tile_size, columns, offsets: {名称: {x, y}}, missing: [...]}，
+      按所含头像的 ETag 计算整体 ETag，支持 304；
+    - ndjson: 流式返回，每行 {name, content_type, data (base64)} 或 {name, missing: true}，先就绪的头像先返回。
+    任何一个头像是占位头像时，整个响应只短时间缓存。
+    """
+    if size not in AVATAR_BATCH_TILE_SIZES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"size 只能是 {', '.join(str(s) for s in AVATAR_BATCH_TILE_SIZES)}")
+    usernames = []
+    seen = set()
+    for name in names.split(","):
+        name = name.strip()
+        if name and len(name) <= 64 and name.lower() not in seen:
+            seen.add(name.lower())
+            usernames.append(name)
+    if not usernames:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="names 不能为空")
+    if len(usernames) > settings.AVATAR_BATCH_MAX_NAMES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"一次最多请求 {settings.AVATAR_BATCH_MAX_NAMES} 个头像")
+
+    fetch_options = dict(
+        url_template=settings.MC_AVATAR_URL_TEMPLATE,
+        ttl_seconds=settings.AVATAR_CACHE_TTL_SECONDS,
+        negative_ttl_seconds=settings.AVATAR_NEGATIVE_CACHE_TTL_SECONDS
+    )
+
+    if format == "ndjson":
+        async def fetch_line(username: str) -> bytes:
+            try:
+                avatar = await avatar_proxy.get(username, **fetch_options)
+                line = {"name": username, "content_type": avatar.content_type,
+                        "data": base64.b64encode(avatar.content).decode("ascii")}
+                if avatar.fallback:
+                    line["fallback"] = True
+            except AvatarNotFound:
+                line = {"name": username, "missing": True}
+            return (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+
+        async def stream_lines():
+            tasks = [asyncio.ensure_future(fetch_line(username)) for username in usernames]
+            try:
+                for next_line in asyncio.as_completed(tasks):
+                    yield await next_line
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        # 流式响应在拿到全部头像之前就要发出响应头，无法预先知道是否含占位头像，只短时间缓存
+        return StreamingResponse(
+            stream_lines(),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": f"public, max-age={settings.AVATAR_FALLBACK_MAX_AGE_SECONDS}"}
+        )
+
+    avatars = await avatar_proxy.get_many(usernames, **fetch_options)
+    any_fallback = any(avatar is not None and avatar.fallback for avatar in avatars.values())
+    max_age = settings.AVATAR_FALLBACK_MAX_AGE_SECONDS if any_fallback else settings.AVATAR_CACHE_TTL_SECONDS
+    etag = make_etag("avatar-sprite", size,
+                     *(f"{name}={avatar.etag if avatar is not None else '-'}" for name, avatar in avatars.items()))
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified_response(etag, headers)
+
+    tiles = [(name, avatar.content) for name, avatar in avatars.items() if avatar is not None]
+    sprite, columns, offsets, broken = await avatar_proxy.get_sprite(etag, tiles, size)
+    payload = {
+        "sprite": "data:image/png;base64," + base64.b64encode(sprite).decode("ascii"),
+        "tile_size": size,
+        "columns": columns,
+        "offsets": offsets,
+        "missing": [name for name, avatar in avatars.items() if avatar is None] + broken,
+    }
+    return Response(content=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                    media_type="application/json", headers=headers)
 
 
 # --- 认证相关端点 ---
@@ -205,23 +764,12 @@ async def register_user(
     if user_create.mc_name and await crud.get_user_by_mc_name(db=session, mc_name=user_create.mc_name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="该 Minecraft 用户名已被关联")
 
-    # crud.create_user 内部将处理 created_at 和 updated_at 为 offset-naive
-    db_user = await crud.create_user(db=session, user_create=user_create)
+    # crud.add_user 内部将处理 created_at 和 updated_at 为 offset-naive；用户与验证邮件任务在同一个事务中提交
+    db_user = await crud.add_user(db=session, user_create=user_create)
 
-    raw_token = generate_email_verification_token(db_user.email)
-
-    # 获取当前 UTC 时间，并去除时区信息，用于 expires_at 字段
-    expires_at_naive = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-        seconds=settings.EMAIL_TOKEN_MAX_AGE_SECONDS)).replace(tzinfo=None)
-
-    await crud.create_verification_token(
-        db=session,
-        user_id=db_user.id,
-        token_hash=get_password_hash(raw_token),
-        expires_at=expires_at_naive  # 修改为去除时区信息的 datetime
-    )
-    background_tasks.add_task(send_verification_email, email_to=db_user.email, username=db_user.username,
-                              token=raw_token)
+    await dispatch_token_email(session, background_tasks, JOB_EMAIL_VERIFICATION,
+                               user_id=db_user.id, email=db_user.email, username=db_user.username)
+    await session.refresh(db_user)
     return db_user
 
 
@@ -242,7 +790,7 @@ async def verify_email_address(token: str, session: AsyncSession = Depends(get_a
     await session.commit()
     await session.refresh(user)
 
-    db_token = await crud.get_verification_token_by_hash(db=session, token_hash=get_password_hash(token))
+    db_token = await crud.get_verification_token_by_hash(db=session, token_hash=hash_token(token))
     if db_token:
         await crud.delete_db_token(db=session, token=db_token)
 
@@ -256,8 +804,14 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     if not user:
         user = await crud.get_user_by_username(db=session, username=form_data.username)
 
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="邮箱/用户名或密码不正确")
+    verified, new_hash = await verify_and_update_password_async(form_data.password, user.hashed_password)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="邮箱/用户名或密码不正确")
+    if new_hash:
+        # bcrypt 工作因子已调整：趁用户提供明文密码时按新配置重新哈希
+        await crud.rehash_user_password(db=session, user=user, new_hash=new_hash)
     if not user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户已被禁用")
     if not user.is_verified:
@@ -288,6 +842,19 @@ async def refresh_access_token(refresh_request: RefreshTokenRequest,
     )
 
 
+@app.post("/auth/logout", status_code=status.HTTP_200_OK, tags=AUTH_TAGS)
+async def logout(logout_request: Optional[RefreshTokenRequest] = None,
+                 token_data: TokenData = Depends(get_current_user_from_token),
+                 session: AsyncSession = Depends(get_async_session)):
+    """吊销当前的访问令牌 (以及请求体中提供的刷新令牌)，所有 worker 立即生效。"""
+    await crud.revoke_token(db=session, token_data=token_data)
+    if logout_request is not None:
+        refresh_data = verify_refresh_token_and_get_token_data(logout_request.refresh_token)
+        if refresh_data and refresh_data.user_id == token_data.user_id:
+            await crud.revoke_token(db=session, token_data=refresh_data)
+    return {"message": "已退出登录"}
+
+
 @app.post("/auth/request-password-reset", status_code=status.HTTP_200_OK, tags=AUTH_TAGS)
 async def request_password_reset(reset_request: PasswordResetRequest, background_tasks: BackgroundTasks,
                                  session: AsyncSession = Depends(get_async_session),
@@ -295,18 +862,8 @@ async def request_password_reset(reset_request: PasswordResetRequest, background
     user = await crud.get_user_by_email(db=session, email=reset_request.email)
     if user:
         try:
-            raw_token = generate_password_reset_token(user.email)
-            # 获取当前 UTC 时间，并去除时区信息，用于 expires_at 字段
-            expires_at_naive = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-                seconds=settings.PASSWORD_RESET_TOKEN_MAX_AGE_SECONDS)).replace(tzinfo=None)
-            await crud.create_password_reset_token(
-                db=session,
-                user_id=user.id,
-                token_hash=get_password_hash(raw_token),
-                expires_at=expires_at_naive  # 修改为去除时区信息的 datetime
-            )
-            background_tasks.add_task(send_password_reset_email, email_to=user.email, username=user.username,
-                                      token=raw_token)
+            await dispatch_token_email(session, background_tasks, JOB_EMAIL_PASSWORD_RESET,
+                                       user_id=user.id, email=user.email, username=user.username)
         except Exception as e:
             logger.error(f"为用户 {reset_request.email} 请求密码重置时发生内部错误: {e}")
 
@@ -323,11 +880,12 @@ async def reset_password(form: PasswordResetForm, session: AsyncSession = Depend
     if not user or not user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用户不存在或已被禁用")
 
-    db_token = await crud.get_password_reset_token_by_hash(db=session, token_hash=get_password_hash(form.token))
+    db_token = await crud.get_password_reset_token_by_hash(db=session, token_hash=hash_token(form.token))
     if not db_token or db_token.user_id != user.id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="密码重置令牌无效或已被使用")
 
-    await crud.update_user_password(db=session, user=user, new_password=form.new_password)
+    # 通过邮件重置密码意味着旧密码可能已泄露，吊销此前签发的所有令牌
+    await crud.update_user_password(db=session, user=user, new_password=form.new_password, revoke_sessions=True)
     await crud.delete_db_token(db=session, token=db_token)
 
     return {"message": "密码已成功重置。"}
@@ -359,7 +917,7 @@ async def update_user_me(user_update: UserUpdate, session: AsyncSession = Depend
 async def change_current_user_password(password_update: UserPasswordUpdate,
                                        session: AsyncSession = Depends(get_async_session),
                                        current_user: User = Depends(get_current_active_user)):
-    if not verify_password(password_update.current_password, current_user.hashed_password):
+    if not await verify_password_async(password_update.current_password, current_user.hashed_password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="当前密码不正确")
     await crud.update_user_password(db=session, user=current_user, new_password=password_update.new_password)
     return {"message": "密码已成功更新"}
@@ -369,66 +927,17 @@ async def change_current_user_password(password_update: UserPasswordUpdate,
 GALLERY_TAGS = ["Gallery"]
 
 
-def create_image_thumbnail(
-        original_image_path: Path,
-        thumbnail_save_path: Path,
-        size: tuple[int, int] = (400, 400)
-):
-    """为图片文件创建缩略图"""
-    try:
-        with PILImage.open(original_image_path) as img:
-            img.thumbnail(size, Resampling.LANCZOS)
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-            img.save(thumbnail_save_path)
-            logger.info(f"图片缩略图已保存到: {thumbnail_save_path}")
-            return True
-    except Exception as e:
-        logger.error(f"创建图片缩略图失败: {e}")
-        return False
-
-
-def create_video_thumbnail(
-        video_path: Path,
-        thumbnail_save_path: Path,
-        size: tuple[int, int] = (400, 400)
-) -> bool:
-    """为视频文件创建缩略图 (封面)"""
-    try:
-        cap = cv2.VideoCapture(str(video_path))
-        if not cap.isOpened():
-            logger.error(f"无法打开视频文件: {video_path}")
-            return False
-
-        ret, frame = cap.read()
-        if not ret:
-            logger.error(f"无法从视频读取帧: {video_path}")
-            cap.release()
-            return False
-
-        frame_pil = PILImage.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        frame_pil.thumbnail(size, Resampling.LANCZOS)
-        frame_pil.save(thumbnail_save_path)
-
-        cap.release()
-        logger.info(f"视频封面已保存到: {thumbnail_save_path}")
-        return True
-    except Exception as e:
-        logger.error(f"创建视频封面失败: {e}")
-        return False
-
-
 @app.post("/gallery/upload", response_model=GalleryItemReadWithBuilder, status_code=status.HTTP_201_CREATED,
           tags=GALLERY_TAGS)
 async def upload_gallery_item(
-        background_tasks: BackgroundTasks,
         title: str = File(...),
         builder_name: str = File(...),
         description: Optional[str] = File(None),
         image: UploadFile = File(...),
         session: AsyncSession = Depends(get_async_session),
-        current_user: User = Depends(get_current_active_user),
-        settings: Settings = Depends(get_settings)
+        current_user: AuthUser = Depends(get_current_auth_user),
+        settings: Settings = Depends(get_settings),
+        thumbnail_slot: Optional[ThumbnailReservation] = Depends(reserve_thumbnail_slot)
 ):
     # 1. 文件类型和大小验证 (保持不变)
     if image.content_type not in settings.allowed_mime_types_list:
@@ -437,83 +946,432 @@ async def upload_gallery_item(
     if image.size > max_file_size_bytes:
         raise HTTPException(status_code=400, detail=f"文件过大，最大允许 {settings.UPLOAD_MAX_SIZE_MB}MB.")
 
-    # 2. 确定文件类型和文件名
-    item_type = ItemType.VIDEO if image.content_type.startswith("video/") else ItemType.IMAGE
-    file_extension = Path(image.filename).suffix.lower() or ".dat"
-    unique_filename_base = str(uuid.uuid4())
-    original_filename = f"{unique_filename_base}{file_extension}"
-    thumbnail_filename = f"{unique_filename_base}_thumb.jpg"  # 缩略图统一为 jpg
-    original_file_location = UPLOAD_DIR / original_filename
-    thumbnail_file_location = UPLOAD_DIR / thumbnail_filename
-
-    # 3. 保存原始文件
+    # 2. 复制到临时文件，同时计算内容哈希 (在线程池中执行，不阻塞事件循环)
+    staged_file = PARTIAL_UPLOAD_DIR / f"{uuid.uuid4().hex}.tmp"
     try:
-        with open(original_file_location, "wb+") as file_object:
-            shutil.copyfileobj(image.file, file_object)
+        size, head, content_hash = await run_in_threadpool(copy_and_hash, image.file, staged_file)
     except Exception as e:
         logger.error(f"保存文件失败: {e}")
+        await run_in_threadpool(staged_file.unlink, True)
         raise HTTPException(status_code=500, detail="上传文件时发生服务器内部错误。")
     finally:
         image.file.close()
 
-    # 4. 准备画廊项目数据并存入数据库
+    # 3. 以文件头部识别出的类型为准再校验一次，客户端声明的 Content-Type 不可信
+    mime_type = sniff_mime_type(head)
+    if mime_type not in settings.allowed_mime_types_list:
+        await run_in_threadpool(staged_file.unlink, True)
+        raise HTTPException(status_code=400, detail=f"不支持的文件类型: {mime_type or 'unknown'}.")
+
+    # 4. 存入数据库并安排缩略图生成，立即返回响应给用户
+    suffix = MIME_EXTENSIONS.get(mime_type) or Path(image.filename).suffix.lower() or ".dat"
+    return await create_gallery_item_for_file(
+        session=session, user_id=current_user.id, title=title, builder_name=builder_name,
+        description=description, staged_file=staged_file, content_hash=content_hash, size=size,
+        mime_type=mime_type, suffix=suffix, thumbnail_slot=thumbnail_slot
+    )
+
+
+@app.post("/gallery/upload/stream", response_model=GalleryItemReadWithBuilder,
+          status_code=status.HTTP_201_CREATED, tags=GALLERY_TAGS)
+async def upload_gallery_item_stream(
+        request: Request,
+        title: str = Query(...),
+        builder_name: str = Query(...),
+        description: Optional[str] = Query(None),
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user),
+        settings: Settings = Depends(get_settings),
+        thumbnail_slot: Optional[ThumbnailReservation] = Depends(reserve_thumbnail_slot)
+):
+    """
+    流式上传：请求体直接是文件内容 (不是 multipart)，元数据通过查询参数传递。
+    先检查 Content-Length，再边接收边写入磁盘并计算 SHA-256，超过大小限制立即中止；
+    文件类型根据文件头部的魔数识别，而不是信任客户端声明的 Content-Type。
+    """
+    max_file_size_bytes = settings.UPLOAD_MAX_SIZE_MB * 1024 * 1024
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_file_size_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"文件过大，最大允许 {settings.UPLOAD_MAX_SIZE_MB}MB.")
+
+    allowed_mime_types = settings.allowed_mime_types_list
+    sniffed = {}
+
+    def destination_for(head: bytes) -> Path:
+        mime_type = sniff_mime_type(head)
+        if mime_type not in allowed_mime_types:
+            raise UploadRejected(mime_type or "unknown")
+        sniffed["mime_type"] = mime_type
+        return PARTIAL_UPLOAD_DIR / f"{uuid.uuid4().hex}.tmp"
+
+    try:
+        staged_file, size, _, content_hash = await stream_to_file(
+            request.stream(), destination_for, max_file_size_bytes
+        )
+    except UploadTooLarge:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"文件过大，最大允许 {settings.UPLOAD_MAX_SIZE_MB}MB.")
+    except UploadRejected as e:
+        raise HTTPException(status_code=400, detail=f"不支持的文件类型: {e}.")
+
+    return await create_gallery_item_for_file(
+        session=session, user_id=current_user.id, title=title, builder_name=builder_name,
+        description=description, staged_file=staged_file, content_hash=content_hash, size=size,
+        mime_type=sniffed["mime_type"], suffix=MIME_EXTENSIONS[sniffed["mime_type"]],
+        thumbnail_slot=thumbnail_slot
+    )
+
+
+async def thumbnail_missing(session: AsyncSession, blob: models.MediaBlob, thumbnail_file_location: Path) -> bool:
+    """已有内容的缩略图或变体文件是否缺失，且没有正在等待或执行的缩略图任务。"""
+    urls = [blob.thumbnail_url] + [variant["url"] for variant in blob.thumbnail_variants or []]
+    if not await run_in_threadpool(any_upload_file_missing, UPLOAD_DIR, urls):
+        return False
+    if get_settings().JOB_QUEUE_ENABLED:
+        return not await crud.has_active_job(db=session, kind=JOB_THUMBNAIL, payload_key="content_hash",
+                                             payload_value=blob.sha256)
+    return not thumbnail_engine.is_pending(thumbnail_file_location)
+
+
+async def create_gallery_item_for_file(
+        session: AsyncSession,
+        user_id: int,
+        title: str,
+        builder_name: str,
+        description: Optional[str],
+        staged_file: Path,
+        content_hash: str,
+        size: int,
+        mime_type: str,
+        suffix: str,
+        thumbnail_slot: Optional[ThumbnailReservation] = None
+) -> models.GalleryItem:
+    """
+    为已接收完整的临时文件创建画廊作品。
+    文件按内容哈希存放 (media/ab/cd/<sha256>)：相同内容已经存在时只增加引用计数、丢弃临时文件，
+    缩略图已存在 (或正在生成) 时跳过缩略图生成；否则把临时文件移动到最终位置，并安排缩略图生成 (不等待其完成)。
+    """
+    settings = get_settings()
     member = await crud.get_or_create_member(db=session, name=builder_name)
-    image_url_to_store = f"/uploads/{original_filename}"
-    thumbnail_url_to_store = f"/uploads/{thumbnail_filename}"  # 预设缩略图URL
+    item_type = ItemType.VIDEO if mime_type.startswith("video/") else ItemType.IMAGE
+    original_file_location = content_addressed_path(UPLOAD_DIR, content_hash, suffix)
+    thumbnail_file_location = content_addressed_path(UPLOAD_DIR, content_hash, "_thumb.jpg")  # 缩略图统一为 jpg
+    variants = plan_thumbnail_variants(
+        content_addressed_path(UPLOAD_DIR, content_hash, ""),
+        settings.thumbnail_variant_widths_list,
+        supported_variant_formats(settings.thumbnail_variant_formats_list)
+    )
+
+    blob, is_new_content = await crud.acquire_media_blob(
+        db=session,
+        sha256=content_hash,
+        image_url=upload_path_to_url(UPLOAD_DIR, original_file_location),
+        thumbnail_url=upload_path_to_url(UPLOAD_DIR, thumbnail_file_location),
+        thumbnail_variants=[{"url": upload_path_to_url(UPLOAD_DIR, path), "width": width, "format": fmt}
+                            for width, fmt, path in variants],
+        mime_type=mime_type,
+        size=size
+    )
+    needs_thumbnail = is_new_content
+    if is_new_content:
+        await run_in_threadpool(move_into_place, staged_file, original_file_location)
+    else:
+        await run_in_threadpool(staged_file.unlink, True)
+        logger.info(f"上传内容已存在 ({content_hash[:12]})，复用已有文件和缩略图。")
+        # 第一次上传的缩略图任务可能丢失或失败：缩略图或变体文件不存在、也没有正在进行的任务时重新生成
+        needs_thumbnail = await thumbnail_missing(session, blob, thumbnail_file_location)
+        if needs_thumbnail:
+            logger.warning(f"已有内容 ({content_hash[:12]}) 的缩略图缺失，重新安排生成。")
+    if not needs_thumbnail and thumbnail_slot is not None:
+        thumbnail_slot.release()  # 不需要生成缩略图，立即归还预留的队列名额
 
     item_create_data = GalleryItemCreate(
         title=title,
         description=description,
-        image_url=image_url_to_store,
-        thumbnail_url=thumbnail_url_to_store,  # 先将URL存入数据库
+        image_url=blob.image_url,
+        thumbnail_url=blob.thumbnail_url,  # 先将预设的缩略图URL存入数据库
         item_type=item_type
     )
-
-    # 存入数据库并立即返回响应，不再等待缩略图生成
+    # 将耗时的缩略图生成任务交给任务队列或缩略图引擎 (独立进程)。
+    # 任务队列的任务与引用计数、作品记录在同一个事务中提交，不会出现作品已保存而缩略图任务丢失的情况
+    thumbnail_job = None
+    if needs_thumbnail:
+        thumbnail_job = new_thumbnail_job(content_hash, original_file_location, thumbnail_file_location,
+                                          item_type, variants)
     db_gallery_item = await crud.create_gallery_item(
         db=session,
         item_create=item_create_data,
-        user_id=current_user.id,
-        member_id=member.id
+        user_id=user_id,
+        member_id=member.id,
+        content_hash=content_hash,
+        thumbnail_variants=blob.thumbnail_variants,
+        next_job=thumbnail_job
+    )
+    if needs_thumbnail and thumbnail_job is None:
+        submit_thumbnail_task(content_hash, original_file_location, thumbnail_file_location, item_type, variants,
+                              reservation=thumbnail_slot)
+
+    await session.refresh(db_gallery_item, attribute_names=["builder"])
+    return db_gallery_item
+
+
+# --- 可续传上传 (tus 风格): 创建 -> PATCH 分块 -> HEAD 查询进度 -> finalize 生成作品 ---
+
+# Postgres 的 lock_not_available：FOR UPDATE NOWAIT 没有拿到行锁
+LOCK_NOT_AVAILABLE_SQLSTATE = "55P03"
+
+
+def is_lock_not_available(error: DBAPIError) -> bool:
+    orig = error.orig
+    sqlstate = getattr(orig, "sqlstate", None) or getattr(getattr(orig, "__cause__", None), "sqlstate", None)
+    return sqlstate == LOCK_NOT_AVAILABLE_SQLSTATE
+
+
+async def get_owned_upload_session(session: AsyncSession, upload_id: str, current_user: AuthUser,
+                                   lock: bool = False) -> models.UploadSession:
+    """
+    获取属于当前用户的上传会话。lock=True 时加行锁 (用于 finalize / abort 这类短事务)，
+    行锁被占用或有 PATCH 正持有写入租约时返回 409。其他数据库错误照常抛出。
+    """
+    try:
+        upload_session = await crud.get_upload_session(db=session, upload_id=upload_id, lock=lock)
+    except DBAPIError as e:
+        if not is_lock_not_available(e):
+            raise
+        await session.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="该上传正在被另一个请求写入")
+    if not upload_session or upload_session.user_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="上传会话不存在或已过期")
+    if lock and crud.is_upload_leased(upload_session):
+        await session.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="该上传正在被另一个请求写入")
+    return upload_session
+
+
+@app.post("/gallery/uploads", response_model=UploadSessionRead, status_code=status.HTTP_201_CREATED,
+          tags=GALLERY_TAGS)
+async def create_resumable_upload(
+        upload_create: UploadSessionCreate,
+        response: Response,
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user),
+        settings: Settings = Depends(get_settings)
+):
+    """创建一个可续传上传会话，之后用 PATCH 按偏移量分块上传文件内容。"""
+    max_file_size_bytes = settings.RESUMABLE_UPLOAD_MAX_SIZE_MB * 1024 * 1024
+    if upload_create.total_size <= 0:
+        raise HTTPException(status_code=400, detail="文件大小无效")
+    if upload_create.total_size > max_file_size_bytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"文件过大，最大允许 {settings.RESUMABLE_UPLOAD_MAX_SIZE_MB}MB.")
+
+    upload_session = await crud.create_upload_session(
+        db=session, upload_id=uuid.uuid4().hex, user_id=current_user.id, upload_create=upload_create
     )
+    response.headers["Location"] = f"/gallery/uploads/{upload_session.id}"
+    response.headers["Upload-Offset"] = "0"
+    return upload_session
 
-    # --- 5. 将耗时的缩略图生成任务添加到后台 ---
-    background_tasks.add_task(
-        process_thumbnail_in_background,
-        original_file_location,
-        thumbnail_file_location,
-        item_type
+
+@app.head("/gallery/uploads/{upload_id}", tags=GALLERY_TAGS)
+async def get_resumable_upload_offset(
+        upload_id: str,
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user)
+):
+    """查询服务器已接收的字节数，客户端断线重连后从这个偏移量继续上传。"""
+    upload_session = await get_owned_upload_session(session, upload_id, current_user)
+    return Response(status_code=status.HTTP_200_OK, headers={
+        "Upload-Offset": str(upload_session.offset),
+        "Upload-Length": str(upload_session.total_size),
+        "Cache-Control": "no-store"
+    })
+
+
+@app.patch("/gallery/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT, tags=GALLERY_TAGS)
+async def append_resumable_upload(
+        upload_id: str,
+        request: Request,
+        upload_offset: int = Header(..., alias="Upload-Offset"),
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user),
+        settings: Settings = Depends(get_settings)
+):
+    """
+    在指定偏移量处追加一个分块，请求体直接写入磁盘上的临时文件。
+    Upload-Offset 必须等于服务器当前已接收的字节数，否则返回 409 和正确的偏移量。
+    写入期间只持有会话的租约 (已提交的条件 UPDATE)，不持有行锁和数据库连接；
+    写完后用 offset 比较更新提交新的偏移量。
+    """
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Content-Type 必须是 application/offset+octet-stream")
+
+    lease_id = uuid.uuid4().hex
+    lease_seconds = settings.RESUMABLE_UPLOAD_LEASE_SECONDS
+    lease = await crud.lease_upload_session(
+        db=session, upload_id=upload_id, user_id=current_user.id, lease_id=lease_id, lease_seconds=lease_seconds
     )
+    if lease is None:
+        # 区分会话不存在 (404) 和正在被另一个请求写入 (409)
+        await get_owned_upload_session(session, upload_id, current_user)
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="该上传正在被另一个请求写入")
 
-    await session.refresh(db_gallery_item, attribute_names=["builder"])
+    new_offset = None
+    try:
+        if upload_offset != lease.offset:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="上传偏移量不匹配",
+                                headers={"Upload-Offset": str(lease.offset)})
+        try:
+            # 在租约过期之前停止写入，避免租约被接管后两个请求同时写同一个文件
+            written = await append_stream_to_file(
+                request.stream(),
+                PARTIAL_UPLOAD_DIR / f"{upload_id}.part",
+                lease.offset,
+                lease.total_size - lease.offset,
+                deadline=time.monotonic() + lease_seconds * 0.9
+            )
+        except UploadTooLarge:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail="分块超出了声明的文件大小")
+        except UploadDeadlineExceeded:
+            raise HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail="分块上传超时，请减小分块大小后重试",
+                                headers={"Upload-Offset": str(lease.offset)})
+        if await crud.commit_upload_chunk(db=session, upload_id=upload_id, lease_id=lease_id,
+                                          old_offset=lease.offset, new_offset=lease.offset + written):
+            new_offset = lease.offset + written
+    finally:
+        # 失败时释放租约；请求被取消而没能释放时，租约到期后自动失效
+        if new_offset is None:
+            await session.rollback()
+            await crud.release_upload_lease(db=session, upload_id=upload_id, lease_id=lease_id)
 
-    # 立即返回响应给用户
-    return db_gallery_item
+    if new_offset is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="上传会话已被其他请求接管或已被删除")
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Upload-Offset": str(new_offset)})
+
+
+@app.post("/gallery/uploads/{upload_id}/finalize", response_model=GalleryItemReadWithBuilder,
+          status_code=status.HTTP_201_CREATED, tags=GALLERY_TAGS)
+async def finalize_resumable_upload(
+        upload_id: str,
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user),
+        settings: Settings = Depends(get_settings),
+        thumbnail_slot: Optional[ThumbnailReservation] = Depends(reserve_thumbnail_slot)
+):
+    """所有分块上传完成后，把临时文件移动到 UPLOAD_DIR 并创建画廊作品。"""
+    upload_session = await get_owned_upload_session(session, upload_id, current_user, lock=True)
+    if upload_session.offset != upload_session.total_size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="文件尚未上传完成",
+                            headers={"Upload-Offset": str(upload_session.offset)})
+
+    part_path = PARTIAL_UPLOAD_DIR / f"{upload_session.id}.part"
+    mime_type = sniff_mime_type(await run_in_threadpool(read_file_head, part_path))
+    if mime_type not in settings.allowed_mime_types_list:
+        await run_in_threadpool(part_path.unlink, True)
+        await crud.delete_upload_session(db=session, upload_session=upload_session)
+        raise HTTPException(status_code=400, detail=f"不支持的文件类型: {mime_type or 'unknown'}.")
+
+    # 分块跨越多个请求，只能在合并完成后计算内容哈希
+    content_hash = await run_in_threadpool(hash_file, part_path)
+
+    title, builder_name, description = upload_session.title, upload_session.builder_name, upload_session.description
+    size = upload_session.total_size
+    await crud.delete_upload_session(db=session, upload_session=upload_session)
+
+    return await create_gallery_item_for_file(
+        session=session, user_id=current_user.id, title=title, builder_name=builder_name,
+        description=description, staged_file=part_path, content_hash=content_hash, size=size,
+        mime_type=mime_type, suffix=MIME_EXTENSIONS[mime_type], thumbnail_slot=thumbnail_slot
+    )
+
+
+@app.delete("/gallery/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT, tags=GALLERY_TAGS)
+async def abort_resumable_upload(
+        upload_id: str,
+        session: AsyncSession = Depends(get_async_session),
+        current_user: AuthUser = Depends(get_current_auth_user)
+):
+    """放弃一个尚未完成的上传，删除已接收的数据。"""
+    upload_session = await get_owned_upload_session(session, upload_id, current_user, lock=True)
+    await run_in_threadpool((PARTIAL_UPLOAD_DIR / f"{upload_session.id}.part").unlink, True)
+    await crud.delete_upload_session(db=session, upload_session=upload_session)
+    return
 
 
 class PaginatedGalleryItems(SQLModel):
-    total_items: int
-    total_pages: int
-    page: int
+    total_items: Optional[int] = None  # ?with_total=false 时为空
+    total_pages: Optional[int] = None
+    page: Optional[int] = None  # 游标模式下为空
     page_size: int
     items: List[GalleryItemReadWithBuilder]
+    next_cursor: Optional[str] = None  # 还有下一页时，传给 ?cursor= 继续读取
 
 
 @app.get("/gallery/items", response_model=PaginatedGalleryItems, tags=GALLERY_TAGS)
 async def get_gallery_items(
+        request: Request,
         session: AsyncSession = Depends(get_async_session),
         settings: Settings = Depends(get_settings),
         page: int = Query(1, ge=1),
-        page_size: int = Query(None, ge=1)
+        page_size: int = Query(None, ge=1),
+        cursor: Optional[str] = Query(None, description="游标分页：上一页返回的 next_cursor (传空字符串从第一页开始)"),
+        with_total: bool = Query(True, description="是否返回总数和总页数 (无限滚动通常不需要)")
 ):
+    """
+    两种分页方式：
+    - 页码模式 (?page=)：按 OFFSET 跳过前面的行，适合跳页浏览；
+    - 游标模式 (?cursor=)：从上一页最后一条之后继续读取，每页开销与翻页深度无关，适合无限滚动。
+    两种模式都会返回 next_cursor，页码模式的第一页之后可以直接切换到游标模式。
+    总数按 LISTING_COUNT_MODE 计算，?with_total=false 时不计算。
+
+    这是访问量最大的接口，走精简读取路径：单次 JOIN 投影查询得到行元组后直接序列化为 JSON，
+    不构造 ORM 实体，也不经过响应模型的逐字段校验 (response_model 仅用于生成接口文档)。
+    序列化后的响应体按画廊和成员的版本号缓存；ETag 由作品表和成员表的 max(updated_at) 与行数生成，未变化时返回 304。
+    """
+    count_mode = settings.LISTING_COUNT_MODE if with_total else None
     effective_page_size = page_size if page_size is not None else settings.GALLERY_DEFAULT_PAGE_SIZE
     if effective_page_size > settings.GALLERY_MAX_PAGE_SIZE:
         effective_page_size = settings.GALLERY_MAX_PAGE_SIZE
 
-    total_items, items = await crud.get_paginated_gallery_items(db=session, page=page, page_size=effective_page_size)
-    total_pages = (total_items + effective_page_size - 1) // effective_page_size
-    return PaginatedGalleryItems(total_items=total_items, total_pages=total_pages, page=page,
-                                 page_size=effective_page_size, items=items)
+    decoded_cursor = None
+    if cursor:
+        try:
+            decoded_cursor = crud.decode_gallery_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="无效的分页游标。")
+
+    async def produce() -> bytes:
+        rows, next_cursor = await crud.get_gallery_listing_page(
+            db=session,
+            page_size=effective_page_size,
+            offset=(page - 1) * effective_page_size if cursor is None else 0,
+            cursor=decoded_cursor
+        )
+        total_items = await crud.count_table_rows(session, models.GalleryItem, count_mode) if count_mode else None
+        payload = {
+            "total_items": total_items,
+            "total_pages": ceil(total_items / effective_page_size) if total_items is not None else None,
+            "page": page if cursor is None else None,
+            "page_size": effective_page_size,
+            "items": [crud.gallery_listing_row_to_dict(row) for row in rows],
+            "next_cursor": next_cursor,
+        }
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    validator = (*await crud.get_table_validator(session, models.GalleryItem),
+                 *await crud.get_table_validator(session, models.Member))
+    return await cached_json_response(
+        request,
+        "gallery_items",
+        {"page": page if cursor is None else None, "cursor": cursor, "page_size": effective_page_size,
+         "count_mode": count_mode},
+        validator,
+        (ENTITY_GALLERY, ENTITY_MEMBERS),
+        produce
+    )
 
 
 # --- 新增：画廊项目管理端点 (更新和删除) ---
@@ -525,7 +1383,7 @@ class GalleryItemUpdate(SQLModel):
 @app.patch("/gallery/items/{item_id}", response_model=GalleryItemReadWithBuilder, tags=GALLERY_TAGS)
 async def update_gallery_item(item_id: int, item_update: GalleryItemUpdate,
                               session: AsyncSession = Depends(get_async_session),
-                              current_user: User = Depends(get_current_active_user)):
+                              current_user: AuthUser = Depends(get_current_auth_user)):
     db_item = await crud.get_gallery_item_by_id(db=session, item_id=item_id)
     if not db_item:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="项目未找到")
@@ -536,13 +1394,14 @@ async def update_gallery_item(item_id: int, item_update: GalleryItemUpdate,
 
 @app.delete("/gallery/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT, tags=GALLERY_TAGS)
 async def delete_gallery_item(item_id: int, session: AsyncSession = Depends(get_async_session),
-                              current_user: User = Depends(get_current_active_user)):
+                              current_user: AuthUser = Depends(get_current_auth_user)):
     db_item = await crud.get_gallery_item_by_id(db=session, item_id=item_id)
     if not db_item:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="项目未找到")
     if db_item.user_id != current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="无权删除此项目")
-    await crud.delete_gallery_item(db=session, item=db_item)
+    orphaned_urls = await crud.delete_gallery_item(db=session, item=db_item)
+    file_reaper.submit(UPLOAD_DIR, orphaned_urls)
     return
 
 
@@ -552,7 +1411,7 @@ MEMBERS_TAGS = ["Members"]
 
 @app.post("/members", response_model=MemberRead, tags=MEMBERS_TAGS, status_code=status.HTTP_201_CREATED)
 async def create_member(member_data: MemberCreate, session: AsyncSession = Depends(get_async_session),
-                        current_user: User = Depends(get_current_active_user)):
+                        current_user: AuthUser = Depends(get_current_auth_user)):
     if await crud.get_member_by_name(db=session, name=member_data.name):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="该名称的成员已存在")
 
@@ -562,14 +1421,19 @@ async def create_member(member_data: MemberCreate, session: AsyncSession = Depen
 
 
 @app.get("/members", response_model=List[MemberRead], tags=MEMBERS_TAGS)
-async def get_all_members(session: AsyncSession = Depends(get_async_session)):
-    return await crud.get_all_members(db=session)
+async def get_all_members(request: Request, session: AsyncSession = Depends(get_async_session)):
+    async def produce() -> bytes:
+        members = await crud.get_all_members(db=session)
+        return serialize_models(MemberRead, members)
+
+    validator = await crud.get_table_validator(session, models.Member)
+    return await cached_json_response(request, "members", {}, validator, (ENTITY_MEMBERS,), produce)
 
 
 @app.patch("/members/{member_id}", response_model=MemberRead, tags=["Members"])
 async def update_member_self(member_id: int, member_update: models.MemberUpdate,
                              session: AsyncSession = Depends(get_async_session),
-                             current_user: User = Depends(get_current_active_user)):
+                             current_user: AuthUser = Depends(get_current_auth_user)):
     db_member = await crud.get_member_by_id(db=session, member_id=member_id)
     if not db_member:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="成员未找到")
@@ -583,7 +1447,7 @@ async def update_member_self(member_id: int, member_update: models.MemberUpdate,
 @app.get("/api/admin/members", response_model=List[MemberRead], tags=["Admin Panel"])
 async def admin_get_members(
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user)
+        admin_user: AuthUser = Depends(get_current_admin_user)
 ):
     """(管理员) 获取所有核心成员的完整列表"""
     return await crud.get_all_members(db=session)
@@ -593,7 +1457,7 @@ async def admin_get_members(
 async def admin_create_member(
         member_data: MemberCreate,
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user)
+        admin_user: AuthUser = Depends(get_current_admin_user)
 ):
     """(管理员) 创建一个新的核心成员"""
     if await crud.get_member_by_name(db=session, name=member_data.name):
@@ -612,7 +1476,7 @@ async def admin_update_member(
         member_id: int,
         member_update: models.MemberUpdate,
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user)
+        admin_user: AuthUser = Depends(get_current_admin_user)
 ):
     """(管理员) 更新指定核心成员的信息"""
     db_member = await crud.get_member_by_id(db=session, member_id=member_id)
@@ -626,7 +1490,7 @@ async def admin_update_member(
 async def admin_delete_member(
         member_id: int,
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user)
+        admin_user: AuthUser = Depends(get_current_admin_user)
 ):
     """(管理员) 删除指定核心成员"""
     db_member = await crud.get_member_by_id(db=session, member_id=member_id)
@@ -640,7 +1504,7 @@ async def admin_delete_member(
 async def delete_member(
         member_id: int,
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user)
+        admin_user: AuthUser = Depends(get_current_admin_user)
 ):
     db_member = await crud.get_member_by_id(db=session, member_id=member_id)
     if not db_member:
@@ -651,29 +1515,16 @@ async def delete_member(
 
 
 @app.get("/friend-links", response_model=list[FriendLinkRead], tags=["Public"])
-async def read_friend_links(db: AsyncSession = Depends(get_async_session)):
+async def read_friend_links(request: Request, db: AsyncSession = Depends(get_async_session)):
     """
     获取所有公开的友情链接列表
     """
-    links = await get_friend_links(db)
-    return links
+    async def produce() -> bytes:
+        links = await get_friend_links(db)
+        return serialize_models(FriendLinkRead, links)
 
-
-# --- 创建一个专门用于后台生成缩略图的函数 ---
-def process_thumbnail_in_background(
-    original_file_path: Path,
-    thumbnail_save_path: Path,
-    item_type: ItemType
-):
-    """
-    根据项目类型，在后台生成图片或视频的缩略图。
-    """
-    logger.info(f"后台任务开始: 为 {original_file_path} 生成缩略图...")
-    if item_type == ItemType.IMAGE:
-        create_image_thumbnail(original_file_path, thumbnail_save_path)
-    elif item_type == ItemType.VIDEO:
-        create_video_thumbnail(original_file_path, thumbnail_save_path)
-    logger.info(f"后台任务结束: 缩略图处理完成。")
+    validator = await crud.get_table_validator(db, models.FriendLink)
+    return await cached_json_response(request, "friend_links", {}, validator, (ENTITY_FRIEND_LINKS,), produce)
 
 
 # --- V2: 自定义管理面板 API ---
@@ -688,13 +1539,17 @@ class AdminUserUpdate(SQLModel):
 @app.get("/api/admin/users", response_model=PaginatedUsers, tags=["Admin Panel"])
 async def admin_get_users(
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user),
+        admin_user: AuthUser = Depends(get_current_admin_user),
         page: int = Query(1, ge=1),
-        page_size: int = Query(10, ge=1, le=100)
+        page_size: int = Query(10, ge=1, le=100),
+        with_total: bool = Query(True, description="是否返回总数和总页数")
 ):
     """(管理员) 分页获取用户列表"""
-    total_users, users = await crud.admin_get_paginated_users(db=session, page=page, page_size=page_size)
-    total_pages = ceil(total_users / page_size)
+    count_mode = get_settings().LISTING_COUNT_MODE if with_total else None
+    total_users, users = await crud.admin_get_paginated_users(
+        db=session, page=page, page_size=page_size, count_mode=count_mode
+    )
+    total_pages = ceil(total_users / page_size) if total_users is not None else None
 
     return PaginatedUsers(
         total_items=total_users,
@@ -710,25 +1565,15 @@ async def admin_update_user(
         user_id: int,
         user_update: AdminUserUpdate,  # <--- This should now work correctly
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user),
+        admin_user: AuthUser = Depends(get_current_admin_user),
 ):
     """(管理员) 更新指定用户信息"""
     db_user = await session.get(User, user_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="用户未找到")
 
-    # Use the specific CRUD function for admin updates
-    # Note: We can reuse the `admin_update_user_details` from crud.py if you created it,
-    # or just perform the logic here directly.
-    update_data = user_update.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_user, key, value)
-
-    db_user.updated_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
-    session.add(db_user)
-    await session.commit()
-    await session.refresh(db_user)
-    return db_user
+    # 提交后使各 worker 中该用户的认证缓存失效；禁用用户时同时吊销其全部令牌
+    return await crud.admin_update_user_details(db=session, user=db_user, update_data=user_update)
 
 
 @app.delete("/api/admin/users/{user_id}", status_code=status.HTTP_200_OK, tags=["Admin Panel"])
@@ -736,21 +1581,23 @@ async def admin_delete_user(
         user_id: int,
         background_tasks: BackgroundTasks,
         session: AsyncSession = Depends(get_async_session),
-        admin_user: User = Depends(get_current_admin_user),
+        admin_user: AuthUser = Depends(get_current_admin_user),
 ):
     """(管理员) 删除指定用户及其所有作品"""
     if admin_user.id == user_id:
         raise HTTPException(status_code=400, detail="管理员不能删除自己。")
 
     # 使用 CRUD 函数执行删除操作
-    deleted_user = await crud.delete_user_by_id(db=session, user_id=user_id)
+    deleted_user, orphaned_urls = await crud.delete_user_by_id(db=session, user_id=user_id)
 
     if not deleted_user:
         raise HTTPException(status_code=404, detail="用户未找到")
+    # 不再被引用的文件在后台删除，响应时间与用户的作品数量无关
+    file_reaper.submit(UPLOAD_DIR, orphaned_urls)
 
     # 在后台发送邮件通知
-    background_tasks.add_task(
-        send_account_deletion_email,
+    await dispatch_email_task(
+        session, background_tasks, JOB_EMAIL_ACCOUNT_DELETION,
         email_to=deleted_user.email,
         username=deleted_user.username
     )
@@ -758,18 +1605,140 @@ async def admin_delete_user(
     return {"message": f"用户 {deleted_user.username} 已被成功删除。"}
 
 
+# --- 全站群发邮件 ---
+@app.post("/api/admin/broadcasts", response_model=BroadcastRead, tags=["Admin Panel"],
+          status_code=status.HTTP_202_ACCEPTED)
+async def admin_create_broadcast(
+        broadcast_data: BroadcastCreate,
+        session: AsyncSession = Depends(get_async_session),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 向所有 (已验证邮箱的) 活跃用户群发邮件。立即返回，通过 GET /api/admin/broadcasts/{id} 查看进度。"""
+    broadcast = await crud.create_broadcast(db=session, broadcast_create=broadcast_data, created_by_id=admin_user.id)
+    await dispatch_broadcast(session, broadcast)
+    logger.info(f"管理员 {admin_user.username} 创建了群发 {broadcast.id}，收件人约 {broadcast.total_recipients} 个。")
+    return broadcast
+
+
+@app.get("/api/admin/broadcasts", response_model=List[BroadcastRead], tags=["Admin Panel"])
+async def admin_list_broadcasts(
+        session: AsyncSession = Depends(get_async_session),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 最近的群发及其进度"""
+    return await crud.list_broadcasts(db=session)
+
+
+@app.get("/api/admin/broadcasts/{broadcast_id}", response_model=BroadcastRead, tags=["Admin Panel"])
+async def admin_get_broadcast(
+        broadcast_id: int,
+        session: AsyncSession = Depends(get_async_session),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 查看群发进度：已处理到的 user.id、成功和失败数以及最近的失败记录"""
+    broadcast = await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+    if not broadcast:
+        raise HTTPException(status_code=404, detail="群发未找到")
+    return broadcast
+
+
+@app.post("/api/admin/broadcasts/{broadcast_id}/cancel", response_model=BroadcastRead, tags=["Admin Panel"])
+async def admin_cancel_broadcast(
+        broadcast_id: int,
+        session: AsyncSession = Depends(get_async_session),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 取消未完成的群发。正在发送的一批会发送完毕，之后停止。"""
+    if not await crud.cancel_broadcast(db=session, broadcast_id=broadcast_id):
+        raise HTTPException(status_code=409, detail="群发不存在或已结束。")
+    return await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+
+
+@app.post("/api/admin/broadcasts/{broadcast_id}/resume", response_model=BroadcastRead, tags=["Admin Panel"],
+          status_code=status.HTTP_202_ACCEPTED)
+async def admin_resume_broadcast(
+        broadcast_id: int,
+        session: AsyncSession = Depends(get_async_session),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 从检查点继续已取消或中断的群发。正在执行的群发不会被重复执行。"""
+    broadcast = await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+    if not broadcast:
+        raise HTTPException(status_code=404, detail="群发未找到")
+    if broadcast.status == models.BroadcastStatus.COMPLETED:
+        raise HTTPException(status_code=409, detail="群发已完成。")
+    if broadcast.status == models.BroadcastStatus.CANCELLED:
+        await crud.reopen_broadcast(db=session, broadcast_id=broadcast_id)
+        broadcast = await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+    await dispatch_broadcast(session, broadcast)
+    return await crud.get_broadcast(db=session, broadcast_id=broadcast_id)
+
+
+@app.post("/api/admin/storage/gc", response_model=dict, tags=["Admin Panel"])
+async def admin_run_storage_gc(
+        dry_run: bool = Query(True, description="只统计孤儿文件，不移动"),
+        admin_user: AuthUser = Depends(get_current_admin_user)
+):
+    """(管理员) 立即对账上传目录：不再被引用的文件移入隔离区，并删除过期的隔离批次。返回本次的统计报告。"""
+    try:
+        report = await storage_collector.run(UPLOAD_DIR, dry_run=dry_run)
+    except StorageGcBusy:
+        raise HTTPException(status_code=409, detail="存储回收正在执行中，请稍后再试。")
+    return report.as_dict()
+
+
+@app.get("/api/admin/storage/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_storage_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看最近一次存储回收的报告 (本进程执行的)、后台文件删除队列和 /uploads 文件服务的统计"""
+    return {**storage_collector.stats(), "file_reaper": file_reaper.stats(), "media_files": media_files.stats()}
+
+
+@app.get("/api/admin/thumbnails/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_thumbnail_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看缩略图引擎的队列深度和任务耗时统计"""
+    return thumbnail_engine.stats()
+
+
+@app.get("/api/admin/auth/user-cache/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_auth_user_cache_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看认证用户缓存的命中率和失效次数，以及跨进程失效监听的连接状态"""
+    return {**auth_user_cache.stats(), "listener": invalidation_listener.stats()}
+
+
+@app.get("/api/admin/mail/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_mail_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看邮件发送通道的发件箱积压、连接数、重试和失败次数，邮件模板的编译和渲染次数，以及本进程内执行的群发"""
+    return {**mail_transport.stats(), "templates": email_templates.stats(), "broadcasts": broadcast_runner.stats()}
+
+
+@app.get("/api/admin/auth/tokens/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_token_cache_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看 JWT 校验缓存的命中率和吊销列表的大小"""
+    return {"verify_cache": verified_token_cache.stats(), "revocations": token_revocation_list.stats()}
+
+
+@app.get("/api/admin/auth/password-hasher/stats", response_model=dict, tags=["Admin Panel"])
+async def admin_get_password_hasher_stats(admin_user: AuthUser = Depends(get_current_admin_user)):
+    """(管理员) 查看密码哈希线程池的排队深度、等待时间和自动升级次数"""
+    return password_hasher.stats()
+
+
 # --- 画廊管理 API ---
 
 @app.get("/api/admin/gallery-items", response_model=PaginatedAdminGallery, tags=["Admin Panel"])
 async def admin_get_gallery_items(
     session: AsyncSession = Depends(get_async_session),
-    admin_user: User = Depends(get_current_admin_user),
+    admin_user: AuthUser = Depends(get_current_admin_user),
     page: int = Query(1, ge=1),
-    page_size: int = Query(10, ge=1, le=100)
+    page_size: int = Query(10, ge=1, le=100),
+    with_total: bool = Query(True, description="是否返回总数和总页数")
 ):
     """(管理员) 分页获取所有画廊作品的列表"""
-    total_items, items = await crud.admin_get_paginated_gallery_items(db=session, page=page, page_size=page_size)
-    total_pages = ceil(total_items / page_size)
+    count_mode = get_settings().LISTING_COUNT_MODE if with_total else None
+    total_items, items = await crud.admin_get_paginated_gallery_items(
+        db=session, page=page, page_size=page_size, count_mode=count_mode
+    )
+    total_pages = ceil(total_items / page_size) if total_items is not None else None
 
     return PaginatedAdminGallery(
         total_items=total_items,
@@ -784,37 +1753,23 @@ async def admin_get_gallery_items(
 async def admin_delete_gallery_item(
     item_id: int,
     session: AsyncSession = Depends(get_async_session),
-    admin_user: User = Depends(get_current_admin_user),
+    admin_user: AuthUser = Depends(get_current_admin_user),
 ):
     """(管理员) 删除指定的画廊作品"""
     db_item = await session.get(models.GalleryItem, item_id)
     if not db_item:
         raise HTTPException(status_code=404, detail="画廊作品未找到")
 
-    # 在删除数据库记录前，先删除关联的物理文件
-    try:
-        # UPLOAD_DIR 已在文件顶部定义
-        if db_item.image_url:
-            image_path = UPLOAD_DIR / Path(db_item.image_url).name
-            if image_path.is_file():
-                image_path.unlink()
-        if db_item.thumbnail_url:
-            thumb_path = UPLOAD_DIR / Path(db_item.thumbnail_url).name
-            if thumb_path.is_file():
-                thumb_path.unlink()
-    except Exception as e:
-        # 即使文件删除失败，也应继续删除数据库记录，但要记录错误
-        logger.error(f"删除作品 {item_id} 的文件时出错: {e}")
-
-    await session.delete(db_item)
-    await session.commit()
+    # 数据库记录删除后，再删除不再被任何作品引用的物理文件
+    orphaned_urls = await crud.delete_gallery_item(db=session, item=db_item)
+    file_reaper.submit(UPLOAD_DIR, orphaned_urls)
     return
 
 
 # --- 站点配置管理 API ---
 
 @app.get("/api/admin/site-config", response_model=dict, tags=["Admin Panel"])
-async def admin_get_site_config(admin_user: User = Depends(get_current_admin_user)):
+async def admin_get_site_config(admin_user: AuthUser = Depends(get_current_admin_user)):
     if not SITE_CONFIG_PATH.exists():
         raise HTTPException(status_code=404, detail="site-config.json not found")
     try:
@@ -831,7 +1786,7 @@ async def admin_get_site_config(admin_user: User = Depends(get_current_admin_use
 @app.post("/api/admin/site-config", status_code=status.HTTP_200_OK, tags=["Admin Panel"])
 async def admin_update_site_config(
         request: Request,
-        admin_user: User = Depends(get_current_admin_user),
+        admin_user: AuthUser = Depends(get_current_admin_user),
 ):
     try:
         new_config = await request.json()
@@ -0,0 +1,328 @@
+﻿# backend/media_files.py
+"""
+/uploads 下上传文件的读取服务 (替代原先的 StaticFiles 挂载)。
+
+- Range：支持单个和多个字节范围 (多个范围返回 multipart/byteranges)，支持 If-Range；
+  重叠或相邻的范围先合并，合并后超过 MEDIA_MAX_RANGES 个时忽略 Range 返回整个文件；
+  <video> 拖动进度条时浏览器只请求需要的部分；
+- 缓存：内容寻址 (media/ 下以 SHA-256 命名) 和以 UUID 命名的文件内容永远不变，
+  返回 Cache-Control: immutable 和一年的有效期；其他文件返回 no-cache，由 ETag / Last-Modified 重新验证 (304)；
+- 零拷贝：ASGI 服务器声明支持 http.response.zerocopy 扩展时把文件描述符交给服务器发送 (由服务器调用 sendfile)，
+  否则在线程池中分块读取后发送 (uvicorn 不提供这个扩展，也不向应用暴露套接字)；
+- 交给前端代理：配置 MEDIA_ACCEL_REDIRECT_PREFIX 后只返回 X-Accel-Redirect 响应头，
+  由 nginx 直接用 sendfile 发送文件 (Range 和条件请求也由 nginx 处理)。nginx 配置示例：
+      location /_uploads/ {
+          internal;
+          alias /path/to/your/project/backend/uploads/;
+      }
+  并在 .env 中设置 MEDIA_ACCEL_REDIRECT_PREFIX="/_uploads/"。
+"""
+import datetime
+import mimetypes
+import os
+import re
+import secrets
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException, Request, Response, status
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive, Scope, Send
+
+from backend.core.config import get_settings
+from backend.http_cache import etag_matches, make_etag, not_modified_response
+from backend.upload_storage import MEDIA_SUBDIR, upload_url_to_path
+
+# 不支持零拷贝时每次从文件读取并发送的字节数
+CHUNK_SIZE = 256 * 1024
+ZEROCOPY_EXTENSION = "http.response.zerocopy"
+
+_RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+_DIGEST_NAME_RE = re.compile(r"^[0-9a-f]{64}")
+# 旧版按 UUID 命名的原图、缩略图 (<uuid>_thumb.jpg) 及其尺寸变体 (<uuid>_thumb_w320.webp)
+_UUID_NAME_RE = re.compile(r"^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}(_thumb(_w\d+)?)?$")
+
+
+class RangeNotSatisfiable(Exception):
+    """Range 中没有任何一个范围落在文件内 (416)。"""
+
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    解析 Range 请求头，返回按起点排序、合并了重叠和相邻范围的 [(start, end), ...] (end 包含在内)。
+    没有 Range、不是 bytes 单位或语法有误时返回 None (按 RFC 9110 忽略 Range)；没有可满足的范围时抛出 RangeNotSatisfiable。
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        match = _RANGE_SPEC_RE.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        elif last:
+            # 后缀范围：最后 N 个字节
+            if int(last) == 0:
+                continue
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def is_immutable_name(relative_path: str) -> bool:
+    """内容寻址 (media/ab/cd/<sha256>...) 或以 UUID 命名的文件，同一个 URL 的内容永远不变。"""
+    directory, _, name = relative_path.rpartition("/")
+    if directory.split("/", 1)[0] == MEDIA_SUBDIR and _DIGEST_NAME_RE.match(name):
+        return True
+    return bool(_UUID_NAME_RE.match(name.partition(".")[0].lower()))
+
+
+def _http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def _not_modified_since(if_modified_since: Optional[str], mtime: float) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return int(mtime) <= since.timestamp()
+
+
+def _if_range_matches(if_range: Optional[str], etag: str, last_modified: str) -> bool:
+    """
+    If-Range 只做强比较：与 ETag 完全相同或与 Last-Modified 完全相同时才按 Range 响应。
+    弱 ETag (W/"...") 不能用于 If-Range (RFC 9110 13.1.5)，一律视为不匹配，返回完整内容。
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith("W/"):
+        return False
+    if if_range.startswith('"'):
+        return not etag.startswith("W/") and if_range == etag
+    return if_range == last_modified
+
+
+def _read_at(file_object: BinaryIO, offset: int, size: int) -> bytes:
+    file_object.seek(offset)
+    return file_object.read(size)
+
+
+class MediaFileResponse(Response):
+    """
+    发送文件的全部或若干字节范围。文件在开始发送前才打开，
+    打开失败 (例如刚被存储回收移走) 时返回 404。客户端断开后立即停止读取。
+    """
+
+    def __init__(self, path: Path, headers: dict, media_type: str, ranges: List[Tuple[int, int]],
+                 size: int, status_code: int = status.HTTP_200_OK, send_body: bool = True,
+                 server: Optional["MediaFiles"] = None):
+        self.path = path
+        self.ranges = ranges
+        self.send_body = send_body
+        self.server = server
+        self.parts: List[Tuple[bytes, int, int]] = []  # (分隔头部, 起点, 长度)
+        self.trailer = b""
+        if len(ranges) > 1:
+            boundary = secrets.token_hex(16)
+            for start, end in ranges:
+                self.parts.append((
+                    (f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                     f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode("latin-1"),
+                    start, end - start + 1))
+            # 每个部分之后的 CRLF 放在下一个分隔头部之前
+            self.parts = [(part if index == 0 else b"\r\n" + part, start, length)
+                          for index, (part, start, length) in enumerate(self.parts)]
+            self.trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            media_type = f"multipart/byteranges; boundary={boundary}"
+        else:
+            start, end = ranges[0] if ranges else (0, -1)
+            self.parts.append((b"", start, end - start + 1))
+            if status_code == status.HTTP_206_PARTIAL_CONTENT:
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        content_length = sum(len(part) + length for part, _, length in self.parts) + len(self.trailer)
+        super().__init__(status_code=status_code, media_type=media_type,
+                         headers={**headers, "Content-Length": str(content_length)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if not self.send_body:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        try:
+            file_object = await run_in_threadpool(open, self.path, "rb")
+        except OSError:
+            await Response(status_code=status.HTTP_404_NOT_FOUND)(scope, receive, send)
+            return
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+            async with anyio.create_task_group() as task_group:
+                async def _run_and_cancel(func):
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(_run_and_cancel, partial(self._send_parts, send, file_object, zerocopy))
+                await _run_and_cancel(partial(self._wait_for_disconnect, receive))
+        finally:
+            await run_in_threadpool(file_object.close)
+
+    async def _wait_for_disconnect(self, receive: Receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def _send_parts(self, send: Send, file_object: BinaryIO, zerocopy: bool):
+        for part, offset, length in self.parts:
+            if part:
+                await send({"type": "http.response.body", "body": part, "more_body": True})
+            if zerocopy:
+                await send({"type": ZEROCOPY_EXTENSION, "file": file_object, "offset": offset,
+                            "count": length, "more_body": True})
+                self._count_sent(length, zerocopy=True)
+                continue
+            remaining = length
+            while remaining > 0:
+                chunk = await run_in_threadpool(_read_at, file_object, offset, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # 文件在发送期间被截断：已声明的 Content-Length 无法满足，只能中止
+                    raise RuntimeError(f"读取 {self.path} 时文件被截断")
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                self._count_sent(len(chunk))
+        await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+
+    def _count_sent(self, size: int, zerocopy: bool = False):
+        if self.server is not None:
+            self.server.bytes_sent += size
+            if zerocopy:
+                self.server.zerocopy_bytes += size
+
+
+class MediaFiles:
+    """/uploads 路由背后的文件服务，记录各类响应的次数 (每个进程一份)。"""
+
+    def __init__(self):
+        self.requests = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.multipart = 0
+        self.unsatisfiable = 0
+        self.accel_redirects = 0
+        self.bytes_sent = 0
+        self.zerocopy_bytes = 0
+
+    async def respond(self, request: Request, upload_dir: Path, file_path: str) -> Response:
+        settings = get_settings()
+        self.requests += 1
+        path = upload_url_to_path(upload_dir, f"/uploads/{file_path}")
+        try:
+            file_stat = await run_in_threadpool(os.stat, path) if path is not None else None
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="文件不存在。")
+
+        relative_path = path.relative_to(upload_dir.resolve()).as_posix()
+        size = file_stat.st_size
+        media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        last_modified = _http_date(file_stat.st_mtime)
+        if is_immutable_name(relative_path):
+            # 内容不变：ETag 不含修改时间，文件被复制或从隔离区恢复后 ETag 保持不变
+            etag = make_etag(relative_path, size)
+            cache_control = f"public, max-age={settings.MEDIA_IMMUTABLE_MAX_AGE_SECONDS}, immutable"
+        else:
+            etag = make_etag(relative_path, size, file_stat.st_mtime_ns)
+            cache_control = "public, no-cache"
+        headers = {
+            "Cache-Control": cache_control,
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Accept-Ranges": "bytes",
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if (etag_matches(if_none_match, etag) if if_none_match
+                else _not_modified_since(request.headers.get("if-modified-since"), file_stat.st_mtime)):
+            self.not_modified += 1
+            return not_modified_response(etag, {"Cache-Control": cache_control, "Last-Modified": last_modified})
+
+        if settings.MEDIA_ACCEL_REDIRECT_PREFIX:
+            self.accel_redirects += 1
+            return Response(headers={
+                **headers,
+                "Content-Type": media_type,
+                "X-Accel-Redirect": settings.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(relative_path),
+            })
+
+        send_body = request.method != "HEAD"
+        ranges = None
+        if _if_range_matches(request.headers.get("if-range"), etag, last_modified):
+            try:
+                ranges = parse_range_header(request.headers.get("range"), size)
+            except RangeNotSatisfiable:
+                self.unsatisfiable += 1
+                return Response(status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+                                headers={**headers, "Content-Range": f"bytes */{size}"})
+            if ranges is not None and len(ranges) > settings.MEDIA_MAX_RANGES:
+                ranges = None
+        if ranges is None:
+            return MediaFileResponse(path, headers, media_type, [(0, size - 1)] if size else [],
+                                     size, send_body=send_body, server=self)
+
+        self.partial += 1
+        if len(ranges) > 1:
+            self.multipart += 1
+        return MediaFileResponse(path, headers, media_type, ranges, size,
+                                 status_code=status.HTTP_206_PARTIAL_CONTENT, send_body=send_body, server=self)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "partial": self.partial,
+            "multipart": self.multipart,
+            "unsatisfiable": self.unsatisfiable,
+            "accel_redirects": self.accel_redirects,
+            "bytes_sent": self.bytes_sent,
+            "zerocopy_bytes": self.zerocopy_bytes,
+        }
+
+
+# 进程内唯一实例
+media_files = MediaFiles()
@@ -6,7 +6,7 @@ from typing import Optional, Any, List
 import datetime
 from datetime import timezone  # 仍然需要用于生成 UTC 时间，但之后会去除时区信息
 from pydantic import model_validator
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Column, JSON, Index, BigInteger, Text
 
 
 # --- 用户模型 ---
@@ -56,6 +56,9 @@ class User(UserBase, table=True):
         description="最后更新时间 (UTC)"
     )
 
+    # 用户纪元：在此时刻之前签发的令牌全部失效 (禁用用户、重置密码时设置)
+    tokens_revoked_at: Optional[datetime.datetime] = Field(default=None, nullable=True, description="令牌吊销纪元 (UTC)")
+
     gallery_items: List["GalleryItem"] = Relationship(back_populates="uploader")
 
     __table_args__ = (
@@ -120,8 +123,8 @@ class VerificationTokenBase(SQLModel):
     """
     邮件验证令牌的基础字段。
     """
-    token_hash: str = Field(description="验证令牌的哈希值")
-    expires_at: datetime.datetime = Field(description="令牌过期时间 (UTC)")
+    token_hash: str = Field(description="验证令牌的 HMAC-SHA256 摘要")
+    expires_at: datetime.datetime = Field(index=True, description="令牌过期时间 (UTC)")
 
 
 class VerificationToken(VerificationTokenBase, table=True):
@@ -165,8 +168,8 @@ class PasswordResetTokenBase(SQLModel):
     """
     密码重置令牌的基础字段。
     """
-    token_hash: str = Field(description="密码重置令牌的哈希值")
-    expires_at: datetime.datetime = Field(description="令牌过期时间 (UTC)")
+    token_hash: str = Field(description="密码重置令牌的 HMAC-SHA256 摘要")
+    expires_at: datetime.datetime = Field(index=True, description="令牌过期时间 (UTC)")
 
 
 class PasswordResetToken(PasswordResetTokenBase, table=True):
@@ -240,6 +243,9 @@ class TokenData(SQLModel):
     解码 JWT 访问令牌或刷新令牌后得到的数据模型。
     """
     user_id: Optional[int] = None
+    jti: Optional[str] = None
+    issued_at: Optional[int] = None
+    expires_at: Optional[int] = None
 
 
 class RefreshTokenRequest(SQLModel):
@@ -326,6 +332,11 @@ class GalleryItem(GalleryItemBase, table=True):
                                      description="关联的成员ID (创作者)")
     builder: Optional["Member"] = Relationship(back_populates="gallery_items")
 
+    content_hash: Optional[str] = Field(default=None, index=True,
+                                        description="原始文件的 SHA-256，对应 MediaBlob (旧作品为空)")
+    thumbnail_variants: Optional[List[dict]] = Field(default=None, sa_column=Column(JSON, nullable=True),
+                                                     description="多分辨率缩略图变体 [{url, width, format}]")
+
     # 修改这里：default_factory 返回 offset-naive 的 datetime
     uploaded_at: datetime.datetime = Field(
         default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),  # <--- 修改
@@ -336,9 +347,14 @@ class GalleryItem(GalleryItemBase, table=True):
     updated_at: datetime.datetime = Field(
         default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),  # <--- 修改
         nullable=False,
+        index=True,  # 列表接口的 ETag 需要 max(updated_at)
         description="最后更新时间 (UTC)"
     )
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # 画廊列表按 (uploaded_at, id) 倒序分页 (游标分页依赖该索引)
+        Index("ix_galleryitem_uploaded_at_id", "uploaded_at", "id"),
+        {'extend_existing': True}
+    )
 
 
 class GalleryItemCreate(GalleryItemBase):
@@ -356,9 +372,16 @@ class GalleryItemRead(GalleryItemBase):
     updated_at: datetime.datetime
 
 
+class ThumbnailVariantRead(SQLModel):
+    url: str
+    width: int
+    format: str
+
+
 # --- 新增：带创作者信息的画廊作品响应模型 ---
 class GalleryItemReadWithBuilder(GalleryItemRead):
     builder: Optional[MemberRead] = None
+    thumbnail_variants: Optional[List[ThumbnailVariantRead]] = None
 
 
 class GalleryItemUpdate(GalleryItemBase):
@@ -368,6 +391,60 @@ class GalleryItemUpdate(GalleryItemBase):
     pass
 
 
+# --- 内容寻址媒体文件模型 ---
+
+class MediaBlob(SQLModel, table=True):
+    """
+    数据库中的 MediaBlob 表模型。
+    相同内容的上传只在磁盘上保存一份 (按 SHA-256 寻址)，ref_count 记录引用它的画廊作品数量，
+    归零时才删除磁盘上的文件。
+    """
+    sha256: str = Field(primary_key=True, description="文件内容的 SHA-256 十六进制摘要")
+    image_url: str = Field(description="原始文件URL")
+    thumbnail_url: Optional[str] = Field(default=None, description="缩略图URL")
+    thumbnail_variants: Optional[List[dict]] = Field(default=None, sa_column=Column(JSON, nullable=True),
+                                                     description="多分辨率缩略图变体 [{url, width, format}]")
+    mime_type: str = Field(description="识别出的文件类型")
+    size: int = Field(sa_column=Column(BigInteger, nullable=False), description="文件字节数")
+    ref_count: int = Field(default=0, nullable=False, description="引用此文件的画廊作品数量")
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="创建时间 (UTC)"
+    )
+    updated_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="最后更新时间 (UTC)"
+    )
+    __table_args__ = {'extend_existing': True}
+
+
+# --- 行数计数器模型 ---
+
+class RowCounter(SQLModel, table=True):
+    """
+    数据库中的 RowCounter 表模型。
+    与对应表的增删在同一事务中更新，列表接口读取它来计算总页数，不必每次 COUNT(*) 扫描全表。
+    """
+    table_name: str = Field(primary_key=True, description="被计数的表名")
+    row_count: int = Field(default=0, sa_column=Column(BigInteger, nullable=False), description="当前行数")
+    __table_args__ = {'extend_existing': True}
+
+
+# --- 已吊销令牌模型 ---
+
+class RevokedToken(SQLModel, table=True):
+    """
+    数据库中的 RevokedToken 表模型。
+    登出时记录令牌的 jti，保留到令牌本身过期为止；各 worker 启动时加载到内存中的吊销列表。
+    """
+    jti: str = Field(primary_key=True, description="令牌ID (JWT 的 jti)")
+    user_id: int = Field(index=True, description="令牌所属的用户ID")
+    expires_at: datetime.datetime = Field(index=True, description="令牌过期时间 (UTC)")
+    __table_args__ = {'extend_existing': True}
+
+
 # 用于友情链接的模型
 class FriendLink(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -406,4 +483,170 @@ class AdminUserUpdate(SQLModel):
     username: Optional[str] = None
     role: Optional[UserRole] = None
     is_active: Optional[bool] = None
-    is_verified: Optional[bool] = None
\ No newline at end of file
+    is_verified: Optional[bool] = None
+
+
+# --- 持久化后台任务队列模型 ---
+
+class JobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    FAILED = "failed"
+
+
+class Job(SQLModel, table=True):
+    """
+    数据库中的 Job 表模型。
+    缩略图生成和邮件发送等任务写入此表，由独立的 worker 进程领取执行 (SELECT ... FOR UPDATE SKIP LOCKED)。
+    执行成功的任务会被删除；超过最大重试次数的任务保留为 FAILED 状态以便排查。
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(index=True, description="任务类型")
+    payload: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False), description="任务参数")
+    status: JobStatus = Field(default=JobStatus.PENDING, nullable=False, description="任务状态")
+    attempts: int = Field(default=0, nullable=False, description="已尝试次数")
+    max_attempts: int = Field(default=5, nullable=False, description="最大尝试次数")
+    run_after: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="最早可执行时间 (UTC)，用于指数退避重试"
+    )
+    locked_at: Optional[datetime.datetime] = Field(default=None, description="被 worker 领取的时间 (UTC)")
+    last_error: Optional[str] = Field(default=None, description="最近一次失败的错误信息")
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="创建时间 (UTC)"
+    )
+    updated_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="最后更新时间 (UTC)"
+    )
+
+    __table_args__ = (
+        Index("ix_job_status_run_after", "status", "run_after"),
+        {'extend_existing': True}
+    )
+
+
+
+# --- 全站群发邮件模型 ---
+
+class BroadcastStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+
+
+class BroadcastCreate(SQLModel):
+    """
+    管理员创建群发邮件时提交的请求体模型。正文为纯文本，发送时会转义并保留换行。
+    """
+    subject: str = Field(min_length=1, max_length=200, description="邮件主题")
+    body: str = Field(min_length=1, max_length=20000, description="邮件正文 (纯文本)")
+    only_verified: bool = Field(default=True, description="是否只发送给已验证邮箱的用户")
+
+
+class Broadcast(SQLModel, table=True):
+    """
+    数据库中的 Broadcast 表模型 (全站群发邮件)。
+    收件人按 user.id 递增的顺序分页读取，每发送完一批就把该批最大的 user.id 写入 last_user_id (检查点)，
+    进程崩溃后从检查点继续，最多重复发送一批。heartbeat_at 用于判断执行者是否还活着，防止两个进程同时发送同一个群发。
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    subject: str = Field(description="邮件主题")
+    body: str = Field(sa_column=Column(Text, nullable=False), description="邮件正文 (纯文本)")
+    only_verified: bool = Field(default=True, nullable=False, description="是否只发送给已验证邮箱的用户")
+    status: BroadcastStatus = Field(default=BroadcastStatus.PENDING, nullable=False, index=True, description="群发状态")
+    created_by_id: Optional[int] = Field(default=None, description="创建群发的管理员ID")
+    total_recipients: int = Field(default=0, nullable=False, description="创建时统计的收件人数量 (估计值)")
+    last_user_id: int = Field(default=0, nullable=False, description="检查点：已处理完的最大 user.id")
+    sent_count: int = Field(default=0, nullable=False, description="发送成功的数量")
+    failed_count: int = Field(default=0, nullable=False, description="发送失败的数量")
+    failures: list = Field(default_factory=list, sa_column=Column(JSON, nullable=False),
+                           description="最近的发送失败记录 (user_id, email, error)，数量有上限")
+    last_error: Optional[str] = Field(default=None, description="最近一次中断的错误信息")
+    heartbeat_at: Optional[datetime.datetime] = Field(default=None, description="执行者最后一次心跳的时间 (UTC)")
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="创建时间 (UTC)"
+    )
+    updated_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="最后更新时间 (UTC)"
+    )
+    finished_at: Optional[datetime.datetime] = Field(default=None, description="完成或取消的时间 (UTC)")
+    __table_args__ = {'extend_existing': True}
+
+
+class BroadcastRead(SQLModel):
+    id: int
+    subject: str
+    body: str
+    only_verified: bool
+    status: BroadcastStatus
+    created_by_id: Optional[int]
+    total_recipients: int
+    last_user_id: int
+    sent_count: int
+    failed_count: int
+    failures: list
+    last_error: Optional[str]
+    heartbeat_at: Optional[datetime.datetime]
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+    finished_at: Optional[datetime.datetime]
+
+
+# --- 可续传上传会话模型 ---
+
+class UploadSessionBase(SQLModel):
+    title: str = Field(description="作品标题")
+    builder_name: str = Field(description="创作者名称")
+    description: Optional[str] = Field(default=None, description="作品描述")
+    filename: str = Field(description="原始文件名")
+    total_size: int = Field(sa_column=Column(BigInteger, nullable=False), description="文件总字节数")
+
+
+class UploadSession(UploadSessionBase, table=True):
+    """
+    数据库中的 UploadSession 表模型 (tus 风格的可续传上传)。
+    已接收的数据直接追加到磁盘上的临时文件，offset 记录已确认写入的字节数。
+    PATCH 写入期间通过 lease_id / lease_expires_at 持有租约，而不是在整个上传过程中持有行锁。
+    """
+    id: str = Field(primary_key=True, description="上传会话ID (随机 UUID)")
+    user_id: int = Field(foreign_key="user.id", index=True, description="上传用户的ID")
+    offset: int = Field(default=0, sa_column=Column(BigInteger, nullable=False), description="已接收的字节数")
+    created_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        description="创建时间 (UTC)"
+    )
+    updated_at: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(timezone.utc).replace(tzinfo=None),
+        nullable=False,
+        index=True,
+        description="最后一次接收数据的时间 (UTC)，用于清理过期的上传"
+    )
+    lease_id: Optional[str] = Field(default=None, description="正在写入该上传的请求持有的租约ID")
+    lease_expires_at: Optional[datetime.datetime] = Field(default=None, description="写入租约的过期时间 (UTC)")
+    __table_args__ = {'extend_existing': True}
+
+
+class UploadSessionCreate(UploadSessionBase):
+    """
+    用于创建可续传上传会话时接收的请求体模型。
+    """
+    pass
+
+
+class UploadSessionRead(SQLModel):
+    id: str
+    offset: int
+    total_size: int
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
@@ -0,0 +1,121 @@
+﻿# backend/password_hasher.py
+"""
+密码哈希执行器。
+
+bcrypt 每次哈希/校验需要数百毫秒的 CPU 时间，直接在异步端点中调用会阻塞整个事件循环 (登录高峰时所有请求都会卡住)。
+这里把哈希运算放到专用的、线程数有限的线程池中执行 (bcrypt 计算期间会释放 GIL)，
+排队的任务数量有上限，超出时抛出 PasswordHasherBusy，由调用方返回 503，而不是让请求无限堆积。
+未调用 start 时 (例如命令行脚本) 退回到 starlette 的默认线程池，不做排队限制。
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasherBusy(Exception):
+    """等待哈希的任务数已达上限。"""
+
+
+class PasswordHasher:
+    """在专用线程池中执行 CryptContext 的哈希、校验和自动升级 (rehash)。"""
+
+    def __init__(self, context: CryptContext):
+        self.context = context
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._max_workers = 0
+        self._max_pending = 0
+        self._pending = 0
+        self._max_pending_seen = 0
+        self._completed = 0
+        self._rejected = 0
+        self._rehashed = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._total_run_seconds = 0.0
+
+    def start(self, max_workers: int, max_pending: int):
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        logger.info(f"密码哈希线程池已启动: {max_workers} 个线程, 队列上限 {max_pending}")
+
+    async def shutdown(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown, True)
+        logger.info("密码哈希线程池已关闭。")
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            return await run_in_threadpool(func, *args)
+        if self._pending >= self._max_pending:
+            self._rejected += 1
+            raise PasswordHasherBusy()
+
+        enqueued_at = time.perf_counter()
+        timings = {}
+
+        def _timed():
+            started_at = time.perf_counter()
+            timings["wait"] = started_at - enqueued_at
+            try:
+                return func(*args)
+            finally:
+                timings["run"] = time.perf_counter() - started_at
+
+        self._pending += 1
+        self._max_pending_seen = max(self._max_pending_seen, self._pending)
+        try:
+            # 调用方被取消时线程中的计算仍会完成，计数在 finally 中照常回收
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _timed)
+        finally:
+            self._pending -= 1
+            if "run" in timings:
+                self._completed += 1
+                self._total_wait_seconds += timings["wait"]
+                self._max_wait_seconds = max(self._max_wait_seconds, timings["wait"])
+                self._total_run_seconds += timings["run"]
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(self.context.verify, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """
+        校验密码；哈希使用的参数 (例如 bcrypt 的 rounds) 与当前配置不一致时，同时返回按当前配置重新计算的哈希，
+        调用方保存后即完成透明升级。返回 (是否正确, 新哈希或 None)。
+        """
+        verified, new_hash = await self._run(self.context.verify_and_update, password, hashed_password)
+        if verified and new_hash is not None:
+            self._rehashed += 1
+        return verified, new_hash
+
+    def stats(self) -> dict:
+        # 线程池中有空闲线程时任务会立即开始执行，因此超出线程数的部分就是排队中的任务
+        running = min(self._pending, self._max_workers)
+        return {
+            "workers": self._max_workers,
+            "max_pending": self._max_pending,
+            "pending": self._pending,
+            "queued": self._pending - running,
+            "running": running,
+            "max_pending_seen": self._max_pending_seen,
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "rehashed": self._rehashed,
+            "avg_wait_ms": round(self._total_wait_seconds / self._completed * 1000, 2) if self._completed else 0.0,
+            "max_wait_ms": round(self._max_wait_seconds * 1000, 2),
+            "avg_run_ms": round(self._total_run_seconds / self._completed * 1000, 2) if self._completed else 0.0,
+        }
@@ -0,0 +1,186 @@
+﻿# backend/response_cache.py
+"""
+公开只读接口的响应缓存。
+
+缓存键 = 接口名 + 查询参数 + 所依赖实体的版本号。crud 中的写操作在事务提交后递增对应实体的版本号，
+旧版本的缓存条目不再被命中，随 TTL 过期或被 LRU 淘汰，无需逐个删除。
+
+后端可插拔：
+- memory: 进程内 LRU + TTL，适合单 worker 部署 (多 worker 时其他进程的缓存最多在 TTL 内过时)；
+- redis:  多个 worker 共享缓存和版本号 (需要安装 redis 包，开发时可以连本地的 Redis 或兼容实现)。
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # 可选依赖，只有 RESPONSE_CACHE_BACKEND=redis 时需要
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+# --- 缓存实体 (写操作递增它们的版本号) ---
+ENTITY_GALLERY = "gallery"
+ENTITY_MEMBERS = "members"
+ENTITY_FRIEND_LINKS = "friend_links"
+
+
+class MemoryCacheBackend:
+    """进程内 LRU 缓存，条目带过期时间；版本号保存在进程内存中。"""
+
+    def __init__(self, max_entries: int):
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._max_entries = max_entries
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl_seconds: int):
+        self._entries[key] = (time.monotonic() + ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_versions(self, entities: Iterable[str]) -> List[int]:
+        return [self._versions.get(entity, 0) for entity in entities]
+
+    async def bump_version(self, entity: str):
+        self._versions[entity] = self._versions.get(entity, 0) + 1
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class RedisCacheBackend:
+    """基于 Redis 的共享缓存：条目使用 Redis 自带的过期时间，版本号用 INCR 原子递增。"""
+
+    def __init__(self, url: str, prefix: str = "andyley:"):
+        if redis_asyncio is None:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis 需要安装 redis 包 (pip install redis)。")
+        self._client = redis_asyncio.from_url(url)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._client.get(self._prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl_seconds: int):
+        await self._client.set(self._prefix + key, value, ex=ttl_seconds)
+
+    async def get_versions(self, entities: Iterable[str]) -> List[int]:
+        values = await self._client.mget([f"{self._prefix}version:{entity}" for entity in entities])
+        return [int(value) if value is not None else 0 for value in values]
+
+    async def bump_version(self, entity: str):
+        await self._client.incr(f"{self._prefix}version:{entity}")
+
+    def size(self) -> Optional[int]:
+        return None  # 共享缓存的条目数不在本进程统计
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class ResponseCache:
+    """
+    响应缓存的统一入口。未配置后端 (或 RESPONSE_CACHE_BACKEND=none) 时直接调用 produce，不做缓存。
+    后端出错时记录日志并退回到直接查询，缓存故障不会影响接口可用性。
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._backend_name = "none"
+        self._ttl_seconds = 0
+        self._hits = 0
+        self._misses = 0
+        self._bumps = 0
+        self._errors = 0
+
+    def configure(self, backend_name: str, ttl_seconds: int, max_entries: int, redis_url: str):
+        if backend_name == "memory":
+            self._backend = MemoryCacheBackend(max_entries=max_entries)
+        elif backend_name == "redis":
+            self._backend = RedisCacheBackend(url=redis_url)
+        else:
+            self._backend = None
+        self._backend_name = backend_name if self._backend is not None else "none"
+        self._ttl_seconds = ttl_seconds
+        logger.info(f"响应缓存后端: {self._backend_name} (TTL {ttl_seconds}s)")
+
+    async def close(self):
+        if self._backend is not None:
+            await self._backend.close()
+            self._backend = None
+
+    async def get_or_produce(self, endpoint: str, params: dict, entities: Tuple[str, ...],
+                             produce: Callable[[], Awaitable[bytes]]) -> Tuple[bytes, bool]:
+        """返回 (响应体, 是否命中缓存)。未命中时调用 produce 生成响应体并写入缓存。"""
+        if self._backend is None:
+            return await produce(), False
+
+        key = None
+        try:
+            versions = await self._backend.get_versions(entities)
+            query = "&".join(f"{name}={params[name]}" for name in sorted(params))
+            key = f"resp:{endpoint}?{query}#" + ".".join(str(version) for version in versions)
+            cached = await self._backend.get(key)
+        except Exception as e:
+            self._errors += 1
+            logger.error(f"读取响应缓存失败: {e}")
+            cached = None
+
+        if cached is not None:
+            self._hits += 1
+            return cached, True
+
+        self._misses += 1
+        body = await produce()
+        if key is not None:
+            try:
+                await self._backend.set(key, body, self._ttl_seconds)
+            except Exception as e:
+                self._errors += 1
+                logger.error(f"写入响应缓存失败: {e}")
+        return body, False
+
+    async def bump(self, *entities: str):
+        """递增实体的版本号，使依赖它们的缓存条目失效。必须在写操作的事务提交之后调用。"""
+        if self._backend is None:
+            return
+        for entity in entities:
+            try:
+                await self._backend.bump_version(entity)
+                self._bumps += 1
+            except Exception as e:
+                self._errors += 1
+                logger.error(f"递增缓存版本号失败 ({entity}): {e}")
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses
+        return {
+            "backend": self._backend_name,
+            "ttl_seconds": self._ttl_seconds,
+            "entries": self._backend.size() if self._backend is not None else 0,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self._bumps,
+            "errors": self._errors,
+        }
+
+
+# 进程内唯一实例：main.py 在应用启动时配置后端，crud 的写操作通过它递增版本号
+response_cache = ResponseCache()
@@ -0,0 +1,326 @@
+﻿# backend/storage_gc.py
+"""
+上传目录的存储回收 (对账)。
+
+文件会因为多种原因泄漏：上传在文件写入之后、事务提交之前失败，用户更换头像时旧文件没有删除，
+缩略图生成失败留下的半成品，以及进程在 file_reaper 删除完成前退出。
+这里定期对账 UPLOAD_DIR 和数据库：
+1. 用 os.scandir 流式遍历 UPLOAD_DIR (不一次性列出所有文件)，跳过比 STORAGE_GC_MIN_AGE_HOURS 更新的文件；
+2. 用集合差得到不再被引用的文件：
+   - media/ 下内容寻址的文件 (原图、缩略图和变体的文件名都以 SHA-256 开头) 每 STORAGE_GC_BATCH_SIZE 个
+     按主键查询一次 MediaBlob；
+   - 其他文件对比作品的原图、缩略图、缩略图变体 URL，以及用户头像和成员头像 URL。
+     这些 URL 列没有索引，因此在运行开始时一次性读出 (只有旧版上传，数量有限)，之后在内存中比较；
+3. 孤儿文件移入隔离区 QUARANTINE_DIR/<本次运行时间>/ (保留原来的相对路径，误判时可以用 --restore 恢复)；
+4. 超过 STORAGE_GC_QUARANTINE_DAYS 的隔离批次被删除，此时磁盘空间才真正释放。
+
+多个 API worker 同时调度时用 advisory lock 保证只有一个在执行。
+
+手动运行 (在项目根目录下):
+    python -m backend.storage_gc --dry-run          # 只统计，不移动文件
+    python -m backend.storage_gc                    # 对账一次并清理过期的隔离批次
+    python -m backend.storage_gc --restore 20261017T030000Z
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from backend import crud
+from backend.core.config import get_settings
+from backend.database import AsyncSessionLocal, async_engine
+from backend.upload_storage import MEDIA_SUBDIR, media_digest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_DIR = Path(__file__).resolve().parent / "uploads"
+# 隔离区不在 /uploads 静态目录下，隔离的文件不会再被公开访问
+QUARANTINE_DIR = Path(__file__).resolve().parent / "quarantine"
+# 隔离批次目录名 (UTC 时间)
+RUN_ID_FORMAT = "%Y%m%dT%H%M%SZ"
+# pg_try_advisory_xact_lock 的键，任意固定值
+STORAGE_GC_LOCK_KEY = 0x5354_4743
+
+
+class StorageGcBusy(Exception):
+    """另一个进程正在执行存储回收。"""
+
+
+@dataclass
+class StorageGcReport:
+    run_id: str
+    dry_run: bool
+    scanned_files: int = 0
+    scanned_bytes: int = 0
+    skipped_recent: int = 0
+    orphaned_files: int = 0
+    quarantined_bytes: int = 0
+    purged_runs: int = 0
+    purged_files: int = 0
+    reclaimed_bytes: int = 0  # 删除过期隔离批次实际释放的磁盘空间
+    errors: int = 0
+    duration_seconds: float = 0.0
+    orphan_samples: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+# --- 同步的文件系统操作 (在线程池中执行) ---
+
+def iter_upload_files(upload_dir: Path) -> Iterator[Tuple[str, int, float]]:
+    """流式遍历上传目录中的普通文件，产出 (相对路径, 字节数, 修改时间)。不跟随符号链接。"""
+    stack = [upload_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            relative = Path(entry.path).relative_to(upload_dir).as_posix()
+                            yield relative, stat.st_size, stat.st_mtime
+                    except OSError as e:
+                        logger.error(f"读取 {entry.path} 失败: {e}")
+        except OSError as e:
+            logger.error(f"遍历目录 {directory} 失败: {e}")
+
+
+def _next_batch(files: Iterator[Tuple[str, int, float]], size: int) -> List[Tuple[str, int, float]]:
+    batch = []
+    for entry in files:
+        batch.append(entry)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _quarantine_files(upload_dir: Path, run_dir: Path, orphans: List[Tuple[str, int, float]]) -> Tuple[int, int, int]:
+    """把孤儿文件移入隔离批次目录，返回 (文件数, 字节数, 错误数)。移动前重新检查修改时间，跳过刚被重新写入的文件。"""
+    moved, moved_bytes, errors = 0, 0, 0
+    for relative, size, mtime in orphans:
+        source = upload_dir / relative
+        destination = run_dir / relative
+        try:
+            if source.stat().st_mtime != mtime:
+                continue  # 检查之后文件被重新写入 (例如相同内容被再次上传)，留到下次对账
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(source), str(destination))
+            moved += 1
+            moved_bytes += size
+        except FileNotFoundError:
+            continue  # 已被 file_reaper 删除
+        except OSError as e:
+            errors += 1
+            logger.error(f"隔离文件 {source} 失败: {e}")
+    return moved, moved_bytes, errors
+
+
+def _directory_usage(directory: Path) -> Tuple[int, int]:
+    files, size = 0, 0
+    for _, file_size, _ in iter_upload_files(directory):
+        files += 1
+        size += file_size
+    return files, size
+
+
+def purge_quarantine(quarantine_dir: Path, retention_days: int, now: datetime.datetime) -> Tuple[int, int, int]:
+    """删除超过保留期的隔离批次，返回 (批次数, 文件数, 释放的字节数)。"""
+    if not quarantine_dir.is_dir():
+        return 0, 0, 0
+    cutoff = now - datetime.timedelta(days=retention_days)
+    runs, files, reclaimed = 0, 0, 0
+    with os.scandir(quarantine_dir) as entries:
+        for entry in entries:
+            try:
+                run_time = datetime.datetime.strptime(entry.name, RUN_ID_FORMAT)
+            except ValueError:
+                continue  # 不是隔离批次目录
+            if run_time >= cutoff or not entry.is_dir(follow_symlinks=False):
+                continue
+            run_files, run_bytes = _directory_usage(Path(entry.path))
+            try:
+                shutil.rmtree(entry.path)
+            except OSError as e:
+                logger.error(f"删除隔离批次 {entry.name} 失败: {e}")
+                continue
+            runs += 1
+            files += run_files
+            reclaimed += run_bytes
+    return runs, files, reclaimed
+
+
+def restore_quarantine_run(upload_dir: Path, quarantine_dir: Path, run_id: str) -> int:
+    """把一个隔离批次中的文件移回上传目录 (目标位置已有文件时跳过)，返回恢复的文件数量。"""
+    run_dir = quarantine_dir / run_id
+    restored = 0
+    for relative, _, _ in iter_upload_files(run_dir):
+        destination = upload_dir / relative
+        if destination.exists():
+            continue
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(run_dir / relative), str(destination))
+        restored += 1
+    return restored
+
+
+# --- 对账 ---
+
+async def _load_referenced_urls() -> Set[str]:
+    """数据库引用的所有非内容寻址上传 URL，每次运行读取一次。"""
+    async with AsyncSessionLocal() as session:
+        return await crud.get_referenced_upload_urls(db=session, exclude_prefix=f"/uploads/{MEDIA_SUBDIR}/")
+
+
+async def _find_orphans(batch: List[Tuple[str, int, float]],
+                        referenced_urls: Set[str]) -> List[Tuple[str, int, float]]:
+    """一批文件中不再被数据库引用的文件 (每批一次 MediaBlob 主键查询)。"""
+    media_hashes = {}
+    urls = {}
+    for entry in batch:
+        digest = media_digest(entry[0])
+        if digest is not None:
+            media_hashes[entry[0]] = digest
+        else:
+            urls[entry[0]] = f"/uploads/{entry[0]}"
+    live_hashes = set()
+    if media_hashes:
+        async with AsyncSessionLocal() as session:
+            live_hashes = await crud.find_existing_media_hashes(db=session, hashes=sorted(set(media_hashes.values())))
+    return [
+        entry for entry in batch
+        if (entry[0] in media_hashes and media_hashes[entry[0]] not in live_hashes)
+        or (entry[0] in urls and urls[entry[0]] not in referenced_urls)
+    ]
+
+
+async def reconcile_storage(upload_dir: Path, quarantine_dir: Path = QUARANTINE_DIR, dry_run: bool = False,
+                            purge: bool = True) -> StorageGcReport:
+    """
+    执行一次对账并 (可选) 清理过期的隔离批次，返回统计报告。
+    另一个进程正在执行时抛出 StorageGcBusy。
+    """
+    settings = get_settings()
+    started = time.monotonic()
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    report = StorageGcReport(run_id=now.strftime(RUN_ID_FORMAT), dry_run=dry_run)
+    run_dir = quarantine_dir / report.run_id
+    min_mtime = time.time() - settings.STORAGE_GC_MIN_AGE_HOURS * 3600
+
+    # 锁会话在整个对账期间保持事务打开，结束时回滚即释放锁
+    async with AsyncSessionLocal() as lock_session:
+        if not await crud.try_advisory_xact_lock(db=lock_session, key=STORAGE_GC_LOCK_KEY):
+            raise StorageGcBusy("另一个进程正在执行存储回收。")
+        try:
+            # 引用快照在运行开始时读取；运行期间新写入的文件比 STORAGE_GC_MIN_AGE_HOURS 新，本来就会被跳过
+            referenced_urls = await _load_referenced_urls()
+            files = iter_upload_files(upload_dir)
+            while True:
+                batch = await run_in_threadpool(_next_batch, files, settings.STORAGE_GC_BATCH_SIZE)
+                if not batch:
+                    break
+                report.scanned_files += len(batch)
+                report.scanned_bytes += sum(size for _, size, _ in batch)
+                candidates = [entry for entry in batch if entry[2] < min_mtime]
+                report.skipped_recent += len(batch) - len(candidates)
+
+                orphans = await _find_orphans(candidates, referenced_urls)
+                if not orphans:
+                    continue
+                report.orphan_samples.extend(relative for relative, _, _ in orphans[:20 - len(report.orphan_samples)])
+                if dry_run:
+                    report.orphaned_files += len(orphans)
+                    report.quarantined_bytes += sum(size for _, size, _ in orphans)
+                    continue
+                moved, moved_bytes, errors = await run_in_threadpool(_quarantine_files, upload_dir, run_dir, orphans)
+                report.orphaned_files += moved
+                report.quarantined_bytes += moved_bytes
+                report.errors += errors
+
+            if purge and not dry_run:
+                report.purged_runs, report.purged_files, report.reclaimed_bytes = await run_in_threadpool(
+                    purge_quarantine, quarantine_dir, settings.STORAGE_GC_QUARANTINE_DAYS, now)
+        finally:
+            await lock_session.rollback()
+
+    report.duration_seconds = round(time.monotonic() - started, 3)
+    logger.info(
+        f"存储回收{'(演练)' if dry_run else ''}完成: 扫描 {report.scanned_files} 个文件，"
+        f"隔离 {report.orphaned_files} 个孤儿文件 ({report.quarantined_bytes} 字节)，"
+        f"删除 {report.purged_runs} 个过期隔离批次释放 {report.reclaimed_bytes} 字节，耗时 {report.duration_seconds}s"
+    )
+    return report
+
+
+class StorageCollector:
+    """保存最近一次对账的报告，供管理接口查看。"""
+
+    def __init__(self):
+        self._last_report: Optional[StorageGcReport] = None
+        self._running = False
+
+    async def run(self, upload_dir: Path, dry_run: bool = False) -> StorageGcReport:
+        self._running = True
+        try:
+            report = await reconcile_storage(upload_dir, dry_run=dry_run)
+        finally:
+            self._running = False
+        self._last_report = report
+        return report
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "last_report": self._last_report.as_dict() if self._last_report is not None else None,
+        }
+
+
+# 进程内唯一实例
+storage_collector = StorageCollector()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上传目录的存储回收")
+    parser.add_argument("--dry-run", action="store_true", help="只统计孤儿文件，不移动")
+    parser.add_argument("--no-purge", action="store_true", help="不删除过期的隔离批次")
+    parser.add_argument("--restore", metavar="RUN_ID", help="把指定隔离批次中的文件移回上传目录")
+    parser.add_argument("--upload-dir", type=Path, default=DEFAULT_UPLOAD_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+    if args.restore:
+        restored = restore_quarantine_run(args.upload_dir, QUARANTINE_DIR, args.restore)
+        logger.info(f"已从隔离批次 {args.restore} 恢复 {restored} 个文件。")
+        return
+
+    async def _main():
+        async_engine.echo = False  # database.py 默认打开了 SQL 日志
+        try:
+            report = await reconcile_storage(args.upload_dir, dry_run=args.dry_run, purge=not args.no_purge)
+        finally:
+            await async_engine.dispose()
+        for name, value in report.as_dict().items():
+            print(f"{name:>18}: {value}")
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+﻿# backend/thumbnails.py
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import cv2
+from PIL import Image as PILImage
+from PIL.Image import Resampling
+
+from backend.models import ItemType
+
+logger = logging.getLogger(__name__)
+
+
+# --- 缩略图生成函数 (在独立进程中执行，因此必须是模块级函数) ---
+
+def _save_atomically(image: PILImage.Image, save_path: Path, image_format: Optional[str] = None, **params):
+    """
+    先写入同目录下的临时文件再 os.replace。缩略图 URL 按 immutable 缓存一年，
+    不能让客户端或 CDN 读到写了一半的文件。格式由目标扩展名决定 (临时文件名不带可识别的扩展名)。
+    """
+    if image_format is None:
+        PILImage.init()
+        image_format = PILImage.registered_extensions()[save_path.suffix.lower()]
+    temp_path = save_path.with_name(f"{save_path.name}.{os.getpid()}.tmp")
+    try:
+        image.save(temp_path, image_format, **params)
+        os.replace(temp_path, save_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+THUMBNAIL_SIZE = (400, 400)
+
+
+def _save_thumbnail(img: PILImage.Image, thumbnail_save_path: Path, size: tuple[int, int]):
+    """把已解码的图片缩小到 size 以内并保存为缩略图 (不修改传入的图片)。"""
+    thumbnail = img.copy()
+    thumbnail.thumbnail(size, Resampling.LANCZOS)
+    if thumbnail.mode in ("RGBA", "P"):
+        thumbnail = thumbnail.convert("RGB")
+    _save_atomically(thumbnail, thumbnail_save_path)
+
+
+def create_image_thumbnail(
+        original_image_path: Path,
+        thumbnail_save_path: Path,
+        size: tuple[int, int] = THUMBNAIL_SIZE
+):
+    """为图片文件创建缩略图"""
+    try:
+        with PILImage.open(original_image_path) as img:
+            _save_thumbnail(img, thumbnail_save_path, size)
+            logger.info(f"图片缩略图已保存到: {thumbnail_save_path}")
+            return True
+    except Exception as e:
+        logger.error(f"创建图片缩略图失败: {e}")
+        return False
+
+
+def create_video_thumbnail(
+        video_path: Path,
+        thumbnail_save_path: Path,
+        size: tuple[int, int] = THUMBNAIL_SIZE
+) -> bool:
+    """为视频文件创建缩略图 (封面)"""
+    try:
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            logger.error(f"无法打开视频文件: {video_path}")
+            return False
+
+        ret, frame = cap.read()
+        if not ret:
+            logger.error(f"无法从视频读取帧: {video_path}")
+            cap.release()
+            return False
+
+        frame_pil = PILImage.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        _save_thumbnail(frame_pil, thumbnail_save_path, size)
+
+        cap.release()
+        logger.info(f"视频封面已保存到: {thumbnail_save_path}")
+        return True
+    except Exception as e:
+        logger.error(f"创建视频封面失败: {e}")
+        return False
+
+
+# --- 多分辨率缩略图变体 (供前端 srcset 使用) ---
+
+# 变体格式 -> (Pillow 编码器名称, 文件扩展名)
+VARIANT_FORMATS = {
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+    "avif": ("AVIF", ".avif"),
+}
+
+# 一个变体: (宽度, 格式, 保存路径)。规划时是目标宽度，生成后是实际宽度 (原图较小时不会放大)
+ThumbnailVariant = Tuple[int, str, Path]
+
+
+def supported_variant_formats(formats: Iterable[str]) -> List[str]:
+    """过滤掉当前 Pillow 无法编码的格式 (例如没有安装 AVIF 插件时的 avif)。"""
+    PILImage.init()
+    return [fmt for fmt in formats if fmt in VARIANT_FORMATS and VARIANT_FORMATS[fmt][0] in PILImage.SAVE]
+
+
+def plan_thumbnail_variants(base_path: Path, widths: Iterable[int], formats: Iterable[str]) -> List[ThumbnailVariant]:
+    """
+    根据不带扩展名的路径前缀规划变体文件，例如 <base>_w320.webp。
+    路径是确定的，因此可以在生成之前就把 URL 写入数据库。按宽度从大到小排列，便于逐级缩小。
+    """
+    formats = list(formats)
+    return [
+        (width, fmt, base_path.with_name(f"{base_path.name}_w{width}{VARIANT_FORMATS[fmt][1]}"))
+        for width in sorted(set(widths), reverse=True)
+        for fmt in formats
+    ]
+
+
+def _load_source_frame(source_path: Path, item_type: ItemType, max_width: int) -> Optional[PILImage.Image]:
+    """读取图片 (或视频的第一帧)。JPEG 使用 draft 模式按接近目标尺寸的比例解码，减少解码开销。"""
+    if item_type == ItemType.VIDEO:
+        cap = cv2.VideoCapture(str(source_path))
+        try:
+            ret, frame = cap.read() if cap.isOpened() else (False, None)
+        finally:
+            cap.release()
+        if not ret:
+            return None
+        return PILImage.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    with PILImage.open(source_path) as img:
+        if img.width > max_width:
+            img.draft("RGB", (max_width, max(1, img.height * max_width // img.width)))
+        img.load()
+        return img.copy()
+
+
+def variant_widths_by_name(variants: Iterable[ThumbnailVariant]) -> Dict[str, int]:
+    """已生成的变体: 文件名 -> 实际宽度，用于把实际宽度写回数据库中规划好的变体记录。"""
+    return {save_path.name: width for width, _, save_path in variants}
+
+
+def _render_variants(img: PILImage.Image, variants: List[ThumbnailVariant], quality: int) -> List[ThumbnailVariant]:
+    """
+    按宽度从大到小逐级缩小，并把每个宽度编码为所有请求的格式。不会放大小于目标宽度的原图，
+    因此多个目标宽度可能得到同样大小的图片：只生成第一个，其余的跳过。
+    返回实际生成的变体 (实际宽度, 格式, 保存路径)。
+    """
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+    produced = []
+    seen = set()
+    current = img
+    for width, fmt, save_path in variants:
+        if width < current.width:
+            current = current.resize((width, max(1, round(current.height * width / current.width))),
+                                     Resampling.LANCZOS)
+        if (current.width, fmt) in seen:
+            continue
+        seen.add((current.width, fmt))
+        encoder = VARIANT_FORMATS[fmt][0]
+        output = current.convert("RGB") if encoder == "JPEG" and current.mode != "RGB" else current
+        _save_atomically(output, save_path, encoder, quality=quality)
+        produced.append((current.width, fmt, save_path))
+    return produced
+
+
+def create_thumbnail_variants(
+        source_path: Path,
+        item_type: ItemType,
+        variants: List[ThumbnailVariant],
+        quality: int = 80
+) -> Optional[List[ThumbnailVariant]]:
+    """为源文件生成缩略图变体，返回实际生成的变体；失败时返回 None。"""
+    if not variants:
+        return []
+    try:
+        img = _load_source_frame(source_path, item_type, max(width for width, _, _ in variants))
+        if img is None:
+            logger.error(f"无法读取用于生成缩略图变体的源文件: {source_path}")
+            return None
+        produced = _render_variants(img, variants, quality)
+        logger.info(f"已为 {source_path.name} 生成 {len(produced)} 个缩略图变体")
+        return produced
+    except Exception as e:
+        logger.error(f"创建缩略图变体失败: {e}")
+        return None
+
+
+def _create_thumbnail_and_variants(
+        source_path: Path,
+        thumbnail_save_path: Path,
+        item_type: ItemType,
+        variants: List[ThumbnailVariant],
+        quality: int
+) -> Optional[List[ThumbnailVariant]]:
+    """源文件只解码一次 (JPEG 使用 draft 模式)，同一帧既用于缩略图，也用于各个变体。"""
+    try:
+        max_width = max([THUMBNAIL_SIZE[0]] + [width for width, _, _ in variants])
+        img = _load_source_frame(source_path, item_type, max_width)
+        if img is None:
+            logger.error(f"无法读取用于生成缩略图的源文件: {source_path}")
+            return None
+        _save_thumbnail(img, thumbnail_save_path, THUMBNAIL_SIZE)
+        produced = _render_variants(img, variants, quality)
+        logger.info(f"已为 {source_path.name} 生成缩略图和 {len(produced)} 个缩略图变体")
+        return produced
+    except Exception as e:
+        logger.error(f"创建缩略图和变体失败: {e}")
+        return None
+
+
+def process_thumbnail(
+        original_file_path: Path,
+        thumbnail_save_path: Path,
+        item_type: ItemType,
+        variants: Optional[List[ThumbnailVariant]] = None,
+        variant_quality: int = 80
+) -> Tuple[bool, float, List[ThumbnailVariant]]:
+    """
+    根据项目类型生成图片或视频的缩略图，以及可选的多分辨率变体。
+    返回 (是否成功, 实际处理耗时秒数, 实际生成的变体)，供调用方统计耗时并把变体的实际宽度写回数据库。
+    """
+    started = time.perf_counter()
+    produced: List[ThumbnailVariant] = []
+    if variants:
+        result = _create_thumbnail_and_variants(original_file_path, thumbnail_save_path, item_type,
+                                                variants, variant_quality)
+        success = result is not None
+        produced = result or []
+    elif item_type == ItemType.IMAGE:
+        success = create_image_thumbnail(original_file_path, thumbnail_save_path)
+    elif item_type == ItemType.VIDEO:
+        success = create_video_thumbnail(original_file_path, thumbnail_save_path)
+    else:
+        success = False
+    return success, time.perf_counter() - started, produced
+
+
+# --- 缩略图引擎 ---
+
+class ThumbnailQueueFull(Exception):
+    """缩略图队列已满，调用方应返回 503 并提示客户端稍后重试。"""
+
+
+class ThumbnailReservation:
+    """
+    ThumbnailEngine.reserve 预留的一个队列名额。submit 时被消耗；
+    没有提交任务的路径 (上传失败、内容去重等) 调用 release 归还。release 可以重复调用。
+    """
+
+    def __init__(self, engine: "ThumbnailEngine"):
+        self._engine = engine
+        self._held = True
+
+    def consume(self) -> bool:
+        """把名额交给即将提交的任务；名额已被归还或消耗时返回 False。"""
+        held, self._held = self._held, False
+        if held:
+            self._engine._reserved -= 1
+        return held
+
+    def release(self):
+        if self.consume():
+            self._engine._pending -= 1
+
+
+class ThumbnailEngine:
+    """
+    基于独立进程池的缩略图引擎。
+    缩略图的 CPU 密集型工作不再占用 API 进程的线程池和 GIL；
+    等待中的任务数量有上限，超出时由调用方向客户端施加背压。
+    上传端点在接收文件之前用 reserve 预留名额，并发上传不会在接收期间一起通过检查、之后一起提交而超出上限。
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._max_pending = 0
+        self._pending = 0  # 已预留名额 + 已提交未完成的任务
+        self._reserved = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_run_seconds = 0.0
+        self._total_wait_seconds = 0.0
+        self._max_run_seconds = 0.0
+        self._callbacks: Set[asyncio.Task] = set()
+        # 已提交、尚未完成的任务的缩略图路径，避免同一内容重复提交
+        self._pending_targets: Set[Path] = set()
+
+    def start(self, max_workers: int, max_pending: int):
+        """创建进程池。使用 spawn 方式启动子进程，避免 fork 继承事件循环和数据库连接。"""
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self._max_pending = max_pending
+        logger.info(f"缩略图引擎已启动: {max_workers} 个工作进程, 队列上限 {max_pending}")
+
+    async def shutdown(self):
+        """关闭进程池，等待已提交的任务完成。"""
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown, True)
+        logger.info("缩略图引擎已关闭。")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def is_saturated(self) -> bool:
+        """队列是否已满 (或引擎未启动)。上传端点应在写入文件前检查。"""
+        return self._executor is None or self._pending >= self._max_pending
+
+    def is_pending(self, thumbnail_save_path: Path) -> bool:
+        """该缩略图是否已有提交但尚未完成的任务。"""
+        return thumbnail_save_path in self._pending_targets
+
+    def reserve(self) -> ThumbnailReservation:
+        """预留一个队列名额，队列已满时抛出 ThumbnailQueueFull。"""
+        if self.is_saturated():
+            self._rejected += 1
+            raise ThumbnailQueueFull()
+        self._pending += 1
+        self._reserved += 1
+        return ThumbnailReservation(self)
+
+    def submit(self, original_file_path: Path, thumbnail_save_path: Path, item_type: ItemType,
+               variants: Optional[List[ThumbnailVariant]] = None, variant_quality: int = 80,
+               on_success: Optional[Callable[[List[ThumbnailVariant]], Awaitable[None]]] = None,
+               reservation: Optional[ThumbnailReservation] = None) -> asyncio.Future:
+        """
+        提交一个缩略图任务，立即返回，不等待其完成。
+        背压检查由 reserve 在接收原始文件之前完成，因此这里不再拒绝任务；传入 reservation 时使用预留的名额。
+        任务成功后以实际生成的变体调用 on_success (在事件循环中作为后台任务运行)。
+        """
+        if self._executor is None:
+            raise ThumbnailQueueFull()
+
+        loop = asyncio.get_running_loop()
+        enqueued_at = time.perf_counter()
+        future = loop.run_in_executor(
+            self._executor, process_thumbnail, original_file_path, thumbnail_save_path, item_type,
+            variants, variant_quality
+        )
+        if reservation is None or not reservation.consume():
+            self._pending += 1
+        self._submitted += 1
+        self._pending_targets.add(thumbnail_save_path)
+
+        def _on_done(fut: asyncio.Future):
+            self._pending -= 1
+            self._pending_targets.discard(thumbnail_save_path)
+            total = time.perf_counter() - enqueued_at
+            try:
+                success, run_seconds, produced = fut.result()
+            except Exception as e:
+                self._failed += 1
+                logger.error(f"缩略图任务异常 ({original_file_path.name}): {e}")
+                return
+
+            wait_seconds = max(total - run_seconds, 0.0)
+            self._total_run_seconds += run_seconds
+            self._total_wait_seconds += wait_seconds
+            self._max_run_seconds = max(self._max_run_seconds, run_seconds)
+            if success:
+                self._completed += 1
+                if on_success is not None:
+                    task = loop.create_task(on_success(produced))
+                    self._callbacks.add(task)
+                    task.add_done_callback(self._callbacks.discard)
+            else:
+                self._failed += 1
+            logger.info(
+                f"缩略图任务结束 ({original_file_path.name}): 成功={success}, "
+                f"排队 {wait_seconds * 1000:.1f}ms, 处理 {run_seconds * 1000:.1f}ms"
+            )
+
+        future.add_done_callback(_on_done)
+        return future
+
+    def stats(self) -> dict:
+        finished = self._completed + self._failed
+        return {
+            "running": self._executor is not None,
+            "pending": self._pending,
+            "reserved": self._reserved,
+            "max_pending": self._max_pending,
+            "submitted": self._submitted,
+            "completed": self._completed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "avg_run_ms": round(self._total_run_seconds / finished * 1000, 2) if finished else 0.0,
+            "avg_wait_ms": round(self._total_wait_seconds / finished * 1000, 2) if finished else 0.0,
+            "max_run_ms": round(self._max_run_seconds * 1000, 2),
+        }
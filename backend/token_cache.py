@@ -0,0 +1,151 @@
+﻿# backend/token_cache.py
+"""
+JWT 校验缓存和吊销列表。
+
+同一个访问令牌在有效期内会被重复出示成百上千次，每次都完整 jwt.decode (HMAC + JSON 解析 + TokenData 校验) 是浪费。
+VerifiedTokenCache 以令牌摘要为键缓存校验通过的声明，直到令牌的 exp。
+
+吊销 (登出、禁用用户、重置密码) 通过内存中的 TokenRevocationList 立即生效，不需要每个请求查询数据库：
+- 按 jti 吊销单个令牌 (登出)，条目保留到令牌过期；
+- 按用户纪元吊销该用户在某一时刻之前签发的所有令牌 (iat < epoch)。
+吊销记录持久化在数据库中 (revokedtoken 表和 user.tokens_revoked_at)，启动时加载；
+新的吊销通过 Postgres NOTIFY 广播到所有 worker (见 backend/invalidation.py)。
+"""
+import datetime
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from backend.models import TokenData
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY 频道；payload 为 "jti:<jti>:<exp>" 或 "user:<user_id>:<epoch>"
+TOKEN_REVOCATION_CHANNEL = "token_revoked"
+
+
+def token_cache_key(kind: str, token: str) -> bytes:
+    """缓存键包含令牌类型，访问令牌和刷新令牌使用不同的密钥，不能互相命中。"""
+    return hashlib.sha256(f"{kind}:{token}".encode("utf-8")).digest()
+
+
+def epoch_from_datetime(revoked_at: datetime.datetime) -> int:
+    """
+    把数据库中的吊销时间 (naive UTC) 转换为纪元秒数。
+    JWT 的 iat 是向下取整的整秒，纪元也向下取整：吊销之后同一秒内签发的令牌 (例如重置密码后立即登录) 仍然有效，
+    代价是吊销之前同一秒内签发的令牌也不会失效。
+    """
+    return math.floor(revoked_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+class VerifiedTokenCache:
+    """令牌摘要 -> 已校验的 TokenData，容量有上限的 LRU，条目在令牌过期时失效。"""
+
+    def __init__(self, max_entries: int = 10000):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[bytes, TokenData]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def configure(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries.clear()
+
+    def get(self, key: bytes) -> Optional[TokenData]:
+        token_data = self._entries.get(key)
+        if token_data is None or (token_data.expires_at or 0) <= time.time():
+            if token_data is not None:
+                del self._entries[key]
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return token_data
+
+    def put(self, key: bytes, token_data: TokenData):
+        if self._max_entries <= 0 or token_data.expires_at is None:
+            return
+        self._entries[key] = token_data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses
+        return {
+            "max_entries": self._max_entries,
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class TokenRevocationList:
+    """内存中的吊销集合：jti -> 令牌过期时间，user_id -> 纪元 (Unix 秒)。"""
+
+    def __init__(self):
+        self._revoked_jtis: Dict[str, float] = {}
+        self._user_epochs: Dict[int, int] = {}
+        self._rejected = 0
+
+    def is_revoked(self, token_data: TokenData) -> bool:
+        revoked = (
+            (token_data.jti is not None and token_data.jti in self._revoked_jtis)
+            # 旧版本签发的令牌没有 iat，视为在任何纪元之前签发
+            or (token_data.user_id in self._user_epochs
+                and (token_data.issued_at or 0) < self._user_epochs[token_data.user_id])
+        )
+        if revoked:
+            self._rejected += 1
+        return revoked
+
+    def revoke_jti(self, jti: str, expires_at: float):
+        self._revoked_jtis[jti] = expires_at
+
+    def set_user_epoch(self, user_id: int, epoch: int):
+        self._user_epochs[user_id] = max(epoch, self._user_epochs.get(user_id, 0))
+
+    def load(self, jtis: Iterable[Tuple[str, float]], user_epochs: Iterable[Tuple[int, int]]):
+        """
+        合并数据库中的吊销记录 (启动时，以及失效监听重连后)。
+        只合并不替换：读取期间通过 NOTIFY 收到的新吊销不会被覆盖掉，过期条目由 prune 清理。
+        """
+        for jti, expires_at in jtis:
+            self.revoke_jti(jti, expires_at)
+        for user_id, epoch in user_epochs:
+            self.set_user_epoch(user_id, epoch)
+
+    def prune(self, max_token_lifetime_seconds: float, now: Optional[float] = None):
+        """删除已经没有意义的条目：jti 对应的令牌已过期；纪元早于任何仍然有效的令牌的签发时间。"""
+        now = now or time.time()
+        self._revoked_jtis = {jti: exp for jti, exp in self._revoked_jtis.items() if exp > now}
+        cutoff = now - max_token_lifetime_seconds
+        self._user_epochs = {user_id: epoch for user_id, epoch in self._user_epochs.items() if epoch > cutoff}
+
+    def handle_notification(self, payload: str):
+        try:
+            kind, key, value = payload.split(":", 2)
+            if kind == "jti":
+                self.revoke_jti(key, float(value))
+            elif kind == "user":
+                self.set_user_epoch(int(key), int(value))
+            else:
+                raise ValueError(kind)
+        except ValueError:
+            logger.warning(f"无法解析的令牌吊销消息: {payload!r}")
+
+    def stats(self) -> dict:
+        return {
+            "revoked_jtis": len(self._revoked_jtis),
+            "user_epochs": len(self._user_epochs),
+            "rejected": self._rejected,
+        }
+
+
+# 进程内唯一实例
+verified_token_cache = VerifiedTokenCache()
+token_revocation_list = TokenRevocationList()
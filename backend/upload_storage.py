@@ -0,0 +1,309 @@
+﻿# backend/upload_storage.py
+import hashlib
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Callable, Iterable, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# 用于识别文件类型的头部字节数
+SNIFF_BYTES = 64
+# 写盘缓冲区大小：攒够这么多字节再交给线程池写入，避免每个小块都切换一次线程
+WRITE_BUFFER_BYTES = 1024 * 1024
+# 内容寻址存储的子目录 (位于 UPLOAD_DIR 下，按哈希前缀分两级目录)
+MEDIA_SUBDIR = "media"
+
+_DIGEST_PREFIX_RE = re.compile(r"^[0-9a-f]{64}")
+
+# 识别出的 MIME 类型对应的文件扩展名
+MIME_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "video/mp4": ".mp4",
+    "video/quicktime": ".mov",
+    "video/webm": ".webm",
+    "image/heic": ".heic",
+    "image/heif": ".heif",
+    "image/avif": ".avif",
+}
+
+# ISO-BMFF (ftyp) 容器中表示静态图片的品牌 -> MIME 类型；HEIC/AVIF 照片与 MP4 使用同一种容器
+_IMAGE_BRANDS = {
+    b"avif": "image/avif", b"avis": "image/avif",
+    b"heic": "image/heic", b"heix": "image/heic", b"heim": "image/heic", b"heis": "image/heic",
+    b"hevc": "image/heic", b"hevx": "image/heic",
+    b"mif1": "image/heif", b"msf1": "image/heif",
+}
+
+
+class UploadTooLarge(Exception):
+    """上传内容超过大小限制。"""
+
+
+class UploadDeadlineExceeded(Exception):
+    """写入没有在截止时间前完成 (可续传上传的租约即将过期)。"""
+
+
+class UploadRejected(Exception):
+    """上传内容不被接受 (例如文件类型不允许)。"""
+
+
+def content_addressed_path(upload_dir: Path, digest: str, suffix: str) -> Path:
+    """内容寻址的存储路径，例如 media/ab/cd/abcd...ef.jpg。同样的内容总是得到同样的路径和 URL。"""
+    return upload_dir / MEDIA_SUBDIR / digest[:2] / digest[2:4] / f"{digest}{suffix}"
+
+
+def media_digest(relative_path: str) -> Optional[str]:
+    """media/ab/cd/<sha256>... 形式的相对路径 (原图、缩略图和变体) 返回内容摘要，其他路径返回 None。"""
+    if not relative_path.startswith(MEDIA_SUBDIR + "/"):
+        return None
+    match = _DIGEST_PREFIX_RE.match(relative_path.rsplit("/", 1)[-1])
+    return match.group(0) if match else None
+
+
+def upload_url_to_path(upload_dir: Path, url: str) -> Optional[Path]:
+    """把 /uploads/... 形式的 URL 转换为 UPLOAD_DIR 下的路径；不在 UPLOAD_DIR 内的 URL 返回 None。"""
+    if not url or not url.startswith("/uploads/"):
+        return None
+    root = upload_dir.resolve()
+    path = (root / url[len("/uploads/"):]).resolve()
+    if root not in path.parents:
+        return None
+    return path
+
+
+def upload_path_to_url(upload_dir: Path, path: Path) -> str:
+    """upload_url_to_path 的逆操作：UPLOAD_DIR 下的路径 -> /uploads/... URL。"""
+    return f"/uploads/{path.relative_to(upload_dir).as_posix()}"
+
+
+def any_upload_file_missing(upload_dir: Path, urls: Iterable[Optional[str]]) -> bool:
+    """一组 /uploads/... URL 中是否有文件不存在 (例如缩略图任务丢失或失败)。应在线程池中调用。"""
+    for url in urls:
+        path = upload_url_to_path(upload_dir, url)
+        if path is not None and not path.is_file():
+            return True
+    return False
+
+
+def remove_upload_files(upload_dir: Path, urls: Iterable[Optional[str]]) -> int:
+    """删除一组 /uploads/... URL 对应的文件，返回实际删除的文件数量。单个文件删除失败只记录日志。"""
+    removed = 0
+    for url in urls:
+        path = upload_url_to_path(upload_dir, url) if url else None
+        if path is None:
+            continue
+        try:
+            if path.is_file():
+                path.unlink()
+                removed += 1
+        except OSError as e:
+            logger.error(f"删除文件 {path} 失败: {e}")
+    return removed
+
+
+def move_into_place(source: Path, destination: Path):
+    """把临时文件移动到最终位置 (同一文件系统内只是重命名，不复制数据)。"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(source, destination)
+
+
+def _sniff_iso_bmff(head: bytes) -> str:
+    """
+    按 ftyp 盒子的主品牌区分图片 (HEIC/HEIF/AVIF) 和视频 (MP4/QuickTime)。
+    通用的 HEIF 品牌 (mif1/msf1) 再看兼容品牌列表，其中有 avif/heic 时按更具体的类型返回。
+    """
+    major_brand = head[8:12]
+    if major_brand == b"qt  ":
+        return "video/quicktime"
+    if major_brand not in _IMAGE_BRANDS:
+        return "video/mp4"
+    mime_type = _IMAGE_BRANDS[major_brand]
+    if mime_type == "image/heif":
+        box_end = min(int.from_bytes(head[0:4], "big"), len(head))
+        compatible = {head[offset:offset + 4] for offset in range(16, box_end - 3, 4)}
+        for brand in (b"avif", b"heic"):
+            if brand in compatible:
+                return _IMAGE_BRANDS[brand]
+    return mime_type
+
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """根据文件头部的魔数识别 MIME 类型，不依赖客户端声明的 Content-Type。"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        return _sniff_iso_bmff(head)
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm"
+    return None
+
+
+def _write_and_hash(file_object: BinaryIO, hasher, data: bytes):
+    file_object.write(data)
+    hasher.update(data)
+
+
+async def stream_to_file(
+        chunks: AsyncIterator[bytes],
+        destination_for: Callable[[bytes], Path],
+        max_bytes: int
+) -> Tuple[Path, int, bytes, str]:
+    """
+    把异步字节流直接写入磁盘，文件写入和 SHA-256 计算在线程池中执行。
+
+    先读取足够识别文件类型的头部字节，再调用 destination_for(head) 决定目标路径
+    (它可以抛出 UploadRejected 拒绝该文件)。累计大小超过 max_bytes 时立即中止并删除已写入的部分。
+    返回 (目标路径, 写入字节数, 文件头部, SHA-256 十六进制摘要)。
+    """
+    hasher = hashlib.sha256()
+    buffer = bytearray()
+    total = 0
+    head = b""
+    destination: Optional[Path] = None
+    file_object = None
+
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadTooLarge()
+            buffer.extend(chunk)
+
+            if file_object is None:
+                if len(buffer) < SNIFF_BYTES:
+                    continue
+                head = bytes(buffer[:SNIFF_BYTES])
+                destination = destination_for(head)
+                file_object = await run_in_threadpool(open, destination, "wb")
+
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                await run_in_threadpool(_write_and_hash, file_object, hasher, bytes(buffer))
+                buffer.clear()
+
+        if file_object is None:
+            # 整个文件比 SNIFF_BYTES 还小
+            head = bytes(buffer)
+            destination = destination_for(head)
+            file_object = await run_in_threadpool(open, destination, "wb")
+        if buffer:
+            await run_in_threadpool(_write_and_hash, file_object, hasher, bytes(buffer))
+        await run_in_threadpool(file_object.close)
+        file_object = None
+        return destination, total, head, hasher.hexdigest()
+    except BaseException:
+        if file_object is not None:
+            await run_in_threadpool(file_object.close)
+        if destination is not None:
+            await run_in_threadpool(destination.unlink, True)
+        raise
+
+
+def _open_for_append(path: Path, offset: int):
+    """以读写方式打开 (不存在则创建)，丢弃 offset 之后残留的数据，并定位到 offset。"""
+    file_object = open(path, "r+b" if path.exists() else "w+b")
+    file_object.truncate(offset)
+    file_object.seek(offset)
+    return file_object
+
+
+async def append_stream_to_file(chunks: AsyncIterator[bytes], path: Path, offset: int, max_bytes: int,
+                                deadline: Optional[float] = None) -> int:
+    """
+    把异步字节流从 offset 处追加写入 path (可续传上传的分块)，返回本次写入的字节数。
+    本次写入超过 max_bytes、超过 deadline (time.monotonic() 时间) 或中途出错时，
+    文件会被截断回 offset，调用方记录的 offset 保持不变。
+    """
+    buffer = bytearray()
+    written = 0
+    file_object = await run_in_threadpool(_open_for_append, path, offset)
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            written += len(chunk)
+            if written > max_bytes:
+                raise UploadTooLarge()
+            if deadline is not None and time.monotonic() > deadline:
+                raise UploadDeadlineExceeded()
+            buffer.extend(chunk)
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                await run_in_threadpool(file_object.write, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(file_object.write, bytes(buffer))
+        await run_in_threadpool(file_object.flush)
+        return written
+    except BaseException:
+        await run_in_threadpool(file_object.truncate, offset)
+        raise
+    finally:
+        await run_in_threadpool(file_object.close)
+
+
+def copy_and_hash(source: BinaryIO, destination: Path) -> Tuple[int, bytes, str]:
+    """
+    把已接收的上传文件对象复制到 destination，同时计算 SHA-256。
+    返回 (字节数, 文件头部, SHA-256 十六进制摘要)。应在线程池中调用。
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    head = b""
+    with open(destination, "wb") as file_object:
+        while True:
+            data = source.read(WRITE_BUFFER_BYTES)
+            if not data:
+                break
+            if not head:
+                head = data[:SNIFF_BYTES]
+            file_object.write(data)
+            hasher.update(data)
+            size += len(data)
+    return size, head, hasher.hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """计算文件的 SHA-256 (可续传上传的分块跨越多个请求，只能在合并完成后计算)。应在线程池中调用。"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file_object:
+        while True:
+            data = file_object.read(WRITE_BUFFER_BYTES)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def read_file_head(path: Path, size: int = SNIFF_BYTES) -> bytes:
+    with open(path, "rb") as file_object:
+        return file_object.read(size)
+
+
+def purge_stale_files(directory: Path, older_than_seconds: float) -> int:
+    """删除目录中超过指定时间未修改的文件，返回删除的文件数量。"""
+    cutoff = time.time() - older_than_seconds
+    removed = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.error(f"清理过期临时文件 {entry.path} 失败: {e}")
+    return removed
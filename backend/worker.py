@@ -0,0 +1,216 @@
+﻿# backend/worker.py
+"""
+持久化任务队列的 worker 进程。
+
+用法 (在项目根目录下运行):
+    python -m backend.worker --processes 4
+
+每个进程独立轮询 job 表，按批领取任务并发执行，失败的任务按指数退避重试。
+媒体处理和邮件发送因此可以与 API 进程分开部署和扩容。
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+from pathlib import Path
+
+from backend import crud, models
+from backend.broadcast import JOB_EMAIL_BROADCAST, run_broadcast_job
+from backend.core.config import get_settings
+from backend.database import AsyncSessionLocal
+from backend.email_utils import send_verification_email, send_password_reset_email, send_account_deletion_email
+from backend.mail_transport import mail_transport
+from backend.thumbnails import process_thumbnail, variant_widths_by_name
+
+logger = logging.getLogger(__name__)
+
+# --- 任务类型 ---
+JOB_THUMBNAIL = "thumbnail"
+JOB_EMAIL_VERIFICATION = "email.verification"
+JOB_EMAIL_PASSWORD_RESET = "email.password_reset"
+JOB_EMAIL_ACCOUNT_DELETION = "email.account_deletion"
+# 全站群发 (JOB_EMAIL_BROADCAST，定义在 backend/broadcast.py)：一个任务发送一批，并在检查点的事务中写入下一批的任务
+
+# 邮件类任务与发送函数的对应关系 (未开启任务队列时，API 进程用它退回到 BackgroundTasks)
+EMAIL_SENDERS = {
+    JOB_EMAIL_VERIFICATION: send_verification_email,
+    JOB_EMAIL_PASSWORD_RESET: send_password_reset_email,
+    JOB_EMAIL_ACCOUNT_DELETION: send_account_deletion_email,
+}
+# 带一次性令牌的邮件：job 表中只保存 user_id，令牌在发送时才生成 (数据库中只有令牌摘要，见 crud.issue_*_token)
+TOKEN_EMAIL_KINDS = {JOB_EMAIL_VERIFICATION, JOB_EMAIL_PASSWORD_RESET}
+
+
+async def issue_email_token(db, kind: str, user_id: int, email: str) -> str:
+    """为验证邮件或重置密码邮件生成令牌 (保存摘要)，返回原始令牌。"""
+    settings = get_settings()
+    if kind == JOB_EMAIL_VERIFICATION:
+        return await crud.issue_verification_token(
+            db=db, user_id=user_id, email=email, max_age_seconds=settings.EMAIL_TOKEN_MAX_AGE_SECONDS)
+    return await crud.issue_password_reset_token(
+        db=db, user_id=user_id, email=email, max_age_seconds=settings.PASSWORD_RESET_TOKEN_MAX_AGE_SECONDS)
+
+
+# --- 任务处理函数 ---
+
+async def handle_thumbnail(payload: dict):
+    """
+    在线程中生成缩略图；worker 进程本身就是扩容单位，无需再套一层进程池。
+    完成后把变体的实际宽度写回数据库 (旧版本写入的任务没有 content_hash，保留规划的宽度)。
+    """
+    success, run_seconds, produced = await asyncio.to_thread(
+        process_thumbnail,
+        Path(payload["original_file_path"]),
+        Path(payload["thumbnail_save_path"]),
+        models.ItemType(payload["item_type"]),
+        [(width, fmt, Path(path)) for width, fmt, path in payload.get("variants", [])],
+        payload.get("variant_quality", 80)
+    )
+    if not success:
+        raise RuntimeError(f"缩略图生成失败: {payload['original_file_path']}")
+    if payload.get("content_hash") and produced:
+        async with AsyncSessionLocal() as session:
+            await crud.record_thumbnail_variants(db=session, sha256=payload["content_hash"],
+                                                 actual_widths=variant_widths_by_name(produced))
+    logger.info(f"缩略图任务完成 ({Path(payload['original_file_path']).name}): 处理 {run_seconds * 1000:.1f}ms")
+
+
+async def handle_email(kind: str, payload: dict):
+    await EMAIL_SENDERS[kind](**payload, raise_on_failure=True)
+
+
+async def handle_token_email(kind: str, payload: dict):
+    """
+    发送时读取用户并生成令牌：用户已被删除或 (验证邮件) 已经验证过时不再发送。
+    旧版本写入的任务没有 user_id，按 email_to 查找用户 (其中的原始令牌已由迁移清除)。
+    """
+    async with AsyncSessionLocal() as session:
+        if "user_id" in payload:
+            user = await session.get(models.User, payload["user_id"])
+        else:
+            user = await crud.get_user_by_email(db=session, email=payload["email_to"])
+        if user is None or (kind == JOB_EMAIL_VERIFICATION and user.is_verified):
+            logger.info(f"{kind} 邮件无需发送 (用户不存在或已验证)。")
+            return
+        user_id, email, username = user.id, user.email, user.username
+        token = await issue_email_token(session, kind, user_id, email)
+    await EMAIL_SENDERS[kind](email_to=email, username=username, token=token, raise_on_failure=True)
+
+
+async def run_job(job: models.Job):
+    """根据任务类型分派到对应的处理函数，失败时抛出异常。"""
+    if job.kind == JOB_THUMBNAIL:
+        await handle_thumbnail(job.payload)
+    elif job.kind in TOKEN_EMAIL_KINDS:
+        await handle_token_email(job.kind, job.payload)
+    elif job.kind in EMAIL_SENDERS:
+        await handle_email(job.kind, job.payload)
+    elif job.kind == JOB_EMAIL_BROADCAST:
+        await run_broadcast_job(job.payload["broadcast_id"], job.payload.get("after_user_id"))
+    else:
+        raise ValueError(f"未知的任务类型: {job.kind}")
+
+
+# --- worker 主循环 ---
+
+async def _execute(job: models.Job):
+    settings = get_settings()
+    try:
+        await run_job(job)
+    except Exception as e:
+        logger.error(f"任务 {job.id} ({job.kind}) 第 {job.attempts} 次执行失败: {e}")
+        async with AsyncSessionLocal() as session:
+            recorded = await crud.fail_job(
+                db=session, job=job, error=repr(e),
+                retry_base_seconds=settings.JOB_RETRY_BASE_SECONDS,
+                retry_max_seconds=settings.JOB_RETRY_MAX_SECONDS
+            )
+        if not recorded:
+            logger.warning(f"任务 {job.id} ({job.kind}) 已超时并被重新领取，本次失败不再记录。")
+        return
+
+    async with AsyncSessionLocal() as session:
+        if not await crud.complete_job(db=session, job=job):
+            logger.warning(f"任务 {job.id} ({job.kind}) 已超时并被重新领取，本次结果不再记录。")
+
+
+async def run_worker(worker_id: int, stop_event: asyncio.Event):
+    """持续领取并执行任务，直到 stop_event 被设置。当前批次会在退出前执行完毕。"""
+    settings = get_settings()
+    logger.info(f"worker {worker_id} 已启动。")
+    while not stop_event.is_set():
+        try:
+            async with AsyncSessionLocal() as session:
+                jobs = await crud.claim_jobs(
+                    db=session,
+                    batch_size=settings.JOB_BATCH_SIZE,
+                    lock_timeout_seconds=settings.JOB_LOCK_TIMEOUT_SECONDS
+                )
+        except Exception as e:
+            logger.error(f"worker {worker_id} 领取任务失败: {e}")
+            jobs = []
+
+        if not jobs:
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await asyncio.gather(*(_execute(job) for job in jobs))
+    logger.info(f"worker {worker_id} 已退出。")
+
+
+def _configure_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+
+def _process_main(worker_id: int):
+    # spawn 启动的子进程不继承父进程的日志配置，需要重新配置，否则任务失败的日志会被丢弃
+    _configure_logging()
+
+    async def _main():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        await run_worker(worker_id, stop_event)
+        await mail_transport.shutdown()
+
+    asyncio.run(_main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="持久化任务队列 worker")
+    parser.add_argument("--processes", type=int, default=get_settings().JOB_WORKER_PROCESSES,
+                        help="启动的 worker 进程数量")
+    args = parser.parse_args()
+    _configure_logging()
+
+    if args.processes <= 1:
+        _process_main(0)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_process_main, args=(i,), name=f"job-worker-{i}")
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    # 父进程收到 SIGTERM 时转发给子进程，让它们执行完当前批次后退出
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
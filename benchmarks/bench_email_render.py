@@ -0,0 +1,122 @@
+﻿# benchmarks/bench_email_render.py
+"""
+对比邮件正文的两种生成方式的吞吐量 (不连接 SMTP 服务器，也不读取数据库)：
+
+- fstring:  原先 send_password_reset_email 的做法，每封邮件用 f-string 拼出完整 HTML (含 <style>)；
+- compiled: email_templates 预编译的模板，每封邮件只替换用户名和令牌，同时生成纯文本版本。
+
+两种方式都分别统计只渲染正文、以及渲染后构造 EmailMessage 并序列化为字节 (即交给 SMTP 连接之前的全部工作) 的每秒次数。
+用法 (在项目根目录下运行):
+    python -m benchmarks.bench_email_render --iterations 20000
+"""
+import argparse
+import secrets
+import time
+from email.message import EmailMessage
+
+from backend.email_templates import EmailTemplates
+
+SITE_NAME = "The Web of Andy and Leyley"
+FRONTEND_BASE_URL = "https://example.com"
+RESET_MINUTES = 30
+
+
+def fstring_render(username: str, token: str):
+    # 与改动前 email_utils.send_password_reset_email 中的代码相同 (配置值改为常量)
+    subject = f"{SITE_NAME} - 密码重置请求"
+    reset_url = f"{FRONTEND_BASE_URL}/reset-password?token={token}"
+    html_content = f"""
+    <html>
+        <head>
+            <style>
+                body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
+                .container {{ padding: 20px; border: 1px solid #ddd; border-radius: 5px; max-width: 600px; margin: 20px auto; }}
+                .button {{ background-color: #28a745; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block; }}
+                p {{ margin-bottom: 15px; }}
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <p>您好 {username},</p>
+                <p>我们收到了一个重置您在【{SITE_NAME}】账户密码的请求。</p>
+                <p>请点击下面的按钮或链接以设置您的新密码。如果您没有请求重置密码，请忽略此邮件。</p>
+                <p><a href="{reset_url}" class="button">重置密码</a></p>
+                <p>如果按钮无法点击，请复制以下链接到您的浏览器地址栏中打开：<br>{reset_url}</p>
+                <p>此链接将在 {RESET_MINUTES} 分钟内有效。</p>
+                <p>此致，<br/>【{SITE_NAME}】团队</p>
+            </div>
+        </body>
+    </html>
+    """
+    return subject, html_content, None
+
+
+def make_compiled_render():
+    templates = EmailTemplates()
+    templates.compile(site_name=SITE_NAME, frontend_base_url=FRONTEND_BASE_URL, reset_minutes=RESET_MINUTES)
+
+    def compiled_render(username: str, token: str):
+        return templates.render("password_reset", username=username, token=token)
+
+    return compiled_render
+
+
+def build_message(subject: str, html_body: str, text_body) -> bytes:
+    # 与 email_utils.send_email 构造邮件的方式相同
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = f"{SITE_NAME} <noreply@example.com>"
+    msg['To'] = "user@example.com"
+    if text_body is not None:
+        msg.set_content(text_body, charset='utf-8')
+        msg.add_alternative(html_body, subtype='html', charset='utf-8')
+    else:
+        msg.set_content(html_body, subtype='html', charset='utf-8')
+    return msg.as_bytes()
+
+
+def measure(name: str, render, iterations: int, with_message: bool) -> dict:
+    tokens = [secrets.token_urlsafe(32) for _ in range(256)]
+    started = time.perf_counter()
+    size = 0
+    for index in range(iterations):
+        subject, html_body, text_body = render(f"user{index % 1000}", tokens[index % len(tokens)])
+        if with_message:
+            size = len(build_message(subject, html_body, text_body))
+        else:
+            size = len(html_body)
+    elapsed = time.perf_counter() - started
+    return {
+        "path": name,
+        "stage": "message" if with_message else "render",
+        "per_second": int(iterations / elapsed),
+        "us_each": round(elapsed / iterations * 1_000_000, 2),
+        "bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="邮件模板渲染吞吐量基准测试")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    compiled_render = make_compiled_render()
+    print(f"模板编译耗时: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+    paths = {"fstring": fstring_render, "compiled": compiled_render}
+    results = []
+    for with_message in (False, True):
+        # 组装邮件比渲染慢得多，迭代次数减少到十分之一
+        iterations = args.iterations if not with_message else max(1, args.iterations // 10)
+        for name, render in paths.items():
+            results.append(measure(name, render, iterations, with_message))
+
+    columns = list(results[0].keys())
+    print(" | ".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>12}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+﻿# benchmarks/bench_gallery_list.py
+"""
+对比公开画廊列表的两条读取路径：
+
+- orm:        crud.get_paginated_gallery_items 加载 ORM 实体 (外加两次 selectinload)，
+              再经 GalleryItemReadWithBuilder 逐字段校验后序列化 (即原先 /gallery/items 的做法)；
+- projection: crud.get_gallery_listing_page 单次 JOIN 投影查询，行元组直接序列化为 JSON。
+
+统计每次请求的 SQL 查询数、内存分配峰值 (tracemalloc) 以及延迟 p50/p99。
+只读取数据，不修改数据库。用法 (在项目根目录下运行，使用 .env 中配置的数据库):
+    python -m benchmarks.bench_gallery_list --iterations 500 --page-size 24
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from backend import crud
+from backend.database import AsyncSessionLocal, async_engine
+from backend.models import GalleryItemReadWithBuilder
+
+
+async def orm_path(session, page: int, page_size: int) -> bytes:
+    _, items = await crud.get_paginated_gallery_items(db=session, page=page, page_size=page_size, count_mode=None)
+    payload = [GalleryItemReadWithBuilder.model_validate(item).model_dump(mode="json") for item in items]
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+async def projection_path(session, page: int, page_size: int) -> bytes:
+    rows, _ = await crud.get_gallery_listing_page(db=session, page_size=page_size, offset=(page - 1) * page_size)
+    payload = [crud.gallery_listing_row_to_dict(row) for row in rows]
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+PATHS = {"orm": orm_path, "projection": projection_path}
+
+
+async def run_once(path, page: int, page_size: int) -> bytes:
+    # 每次请求使用新的会话，与 get_async_session 依赖的行为一致 (不复用 identity map)
+    async with AsyncSessionLocal() as session:
+        return await path(session, page, page_size)
+
+
+async def measure(name: str, page: int, page_size: int, iterations: int, warmup: int) -> dict:
+    path = PATHS[name]
+    for _ in range(warmup):
+        await run_once(path, page, page_size)
+
+    # 1. 查询数
+    query_count = 0
+
+    def _count_query(*args):
+        nonlocal query_count
+        query_count += 1
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", _count_query)
+    body = await run_once(path, page, page_size)
+    event.remove(async_engine.sync_engine, "before_cursor_execute", _count_query)
+
+    # 2. 内存分配 (单独测量，tracemalloc 本身会显著拖慢执行)
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(iterations, 50)):
+        tracemalloc.reset_peak()
+        start_current, _ = tracemalloc.get_traced_memory()
+        await run_once(path, page, page_size)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - start_current)
+    tracemalloc.stop()
+
+    # 3. 延迟
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await run_once(path, page, page_size)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+
+    return {
+        "path": name,
+        "queries": query_count,
+        "response_bytes": len(body),
+        "alloc_peak_kb": round(statistics.mean(peaks) / 1024, 1),
+        "p50_ms": round(latencies[len(latencies) // 2], 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="画廊列表读取路径基准测试")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--page", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=24)
+    args = parser.parse_args()
+
+    async_engine.echo = False  # database.py 默认打开了 SQL 日志，会淹没计时结果
+    results = [await measure(name, args.page, args.page_size, args.iterations, args.warmup) for name in PATHS]
+    await async_engine.dispose()
+
+    columns = list(results[0].keys())
+    print(" | ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>14}" for column in columns))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+﻿# benchmarks/fake_avatar_upstream.py
+"""
+用于测试头像代理的本地假上游 (只依赖标准库)。
+
+用法:
+    python -m benchmarks.fake_avatar_upstream --port 8099 --delay 2 --fail-rate 0.5
+然后在 .env 中设置:
+    MC_AVATAR_URL_TEMPLATE="http://127.0.0.1:8099/avatar/{{username}}/128.png"
+
+- 用户名以 missing 开头时返回 404 (验证负缓存)；
+- --delay 模拟上游变慢 (验证请求合并：并发请求同一用户名时，这里只会收到一次请求)；
+- --fail-rate 按比例返回 503 (验证熔断器和占位头像)。
+每个请求都会打印到标准输出，便于统计代理实际发往上游的请求数。
+"""
+import argparse
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 像素的 PNG
+PNG_PIXEL = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000b49444154789c6360000200000500017a5eab3f0000000049454e44ae426082"
+)
+
+
+def make_handler(delay: float, fail_rate: float):
+    class FakeAvatarHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            parts = self.path.strip("/").split("/")
+            username = parts[1] if len(parts) > 1 else ""
+            if random.random() < fail_rate:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if username.lower().startswith("missing"):
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(PNG_PIXEL)))
+            self.end_headers()
+            self.wfile.write(PNG_PIXEL)
+
+    return FakeAvatarHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="头像代理测试用的本地假上游")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay", type=float, default=0.0, help="每个请求的延迟秒数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回 503 的比例 (0-1)")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args.delay, args.fail_rate))
+    print(f"假头像上游已启动: http://127.0.0.1:{args.port}/avatar/<username>/128.png")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
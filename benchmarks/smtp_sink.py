@@ -0,0 +1,79 @@
+﻿# benchmarks/smtp_sink.py
+"""
+本地 SMTP 接收端 (只收不发)，用于测试 backend/mail_transport.py 的连接复用、批量发送和重试。
+需要安装 aiosmtpd (pip install aiosmtpd)。
+
+用法:
+    python -m benchmarks.smtp_sink --port 8025 --fail-rate 0.2
+然后在 .env 中设置:
+    MAIL_SERVER="127.0.0.1"
+    MAIL_PORT=8025
+    MAIL_STARTTLS=False
+    MAIL_SSL_TLS=False
+    MAIL_USE_CREDENTIALS=False
+
+- --fail-rate 按比例对 DATA 返回 451 临时错误 (验证重试)；
+- --delay 模拟慢速服务器；
+- 每秒打印一次累计的连接数和收到的邮件数：连接池正常工作时，连接数应远小于邮件数。
+"""
+import argparse
+import asyncio
+import random
+
+from aiosmtpd.controller import Controller
+
+
+class SinkHandler:
+    def __init__(self, delay: float, fail_rate: float):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.connections = 0
+        self.messages = 0
+        self.rejected = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.rejected += 1
+            return "451 Temporary failure, please retry"
+        self.messages += 1
+        return "250 Message accepted for delivery"
+
+
+async def report(handler: SinkHandler):
+    last = None
+    while True:
+        await asyncio.sleep(1)
+        current = (handler.connections, handler.messages, handler.rejected)
+        if current != last:
+            print(f"连接 {handler.connections} | 收到邮件 {handler.messages} | 临时拒绝 {handler.rejected}")
+            last = current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 SMTP 接收端")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--delay", type=float, default=0.0, help="每封邮件的处理延迟秒数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回 451 的比例 (0-1)")
+    args = parser.parse_args()
+
+    handler = SinkHandler(args.delay, args.fail_rate)
+    controller = Controller(handler, hostname="127.0.0.1", port=args.port)
+    controller.start()
+    print(f"SMTP 接收端已启动: 127.0.0.1:{args.port}")
+    try:
+        asyncio.run(report(handler))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -52,6 +52,13 @@ export const useAuthStore = defineStore('auth', () => {
     // 【核心修正】: 在函数内部获取 router 实例
     const router = useRouter();
 
+    // 通知后端吊销当前令牌 (不等待结果)；本地令牌先清除，401 触发的再次登出不会重复请求
+    if (accessToken.value) {
+      apiClient.post('/auth/logout',
+        refreshToken.value ? { refresh_token: refreshToken.value } : null,
+        { headers: { Authorization: `Bearer ${accessToken.value}` } }
+      ).catch(() => {});
+    }
     setTokens(null, null);
     setUserInfo(null);
 
@@ -0,0 +1,85 @@
+﻿/**
+ * 合并同一时刻发起的 MC 头像请求。
+ * 成员网格、画廊卡片里的每个 Avatar 组件都会请求一次头像，这里把同一个事件循环周期内的请求
+ * 合并成一次 /avatars/batch?format=ndjson 请求，先就绪的头像先显示。
+ */
+const BATCH_MAX_NAMES = 100;
+
+// 小写用户名 -> Promise<string | null>，已经加载过的头像直接复用 (data URL)
+const avatarPromises = new Map();
+let pending = null;
+
+async function flushBatch(apiBaseUrl, entries) {
+  const names = [...entries.keys()];
+  const url = `${apiBaseUrl.replace(/\/$/, '')}/avatars/batch?format=ndjson&names=${names.map(encodeURIComponent).join(',')}`;
+  try {
+    const response = await fetch(url);
+    if (!response.ok || !response.body) {
+      throw new Error(`批量获取头像失败: ${response.status}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    const handleLine = (line) => {
+      if (!line.trim()) return;
+      const item = JSON.parse(line);
+      const entry = entries.get(item.name.toLowerCase());
+      if (!entry) return;
+      entry.resolve(item.missing ? null : `data:${item.content_type};base64,${item.data}`);
+      // 占位头像只在本次页面中使用，下次重新请求，上游恢复后即可换回真实头像
+      if (item.missing || item.fallback) avatarPromises.delete(item.name.toLowerCase());
+    };
+    for (;;) {
+      const {done, value} = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, {stream: true});
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      lines.forEach(handleLine);
+    }
+    handleLine(buffer);
+  } catch (error) {
+    console.error(error);
+  } finally {
+    // 没有出现在响应中的用户名按不存在处理，调用方会使用备用头像
+    for (const [key, entry] of entries) {
+      if (!entry.settled) avatarPromises.delete(key);
+      entry.resolve(null);
+    }
+  }
+}
+
+/**
+ * 获取一个 MC 头像的 data URL；头像不存在或请求失败时返回 null。
+ * @param {string} name - Minecraft 用户名。
+ * @param {string} apiBaseUrl - 后端API的基础地址。
+ * @returns {Promise<string | null>}
+ */
+export function loadMcAvatar(name, apiBaseUrl) {
+  const key = name.toLowerCase();
+  if (avatarPromises.has(key)) {
+    return avatarPromises.get(key);
+  }
+  if (!pending || pending.apiBaseUrl !== apiBaseUrl || pending.entries.size >= BATCH_MAX_NAMES) {
+    const batch = {apiBaseUrl, entries: new Map()};
+    pending = batch;
+    queueMicrotask(() => {
+      if (pending === batch) pending = null;
+      flushBatch(batch.apiBaseUrl, batch.entries);
+    });
+  }
+  const promise = new Promise((resolve) => {
+    const entry = {
+      settled: false,
+      resolve: (value) => {
+        if (!entry.settled) {
+          entry.settled = true;
+          resolve(value);
+        }
+      }
+    };
+    pending.entries.set(key, entry);
+  });
+  avatarPromises.set(key, promise);
+  return promise;
+}
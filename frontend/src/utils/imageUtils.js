@@ -29,4 +29,21 @@ export function getFullImageUrl(relativeUrl, name, apiBaseUrl) {
   // 优先级 3: 最终备选方案，返回一个本地的或网络的统一占位符
   // 您可以替换为您喜欢的任何占位符图片URL
   return '/placeholder-avatar.png';
-}
\ No newline at end of file
+}
+
+/**
+ * 根据后端返回的缩略图变体列表，生成指定格式的 srcset 字符串。
+ * @param {Array<{url: string, width: number, format: string}> | null | undefined} variants - 缩略图变体列表。
+ * @param {string} format - 需要的格式，例如 'webp' 或 'jpeg'。
+ * @param {string} apiBaseUrl - 后端API的基础地址。
+ * @returns {string} srcset 字符串；没有对应格式的变体时返回空字符串。
+ */
+export function buildSrcset(variants, format, apiBaseUrl) {
+  if (!Array.isArray(variants)) {
+    return '';
+  }
+  return variants
+    .filter(variant => variant.format === format)
+    .map(variant => `${getFullImageUrl(variant.url, null, apiBaseUrl)} ${variant.width}w`)
+    .join(', ');
+}